@@ -0,0 +1,557 @@
+"""
+Бенчмарк обработки обновлений без Telegram
+
+Синтетические обновления для всех сценариев бота (/start, кнопки меню,
+inline-кнопки stars_*, ввод количества, подарок) проходят через настоящий
+Dispatcher и обработчики из telestars_bot.py. Вызовы Bot API принимает
+FakeBot, который только считает их. Вместо PostgreSQL по умолчанию
+используется SQLite с теми же функциями, что и в database.py.
+
+Использование:
+    python bench.py                                  # SQLite в памяти, 16 клиентов
+    python bench.py --concurrency 64 --users 10000 --sessions 20000
+    python bench.py --database postgres              # база из DATABASE_URL (миграции применены)
+    python bench.py --processes 4                    # 4 процесса, пользователи по jump_hash
+    python bench.py --save-baseline bench_baseline.json
+    python bench.py --compare bench_baseline.json    # код выхода 1 при регрессии
+"""
+import argparse
+import copy
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+# Бенчмарку не нужны настоящие токен и база; конфигурация требует, чтобы они были заданы
+os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/telestars')
+
+from telegram import Update
+from telegram.ext import Dispatcher, TypeHandler
+
+import telestars_bot
+from config import DB_EXECUTOR_WORKERS, DB_EXECUTOR_QUEUE_SIZE, DB_TASK_TIMEOUT
+from conversation_state import StateStore, create_backend
+from database import user_row
+from db_executor import KeyedExecutor
+from outbound import OutboundScheduler
+from webhook_loadtest import make_update, percentile
+from workers import jump_hash
+from write_behind import RegistrationBuffer
+
+logger = logging.getLogger(__name__)
+
+# Сценарии: последовательность действий одного пользователя
+FLOWS = {
+    'start': [('text', '/start')],
+    'menu': [('text', '👤 Профиль'), ('text', '💎 Купить Premium'), ('text', '🆘 Поддержка')],
+    'buy_button': [('text', '⭐ Купить звезды'), ('callback', 'stars_100')],
+    'buy_amount': [('text', '⭐ Купить звезды'), ('text', '250')],
+    'gift': [('text', '⭐ Купить звезды'), ('callback', 'stars_gift'), ('text', '500')],
+    'invalid_amount': [('text', '⭐ Купить звезды'), ('text', 'abc'), ('text', '10'), ('callback', 'stars_50')],
+    'unknown_text': [('text', 'привет')],
+}
+
+# Метрики, по которым сравниваются результаты: (ключ, True если больше - лучше)
+_COMPARED = [('throughput', True), ('p50_ms', False), ('p95_ms', False), ('p99_ms', False)]
+
+
+class FakeBot:
+    """Bot без сети: считает вызовы Bot API и сразу отвечает (или через latency секунд)"""
+
+    def __init__(self, latency=0.0):
+        self.id = 1
+        self.username = 'telestars_bench_bot'
+        self.first_name = 'Bench'
+        self.defaults = None
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1_000_000)
+
+    def _call(self, method, chat_id=None):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] += 1
+            message_id = next(self._message_ids)
+        return SimpleNamespace(message_id=message_id, chat_id=chat_id)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._call('send_message', chat_id)
+
+    def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        return self._call('edit_message_text', chat_id)
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self._call('answer_callback_query')
+        return True
+
+    # Объекты PTB 12.8 (CallbackQuery.answer() и др.) вызывают методы Bot в camelCase
+    sendMessage = send_message
+    editMessageText = edit_message_text
+    answerCallbackQuery = answer_callback_query
+
+
+class SQLiteDatabase:
+    """Функции database.py, которые вызывают обработчики, поверх SQLite"""
+
+    def __init__(self, path=':memory:'):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT NOT NULL,
+                    last_name TEXT,
+                    language_code TEXT,
+                    is_premium INTEGER DEFAULT 0,
+                    stars_balance INTEGER DEFAULT 0,
+                    total_spent INTEGER DEFAULT 0,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    amount INTEGER NOT NULL,
+                    cost TEXT NOT NULL,
+                    is_gift INTEGER NOT NULL,
+                    created_at TEXT NOT NULL,
+                    expires_at TEXT NOT NULL
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_orders_user_status ON orders(user_id, status)"
+            )
+
+    def _upsert(self, rows):
+        now = datetime.now().isoformat()
+        new_users = 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for row in rows:
+                exists = self._conn.execute("SELECT 1 FROM users WHERE id = ?", (row[0],)).fetchone()
+                self._conn.execute("""
+                    INSERT INTO users (id, username, first_name, last_name, language_code, is_premium,
+                                       created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE
+                    SET username = excluded.username, first_name = excluded.first_name,
+                        last_name = excluded.last_name, language_code = excluded.language_code,
+                        is_premium = excluded.is_premium, updated_at = excluded.updated_at
+                """, row + (now, now))
+                new_users += exists is None
+            self._conn.execute("COMMIT")
+        return new_users
+
+    def add_user(self, user):
+        return self._upsert([user_row(user)]) == 1
+
+    def add_users_bulk(self, rows):
+        return self._upsert(list({row[0]: row for row in rows}.values()))
+
+    def get_user(self, user_id):
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+            row = cursor.fetchone()
+            columns = [column[0] for column in cursor.description]
+        if row is None:
+            return None
+        user = dict(zip(columns, row))
+        user['created_at'] = datetime.fromisoformat(user['created_at'])
+        return user
+
+    def create_order(self, user_id, amount, cost, is_gift, ttl_seconds):
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=ttl_seconds)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "UPDATE orders SET status = 'cancelled' WHERE user_id = ? AND status = 'pending'", (user_id,)
+            )
+            cursor = self._conn.execute("""
+                INSERT INTO orders (user_id, status, amount, cost, is_gift, created_at, expires_at)
+                VALUES (?, 'pending', ?, ?, ?, ?, ?)
+            """, (user_id, amount, str(cost), is_gift, now.isoformat(), expires_at.isoformat()))
+            order_id = cursor.lastrowid
+            self._conn.execute("COMMIT")
+        return {'id': order_id, 'created_at': now, 'expires_at': expires_at}
+
+    def install(self, module):
+        """Подменить функции базы данных в модуле бота"""
+        module.add_user = self.add_user
+        module.add_users_bulk = self.add_users_bulk
+        module.get_user = self.get_user
+        module.create_order = self.create_order
+
+
+def make_callback(update_id, user_id, data):
+    """Синтетическое нажатие inline-кнопки под сообщением бота"""
+    message = make_update(update_id, user_id, 'Выберите количество звёзд')['message']
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': message['from'],
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': message,
+        },
+    }
+
+
+class Bench:
+    """Диспетчер бота с фейковым Bot и клиенты, которые отправляют ему обновления"""
+
+    def __init__(self, args, user_ids=None):
+        """
+        Args:
+            args: параметры командной строки
+            user_ids: из каких пользователей выбирать (по умолчанию 1..args.users)
+        """
+        self.args = args
+        self.user_ids = user_ids or range(1, args.users + 1)
+        self.bot = FakeBot(latency=args.bot_latency)
+        self.dispatcher = Dispatcher(self.bot, queue.Queue(), workers=1, use_context=True)
+        self.outbound = OutboundScheduler(
+            self.bot,
+            global_rate=args.outbound_rate,
+            chat_rate=args.outbound_rate,
+            chat_burst=int(args.outbound_rate),
+            workers=args.outbound_workers,
+        )
+        self.executor = KeyedExecutor(
+            workers=DB_EXECUTOR_WORKERS,
+            queue_size=DB_EXECUTOR_QUEUE_SIZE,
+            task_timeout=DB_TASK_TIMEOUT,
+            name='bench-db',
+        )
+        self.state_store = StateStore(
+            create_backend(args.state, args.state_path),
+            executor=self.executor,
+            timeout=DB_TASK_TIMEOUT,
+        )
+        self.registrations = None
+        if args.write_behind:
+            self.registrations = RegistrationBuffer(telestars_bot.add_users_bulk, batch_size=500, flush_interval=0.5)
+
+        bot_data = self.dispatcher.bot_data
+        bot_data['outbound'] = self.outbound
+        bot_data['db_executor'] = self.executor
+        bot_data['state_store'] = self.state_store
+        if self.registrations is not None:
+            bot_data['registrations'] = self.registrations
+
+        telestars_bot.register_handlers(self.dispatcher)
+        self.dispatcher.add_error_handler(self._on_error)
+        # Последняя группа отмечает, что обновление полностью обработано
+        self.dispatcher.add_handler(TypeHandler(Update, self._on_processed), group=99)
+
+        self._update_ids = itertools.count(1)
+        self._sessions = itertools.count()
+        self._lock = threading.Lock()
+        self._waiting = {}  # update_id -> threading.Event
+        self.latencies = defaultdict(list)  # сценарий -> задержки обработки, секунды
+        self.errors = Counter()  # тип исключения -> сколько раз обработчики его выбросили
+        self.error_samples = {}  # тип исключения -> текст первой ошибки
+
+    def _on_error(self, update, context):
+        """Ошибка в обработчике: обновление все равно дойдет до _on_processed, поэтому считаем ее здесь"""
+        name = type(context.error).__name__
+        with self._lock:
+            self.errors[name] += 1
+            self.error_samples.setdefault(name, repr(context.error))
+
+    def _on_processed(self, update, context):
+        event = self._waiting.pop(update.update_id, None)
+        if event is not None:
+            event.set()
+
+    def _send(self, kind, user_id, payload):
+        with self._lock:
+            update_id = next(self._update_ids)
+        if kind == 'callback':
+            data = make_callback(update_id, user_id, payload)
+        else:
+            data = make_update(update_id, user_id, payload)
+        update = Update.de_json(data, self.bot)
+        event = threading.Event()
+        self._waiting[update_id] = event
+        started = time.perf_counter()
+        self.dispatcher.update_queue.put(update)
+        if not event.wait(30):
+            raise RuntimeError(f"Обновление {update_id} не обработано за 30 с")
+        return time.perf_counter() - started
+
+    def _client(self, flows, results):
+        rng = random.Random()
+        local = defaultdict(list)
+        while True:
+            with self._lock:
+                session = next(self._sessions)
+            if session >= self.args.sessions:
+                break
+            name = flows[session % len(flows)]
+            user_id = rng.choice(self.user_ids)
+            for kind, payload in FLOWS[name]:
+                local[name].append(self._send(kind, user_id, payload))
+        with self._lock:
+            for name, values in local.items():
+                results[name].extend(values)
+
+    def run(self):
+        """
+        Прогнать сценарии в concurrency клиентов
+
+        Returns:
+            dict: latencies (сценарий -> задержки в секундах), elapsed, drained,
+                  bot_calls, outbound_latency_p95, errors (тип -> число), error_samples
+        """
+        flows = self.args.flows or list(FLOWS)
+        thread = threading.Thread(target=self.dispatcher.start, name='dispatcher', daemon=True)
+        thread.start()
+        while not self.dispatcher.running:
+            time.sleep(0.01)
+
+        started = time.perf_counter()
+        clients = [
+            threading.Thread(target=self._client, args=(flows, self.latencies))
+            for _ in range(self.args.concurrency)
+        ]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - started
+
+        # Дожидаемся исходящих сообщений и фоновых записей
+        self.dispatcher.stop()
+        self.outbound.stop()
+        drained = time.perf_counter() - started
+        self.state_store.close()
+        self.executor.shutdown(wait=True)
+        if self.registrations is not None:
+            self.registrations.close()
+
+        return {
+            'latencies': dict(self.latencies),
+            'elapsed': elapsed,
+            'drained': drained,
+            'bot_calls': dict(self.bot.calls),
+            'outbound_latency_p95': self.outbound.stats()['latency_p95'],
+            'errors': dict(self.errors),
+            'error_samples': dict(self.error_samples),
+        }
+
+
+def _prepare(args):
+    """Подготовить процесс к прогону: уровень логов и замена базы данных"""
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    if args.database == 'sqlite':
+        SQLiteDatabase(args.sqlite_path).install(telestars_bot)
+    else:
+        telestars_bot.pricing.reload()
+
+
+def run_partition(args, index, count):
+    """
+    Прогон в отдельном процессе для пользователей, которые по jump_hash
+    попадают в процесс index из count (как в режиме BOT_WORKERS)
+    """
+    _prepare(args)
+    partition_args = copy.copy(args)
+    partition_args.sessions = args.sessions // count + (1 if index < args.sessions % count else 0)
+    user_ids = [user_id for user_id in range(1, args.users + 1) if jump_hash(user_id, count) == index]
+    return Bench(partition_args, user_ids).run()
+
+
+def expected_bot_calls(flows):
+    """
+    Методы Bot API, которые обязаны вызываться в этих сценариях
+
+    Если какого-то вызова нет, сценарий не дошел до ответа пользователю.
+    """
+    expected = {'send_message'}
+    if any(kind == 'callback' for name in flows for kind, _ in FLOWS[name]):
+        expected.update(('answer_callback_query', 'edit_message_text'))
+    return sorted(expected)
+
+
+def report(args, runs):
+    """
+    Сводка по прогонам всех процессов
+
+    Процессы работают параллельно, поэтому время прогона - время самого долгого из них.
+
+    Returns:
+        dict: параметры и результаты
+    """
+    flows = args.flows or list(FLOWS)
+    latencies = defaultdict(list)
+    bot_calls = Counter()
+    errors = Counter()
+    error_samples = {}
+    for run in runs:
+        for name, values in run['latencies'].items():
+            latencies[name].extend(values)
+        bot_calls.update(run['bot_calls'])
+        errors.update(run['errors'])
+        for name, sample in run['error_samples'].items():
+            error_samples.setdefault(name, sample)
+    elapsed = max(run['elapsed'] for run in runs)
+    all_latencies = sorted(value for values in latencies.values() for value in values)
+
+    results = {
+        'updates': len(all_latencies),
+        'elapsed': elapsed,
+        'throughput': len(all_latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(all_latencies, 0.50) * 1000,
+        'p95_ms': percentile(all_latencies, 0.95) * 1000,
+        'p99_ms': percentile(all_latencies, 0.99) * 1000,
+        'drain_elapsed': max(run['drained'] for run in runs),
+        'bot_calls': dict(bot_calls),
+        'missing_bot_calls': [method for method in expected_bot_calls(flows) if not bot_calls.get(method)],
+        'errors': dict(errors),
+        'error_samples': error_samples,
+        'outbound_latency_p95_ms': max(run['outbound_latency_p95'] for run in runs) * 1000,
+        'flows': {},
+    }
+    for name in flows:
+        values = sorted(latencies.get(name, []))
+        results['flows'][name] = {
+            'updates': len(values),
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p95_ms': percentile(values, 0.95) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+        }
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'params': {
+            'database': args.database,
+            'state': args.state,
+            'processes': args.processes,
+            'concurrency': args.concurrency,
+            'users': args.users,
+            'sessions': args.sessions,
+            'write_behind': args.write_behind,
+            'bot_latency': args.bot_latency,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, tolerance):
+    """
+    Сравнить результаты с базовыми
+
+    Returns:
+        list: строки отчета и признак регрессии (list, bool)
+    """
+    lines = []
+    regressed = False
+    for key, higher_is_better in _COMPARED:
+        before = baseline['results'][key]
+        after = current['results'][key]
+        change = (after - before) / before if before else 0.0
+        worse = -change if higher_is_better else change
+        mark = ''
+        if worse > tolerance:
+            mark = '  <-- регрессия'
+            regressed = True
+        lines.append(f"{key:>12}: {before:10.2f} -> {after:10.2f} ({change:+.1%}){mark}")
+    return lines, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк обработки обновлений без Telegram")
+    parser.add_argument('--concurrency', type=int, default=16, help="число параллельных клиентов в процессе")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="число процессов-обработчиков (пользователи делятся между ними по jump_hash)")
+    parser.add_argument('--users', type=int, default=1000, help="число разных пользователей")
+    parser.add_argument('--sessions', type=int, default=5000, help="сколько сценариев выполнить")
+    parser.add_argument('--flows', nargs='+', choices=list(FLOWS), help="сценарии (по умолчанию все)")
+    parser.add_argument('--database', choices=['sqlite', 'postgres'], default='sqlite',
+                        help="sqlite - замена в памяти, postgres - база из DATABASE_URL")
+    parser.add_argument('--sqlite-path', default=':memory:', help="файл SQLite для --database sqlite")
+    parser.add_argument('--state', choices=['memory', 'sqlite', 'postgres'], default='memory',
+                        help="хранилище состояния диалога")
+    parser.add_argument('--state-path', default=':memory:', help="файл SQLite для --state sqlite")
+    parser.add_argument('--write-behind', action='store_true', help="пакетная запись регистраций")
+    parser.add_argument('--bot-latency', type=float, default=0.0, help="задержка ответа FakeBot, секунд")
+    parser.add_argument('--outbound-rate', type=float, default=1e6, help="лимит исходящих сообщений в секунду")
+    parser.add_argument('--outbound-workers', type=int, default=8, help="потоков для вызовов Bot API")
+    parser.add_argument('--save-baseline', metavar='FILE', help="сохранить результаты как базовые")
+    parser.add_argument('--compare', metavar='FILE', help="сравнить с базовыми результатами")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое ухудшение (0.2 = 20%%)")
+    parser.add_argument('--verbose', action='store_true', help="логи бота уровня INFO")
+    args = parser.parse_args()
+
+    if args.processes > 1:
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(args.processes) as pool:
+            runs = pool.starmap(run_partition, [(args, index, args.processes) for index in range(args.processes)])
+    else:
+        _prepare(args)
+        runs = [Bench(args).run()]
+
+    result = report(args, runs)
+    results = result['results']
+    print(f"Обновлений: {results['updates']} за {results['elapsed']:.2f} с "
+          f"({results['throughput']:.0f} обновлений/с)")
+    print(f"Задержка обработки: p50={results['p50_ms']:.2f} мс, "
+          f"p95={results['p95_ms']:.2f} мс, p99={results['p99_ms']:.2f} мс")
+    for name, flow in results['flows'].items():
+        print(f"  {name:>15}: {flow['updates']:7d} обновлений, p50={flow['p50_ms']:.2f} мс, "
+              f"p95={flow['p95_ms']:.2f} мс, p99={flow['p99_ms']:.2f} мс")
+    print(f"Вызовы Bot API: {results['bot_calls']}, все отправлены за {results['drain_elapsed']:.2f} с")
+
+    # Прогон с ошибками не годится ни как результат, ни как базовый уровень
+    failed = False
+    if results['errors']:
+        failed = True
+        print(f"Ошибки в обработчиках: {sum(results['errors'].values())}")
+        for name, count in sorted(results['errors'].items()):
+            print(f"  {name}: {count} (например, {results['error_samples'][name]})")
+    if results['missing_bot_calls']:
+        failed = True
+        print(f"Не было вызовов Bot API: {', '.join(results['missing_bot_calls'])}")
+    if failed:
+        sys.exit(1)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Базовые результаты сохранены в {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['params'] != result['params']:
+            print(f"Внимание: параметры отличаются от базовых: {baseline['params']}")
+        lines, regressed = compare(baseline, result, args.tolerance)
+        print(f"Сравнение с {args.compare} ({baseline['created_at']}):")
+        for line in lines:
+            print(line)
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
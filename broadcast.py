@@ -0,0 +1,247 @@
+"""
+Рассылка сообщений по пользователям
+
+Рассылки создаются в таблице broadcasts (из командной строки), а отправляет
+их запущенный бот через общую очередь исходящих сообщений, поэтому рассылка
+не нарушает лимиты Telegram и не мешает ответам пользователям.
+
+Использование:
+    python broadcast.py create "Текст" [--language ru] [--premium | --no-premium]
+                                       [--created-from 2024-01-01] [--created-to 2024-02-01]
+    python broadcast.py list
+    python broadcast.py cancel ID
+"""
+import argparse
+import logging
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import wait
+from datetime import datetime
+
+from telegram.error import Unauthorized
+
+from database import (
+    claim_broadcast,
+    create_broadcast,
+    finish_broadcast,
+    get_broadcast_recipients,
+    get_broadcasts,
+    heartbeat_broadcast,
+    release_broadcast,
+    save_broadcast_progress,
+    set_broadcast_status,
+)
+from outbound import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+def _is_blocked(error):
+    """
+    Ошибка означает, что пользователь заблокировал бота или удалил аккаунт
+
+    Telegram отвечает на это 403 (Unauthorized). BadRequest ("chat not found" и т.п.)
+    бывает и временным, поэтому такие получатели считаются ошибкой отправки,
+    а не отметкой blocked_at.
+    """
+    return isinstance(error, Unauthorized)
+
+
+class BroadcastRunner:
+    """
+    Отправка рассылок в фоновом потоке
+
+    Получатели читаются страницами по page_size, сообщения страницы ставятся
+    в очередь OutboundScheduler с приоритетом PRIORITY_BULK. Когда страница
+    отправлена, одной транзакцией сохраняются контрольная точка, счетчики
+    и отметки о заблокировавших бота пользователях. После падения процесса
+    рассылка продолжится со следующей страницы (сообщения последней
+    незавершенной страницы могут уйти повторно).
+
+    Рассылку отправляет только процесс, который ее взял (claimed_by): пока
+    страница отправляется, он обновляет heartbeat_at. Другой процесс
+    забирает рассылку, только если heartbeat не обновлялся дольше lease.
+    """
+
+    def __init__(self, outbound, page_size=100, lease=120):
+        """
+        Args:
+            outbound: OutboundScheduler
+            page_size: сколько получателей читать и держать в очереди за раз
+            lease: через сколько секунд без heartbeat рассылку может забрать другой процесс
+        """
+        self._outbound = outbound
+        self.page_size = page_size
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.current = None  # ID рассылки, которая отправляется сейчас
+
+    def poll(self):
+        """
+        Начать следующую рассылку, если сейчас ничего не отправляется
+
+        Returns:
+            bool: True если рассылка запущена
+        """
+        with self._lock:
+            if self._stop_event.is_set() or (self._thread is not None and self._thread.is_alive()):
+                return False
+            broadcast = claim_broadcast(self.owner, self.lease)
+            if broadcast is None:
+                return False
+            self.current = broadcast['id']
+            self._thread = threading.Thread(
+                target=self._run, args=(broadcast,), name=f"broadcast-{broadcast['id']}", daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def _run(self, broadcast):
+        broadcast_id = broadcast['id']
+        last_user_id = broadcast['last_user_id']
+        logger.info(f"Рассылка {broadcast_id}: старт после пользователя {last_user_id}")
+        try:
+            while not self._stop_event.is_set():
+                user_ids = get_broadcast_recipients(broadcast, last_user_id, self.page_size)
+                if not user_ids:
+                    if finish_broadcast(broadcast_id, self.owner):
+                        logger.info(f"Рассылка {broadcast_id} завершена")
+                    else:
+                        logger.warning(f"Рассылка {broadcast_id} не завершена: ее отправляет другой процесс "
+                                       "или она остановлена")
+                    return
+
+                sent, failed, blocked = self._send_page(broadcast, user_ids)
+                last_user_id = user_ids[-1]
+                status = save_broadcast_progress(broadcast_id, self.owner, last_user_id, sent, failed, blocked)
+                if status is None:
+                    logger.warning(f"Рассылка {broadcast_id} остановлена: ее отправляет другой процесс")
+                    return
+                if status != 'running':
+                    logger.info(f"Рассылка {broadcast_id} остановлена: статус {status}")
+                    return
+            # Процесс останавливается: рассылку сразу может забрать другой процесс
+            self._release(broadcast_id)
+        except Exception as e:
+            # Рассылка остается в статусе running и продолжится со следующей попытки
+            logger.error(f"Ошибка рассылки {broadcast_id}: {e}")
+            self._release(broadcast_id)
+        finally:
+            self.current = None
+
+    def _send_page(self, broadcast, user_ids):
+        """
+        Отправить сообщение странице получателей и дождаться результата
+
+        Returns:
+            tuple: (доставлено, ошибок, список заблокировавших бота)
+        """
+        kwargs = {}
+        if broadcast['parse_mode']:
+            kwargs['parse_mode'] = broadcast['parse_mode']
+        futures = [
+            (user_id, self._outbound.send_message(user_id, broadcast['text'], priority=PRIORITY_BULK, **kwargs))
+            for user_id in user_ids
+        ]
+
+        # Пока очередь отправляет страницу, продлеваем владение рассылкой
+        pending = {future for _, future in futures}
+        while pending:
+            _, pending = wait(pending, timeout=self.lease / 3)
+            if pending:
+                self._heartbeat(broadcast['id'])
+
+        sent = failed = 0
+        blocked = []
+        for user_id, future in futures:
+            error = future.exception()
+            if error is None:
+                sent += 1
+            elif _is_blocked(error):
+                blocked.append(user_id)
+            else:
+                failed += 1
+        return sent, failed, blocked
+
+    def _heartbeat(self, broadcast_id):
+        try:
+            if not heartbeat_broadcast(broadcast_id, self.owner):
+                logger.warning(f"Рассылку {broadcast_id} забрал другой процесс или она остановлена")
+        except Exception as e:
+            logger.warning(f"Не удалось продлить владение рассылкой {broadcast_id}: {e}")
+
+    def _release(self, broadcast_id):
+        try:
+            release_broadcast(broadcast_id, self.owner)
+        except Exception as e:
+            logger.warning(f"Не удалось отпустить рассылку {broadcast_id}: {e}")
+
+    def stop(self):
+        """Дождаться отправки текущей страницы и остановиться (рассылка продолжится при следующем запуске)"""
+        with self._lock:
+            self._stop_event.set()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Рассылки по пользователям")
+    commands = parser.add_subparsers(dest='command')
+
+    create = commands.add_parser('create', help="создать рассылку")
+    create.add_argument('text', help="текст сообщения")
+    create.add_argument('--parse-mode', choices=['HTML', 'Markdown', 'MarkdownV2'])
+    create.add_argument('--language', help="только пользователям с этим language_code")
+    premium = create.add_mutually_exclusive_group()
+    premium.add_argument('--premium', dest='is_premium', action='store_true', default=None,
+                         help="только пользователям с Telegram Premium")
+    premium.add_argument('--no-premium', dest='is_premium', action='store_false',
+                         help="только пользователям без Telegram Premium")
+    create.add_argument('--created-from', type=_parse_date, help="зарегистрированы не раньше (ГГГГ-ММ-ДД)")
+    create.add_argument('--created-to', type=_parse_date, help="зарегистрированы раньше (ГГГГ-ММ-ДД)")
+
+    commands.add_parser('list', help="последние рассылки")
+
+    cancel = commands.add_parser('cancel', help="отменить рассылку")
+    cancel.add_argument('id', type=int)
+
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    if args.command == 'create':
+        broadcast_id = create_broadcast(
+            args.text,
+            parse_mode=args.parse_mode,
+            language_code=args.language,
+            is_premium=args.is_premium,
+            created_from=args.created_from,
+            created_to=args.created_to,
+        )
+        print(f"Рассылка {broadcast_id} создана, ее отправит запущенный бот")
+    elif args.command == 'list':
+        for row in get_broadcasts():
+            print(f"{row['id']}: {row['status']}, отправлено {row['sent']}, ошибок {row['failed']}, "
+                  f"заблокировали бота {row['blocked']}, последний user ID {row['last_user_id']}")
+    elif args.command == 'cancel':
+        if set_broadcast_status(args.id, 'cancelled'):
+            print(f"Рассылка {args.id} отменена")
+        else:
+            print(f"Рассылка {args.id} не найдена или уже завершена")
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Автоматический выключатель (circuit breaker) для обращений к базе данных
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'  # Запросы идут в базу
+OPEN = 'open'  # Запросы сразу завершаются ошибкой CircuitOpen
+
+
+class CircuitOpen(Exception):
+    """База данных недоступна: запрос отклонен без попытки подключения"""
+
+
+class CircuitBreaker:
+    """
+    Выключатель, который перестает пускать запросы после серии ошибок
+
+    После failure_threshold ошибок подряд выключатель размыкается: запросы
+    сразу получают CircuitOpen, не дожидаясь таймаута подключения. Пока он
+    разомкнут, фоновый поток раз в probe_interval секунд вызывает probe();
+    первая успешная проверка замыкает выключатель.
+    """
+
+    def __init__(self, probe, failure_threshold=5, probe_interval=5.0, name='database'):
+        """
+        Args:
+            probe: функция проверки доступности (исключение - недоступно)
+            failure_threshold: сколько ошибок подряд размыкают выключатель
+            probe_interval: пауза между проверками, секунд
+            name: имя для логов
+        """
+        self._probe = probe
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._closed_event = threading.Event()
+        self._closed_event.set()
+        self._state = CLOSED
+        self._failures = 0
+        self._stopped = False
+
+        # Статистика
+        self._opened = 0
+        self._rejected = 0
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def is_closed(self):
+        return self._state == CLOSED
+
+    def check(self):
+        """
+        Проверить, можно ли выполнять запрос
+
+        Raises:
+            CircuitOpen: если выключатель разомкнут
+        """
+        if self._state == CLOSED:
+            return
+        with self._lock:
+            self._rejected += 1
+        raise CircuitOpen(f"{self.name} недоступна, запрос отклонен")
+
+    def record_success(self):
+        """Отметить успешный запрос"""
+        if self._failures:
+            with self._lock:
+                self._failures = 0
+
+    def record_failure(self, error):
+        """Отметить ошибку связи с базой; при достижении порога разомкнуть выключатель"""
+        with self._lock:
+            self._failures += 1
+            if self._state != CLOSED or self._failures < self.failure_threshold:
+                return
+            self._state = OPEN
+            self._opened += 1
+            self._closed_event.clear()
+        logger.error(f"Выключатель {self.name} разомкнут после {self.failure_threshold} ошибок подряд: {error}")
+        threading.Thread(target=self._probe_loop, name=f'{self.name}-probe', daemon=True).start()
+
+    def _probe_loop(self):
+        while True:
+            self._closed_event.wait(self.probe_interval)
+            with self._lock:
+                if self._stopped or self._state == CLOSED:
+                    return
+            try:
+                self._probe()
+            except Exception as e:
+                logger.warning(f"{self.name} все еще недоступна: {e}")
+                continue
+            with self._lock:
+                self._state = CLOSED
+                self._failures = 0
+                self._closed_event.set()
+            logger.info(f"Выключатель {self.name} замкнут: связь восстановлена")
+            return
+
+    def stop(self):
+        """Остановить фоновые проверки"""
+        with self._lock:
+            self._stopped = True
+            self._closed_event.set()
+
+    def stats(self):
+        """
+        Статистика
+
+        Returns:
+            dict: open (1 если разомкнут), consecutive_failures, opened (сколько раз
+                  размыкался), rejected (запросов отклонено)
+        """
+        with self._lock:
+            return {
+                'open': int(self._state != CLOSED),
+                'consecutive_failures': self._failures,
+                'opened': self._opened,
+                'rejected': self._rejected,
+            }
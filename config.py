@@ -16,3 +16,107 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     # Если URL не найден, также вызываем исключение
     raise ValueError("Ошибка: не найдена строка подключения (DATABASE_URL) в .env файле.")
+
+# Настройки пула соединений с базой данных
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))  # Сколько соединений держать открытыми всегда
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))  # Максимум одновременно открытых соединений
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))  # Сколько секунд ждать свободное соединение
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))  # Проверять соединение, простоявшее дольше N секунд
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))  # Таймаут установки TCP-соединения с PostgreSQL
+
+# Отложенная пакетная запись регистраций из /start (write-behind)
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+DB_WRITE_BEHIND_BATCH = int(os.getenv("DB_WRITE_BEHIND_BATCH", "500"))  # Сброс при накоплении N записей
+DB_WRITE_BEHIND_INTERVAL = float(os.getenv("DB_WRITE_BEHIND_INTERVAL", "1"))  # Или не реже чем раз в N секунд
+
+# Кэш пользователей для get_user
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))  # Максимум пользователей в кэше
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))  # Время жизни записи в секундах
+USER_CACHE_NEGATIVE_TTL = float(os.getenv("USER_CACHE_NEGATIVE_TTL", "10"))  # Сколько помнить, что пользователя нет
+
+# Пул потоков для запросов к базе данных из обработчиков
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))  # Потоков (запросы одного пользователя всегда в одном потоке)
+DB_EXECUTOR_QUEUE_SIZE = int(os.getenv("DB_EXECUTOR_QUEUE_SIZE", "1000"))  # Максимум задач в очереди одного потока
+DB_TASK_TIMEOUT = float(os.getenv("DB_TASK_TIMEOUT", "5"))  # Сколько секунд задача может ждать в очереди / обработчик ждать ответа
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "10000"))  # statement_timeout в миллисекундах (0 - без ограничения)
+
+# Режим получения обновлений: polling (getUpdates) или webhook (встроенный HTTP-сервер)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес webhook, например https://example.com/telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")  # Адрес, на котором слушает HTTP-сервер
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))  # Порт HTTP-сервера
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")  # Путь, на который Telegram шлет обновления
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))  # Максимум необработанных обновлений в памяти
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError(f"Ошибка: неизвестный режим BOT_MODE={BOT_MODE}, ожидается polling или webhook.")
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    raise ValueError("Ошибка: для BOT_MODE=webhook нужен WEBHOOK_URL в .env файле.")
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    # Без секрета любой, кто достучится до порта, может прислать поддельное обновление
+    raise ValueError("Ошибка: для BOT_MODE=webhook нужен WEBHOOK_SECRET в .env файле.")
+
+# Ограничения исходящих сообщений (лимиты Telegram)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))  # Сообщений в секунду на весь бот
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))  # Сообщений в секунду в один чат
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))  # Сколько сообщений в чат можно отправить подряд
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "8"))  # Потоков для вызовов Bot API
+
+# Хранилище состояния диалога (текущий заказ и т.п.)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "postgres").lower()  # postgres, sqlite или memory
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", "state.sqlite3")  # Файл для STATE_BACKEND=sqlite
+STATE_IDLE_TTL = float(os.getenv("STATE_IDLE_TTL", "1800"))  # Через сколько секунд неактивности выгружать пользователя из памяти
+STATE_MAX_USERS = int(os.getenv("STATE_MAX_USERS", "100000"))  # Максимум пользователей в памяти
+
+# Заказы
+ORDER_TTL = int(os.getenv("ORDER_TTL", "1800"))  # Сколько секунд счет активен
+ORDER_SWEEP_INTERVAL = float(os.getenv("ORDER_SWEEP_INTERVAL", "60"))  # Как часто проверять просроченные заказы
+ORDER_SWEEP_BATCH = int(os.getenv("ORDER_SWEEP_BATCH", "1000"))  # Сколько заказов просрочивать одним запросом
+
+# Цены
+PRICE_PER_STAR = os.getenv("PRICE_PER_STAR", "1.47")  # Цена звезды, пока тарифы не загружены из таблицы tariffs
+PRICING_RELOAD_INTERVAL = float(os.getenv("PRICING_RELOAD_INTERVAL", "30"))  # Как часто проверять изменения тарифов
+
+# Журнал звезд
+LEDGER_RECONCILE_INTERVAL = float(os.getenv("LEDGER_RECONCILE_INTERVAL", "300"))  # Как часто сверять балансы с журналом
+LEDGER_RECONCILE_LAG = float(os.getenv("LEDGER_RECONCILE_LAG", "60"))  # Не сверять записи журнала моложе этого возраста, секунд
+LEDGER_RECONCILE_REPAIR = os.getenv("LEDGER_RECONCILE_REPAIR", "false").lower() in ("1", "true", "yes")  # Исправлять балансы по журналу при расхождении
+
+# Рассылки
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "30"))  # Как часто проверять новые рассылки
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "100"))  # Сколько получателей читать и ставить в очередь за раз
+BROADCAST_LEASE = float(os.getenv("BROADCAST_LEASE", "120"))  # Через сколько секунд без heartbeat рассылку может забрать другой процесс
+
+# Метрики
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")  # Адрес HTTP-сервера метрик
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # Порт /metrics (0 - не запускать сервер)
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() in ("1", "true", "yes")  # Включить профилировщик медленных обновлений при старте
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))  # Период снятия стеков профилировщиком, секунд
+PROFILER_TOP = int(os.getenv("PROFILER_TOP", "20"))  # Сколько самых медленных обновлений хранить
+
+# Автоматический выключатель базы данных и журнал регистраций на время ее недоступности
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "5"))  # Сколько ошибок связи подряд отключают запросы к базе
+DB_BREAKER_PROBE_INTERVAL = float(os.getenv("DB_BREAKER_PROBE_INTERVAL", "5"))  # Как часто проверять, вернулась ли база
+REGISTRATION_JOURNAL_PATH = os.getenv("REGISTRATION_JOURNAL_PATH", "registrations.journal")  # Файл для регистраций без базы
+REGISTRATION_JOURNAL_FSYNC = os.getenv("REGISTRATION_JOURNAL_FSYNC", "false").lower() in ("1", "true", "yes")  # fsync после каждой записи
+JOURNAL_REPLAY_INTERVAL = float(os.getenv("JOURNAL_REPLAY_INTERVAL", "10"))  # Как часто пытаться сохранить журнал в базу
+JOURNAL_REPLAY_BATCH = int(os.getenv("JOURNAL_REPLAY_BATCH", "1000"))  # Сколько пользователей сохранять одним запросом
+
+# Процессы-обработчики
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))  # Сколько процессов обрабатывают обновления (1 - все в одном процессе)
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "10000"))  # Максимум обновлений в очереди одного процесса
+
+# Тексты и клавиатуры
+LOCALES_DIR = os.getenv("LOCALES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales"))  # Каталог с файлами текстов <язык>.json
+DEFAULT_LOCALE = os.getenv("DEFAULT_LOCALE", "ru")  # Язык для пользователей, чьего языка нет в каталоге
+
+# Логирование
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # Уровень логов
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json - одна строка JSON на запись, text - прежний текстовый формат
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # Сколько записей ждут вывода; сверх этого записи ниже ERROR отбрасываются
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))  # Доля записываемых частых событий (регистрации, обработанные обновления)
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")  # Доли для отдельных событий: update_handled=0.01,user_registered=0.1
+
+# Администраторы
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if user_id}  # Telegram ID через запятую, которым доступна /stats
+STATS_DAYS = int(os.getenv("STATS_DAYS", "7"))  # За сколько дней /stats показывает новых пользователей
@@ -0,0 +1,355 @@
+"""
+Хранение состояния диалога пользователей (вместо context.user_data)
+
+Состояние загружается из хранилища при первом обращении к пользователю,
+в хранилище пишутся только измененные ключи, а давно неактивные
+пользователи вытесняются из памяти.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from database import load_user_state, save_user_state
+
+logger = logging.getLogger(__name__)
+
+
+class UserState:
+    """
+    Состояние одного пользователя с отслеживанием измененных ключей
+
+    Ведет себя как словарь (get, [], pop, in), значения должны сериализоваться в JSON.
+    """
+
+    __slots__ = ('user_id', '_data', '_dirty', '_deleted', 'last_access')
+
+    def __init__(self, user_id, data=None):
+        self.user_id = user_id
+        self._data = data or {}
+        self._dirty = set()
+        self._deleted = set()
+        self.last_access = time.monotonic()
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._dirty.add(key)
+        self._deleted.discard(key)
+
+    def pop(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._dirty.discard(key)
+        self._deleted.add(key)
+        return self._data.pop(key)
+
+    @property
+    def is_dirty(self):
+        return bool(self._dirty or self._deleted)
+
+    def take_changes(self):
+        """
+        Забрать изменения с момента прошлого вызова
+
+        Returns:
+            tuple: (dict измененных ключей и значений, список удаленных ключей)
+        """
+        changed = {key: self._data[key] for key in self._dirty}
+        deleted = list(self._deleted)
+        self._dirty.clear()
+        self._deleted.clear()
+        return changed, deleted
+
+    def restore_changes(self, changed, deleted):
+        """Вернуть несохраненные изменения, если их не перезаписали новые"""
+        for key in changed:
+            if key not in self._deleted:
+                self._dirty.add(key)
+        for key in deleted:
+            if key not in self._dirty:
+                self._deleted.add(key)
+
+
+class MemoryStateBackend:
+    """Хранилище в памяти процесса (для тестов и бенчмарков)"""
+
+    def __init__(self):
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def load(self, user_id):
+        with self._lock:
+            return {key: json.loads(value) for key, value in self._rows.get(user_id, {}).items()}
+
+    def save(self, user_id, changed, deleted):
+        with self._lock:
+            rows = self._rows.setdefault(user_id, {})
+            for key, value in changed.items():
+                rows[key] = json.dumps(value)
+            for key in deleted:
+                rows.pop(key, None)
+            if not rows:
+                del self._rows[user_id]
+
+    def close(self):
+        pass
+
+
+class SQLiteStateBackend:
+    """Хранилище в локальном файле SQLite (для локального запуска)"""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS conversation_state (
+                    user_id INTEGER NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, key)
+                ) WITHOUT ROWID
+            """)
+
+    def load(self, user_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM conversation_state WHERE user_id = ?", (user_id,)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def save(self, user_id, changed, deleted):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("""
+                    INSERT INTO conversation_state (user_id, key, value, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id, key) DO UPDATE
+                    SET value = excluded.value, updated_at = excluded.updated_at
+                """, [(user_id, key, json.dumps(value), now) for key, value in changed.items()])
+                self._conn.executemany(
+                    "DELETE FROM conversation_state WHERE user_id = ? AND key = ?",
+                    [(user_id, key) for key in deleted],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class PostgresStateBackend:
+    """Хранилище в таблице conversation_state основной базы PostgreSQL"""
+
+    def load(self, user_id):
+        return load_user_state(user_id)
+
+    def save(self, user_id, changed, deleted):
+        save_user_state(user_id, changed, deleted)
+
+    def close(self):
+        pass
+
+
+class StateStore:
+    """
+    Кэш состояний пользователей поверх хранилища
+
+    - Состояние пользователя читается из хранилища при первом обращении.
+      Если загрузка не удалась, get() возвращает временное пустое состояние,
+      которое не кэшируется и не записывается; следующий get() повторит загрузку.
+    - flush() пишет только ключи, измененные с прошлой записи.
+    - evict_idle() выгружает из памяти пользователей, неактивных дольше
+      idle_ttl секунд; при превышении max_users вытесняются самые давние.
+
+    Если передан executor (KeyedExecutor), чтение и запись выполняются через него
+    с ключом user_id, поэтому загрузка после вытеснения не обгонит запись.
+    """
+
+    def __init__(self, backend, idle_ttl=1800.0, max_users=100000, executor=None, timeout=5.0):
+        self.backend = backend
+        self.idle_ttl = idle_ttl
+        self.max_users = max_users
+        self._executor = executor
+        self._timeout = timeout
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Статистика
+        self.loads = 0
+        self.load_failures = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def _load(self, user_id):
+        if self._executor is None:
+            return self.backend.load(user_id)
+        return self._executor.submit(user_id, self.backend.load, user_id).result(timeout=self._timeout)
+
+    def get(self, user_id):
+        """
+        Получить состояние пользователя (загружается из хранилища при первом обращении)
+
+        Returns:
+            UserState: состояние пользователя
+        """
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is not None:
+                self._states.move_to_end(user_id)
+                state.last_access = time.monotonic()
+                return state
+
+        try:
+            data = self._load(user_id)
+        except Exception as e:
+            # Без хранилища отвечаем с пустым состоянием, но не запоминаем его:
+            # иначе flush() перезаписал бы сохраненные ключи пользователя
+            logger.error("Не удалось загрузить состояние пользователя %s: %s", user_id, e,
+                         extra={'event': 'state_load_failed', 'user_id': user_id})
+            with self._lock:
+                self.load_failures += 1
+            return UserState(user_id)
+        with self._lock:
+            self.loads += 1
+            # Пока шла загрузка, состояние мог создать другой поток
+            state = self._states.get(user_id)
+            if state is None:
+                state = self._states[user_id] = UserState(user_id, data)
+            self._states.move_to_end(user_id)
+            state.last_access = time.monotonic()
+        return state
+
+    def flush(self, user_id, wait=False):
+        """
+        Записать измененные ключи пользователя в хранилище
+
+        Args:
+            user_id: Telegram user ID
+            wait: дождаться окончания записи
+        """
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is None or not state.is_dirty:
+                return
+            changed, deleted = state.take_changes()
+            self.writes += 1
+
+        if self._executor is None:
+            try:
+                self.backend.save(user_id, changed, deleted)
+            except Exception as e:
+                self._save_failed(state, changed, deleted, e)
+            return
+
+        try:
+            future = self._executor.submit(user_id, self.backend.save, user_id, changed, deleted)
+        except Exception as e:
+            self._save_failed(state, changed, deleted, e)
+            return
+        future.add_done_callback(lambda f: self._on_saved(state, changed, deleted, f))
+        if wait:
+            try:
+                future.result(timeout=self._timeout)
+            except Exception:
+                pass
+
+    def _on_saved(self, state, changed, deleted, future):
+        error = future.exception()
+        if error is not None:
+            self._save_failed(state, changed, deleted, error)
+
+    def _save_failed(self, state, changed, deleted, error):
+        with self._lock:
+            state.restore_changes(changed, deleted)
+        logger.error("Не удалось сохранить состояние пользователя %s: %s", state.user_id, error,
+                     extra={'event': 'state_save_failed', 'user_id': state.user_id})
+
+    def evict_idle(self):
+        """
+        Выгрузить из памяти неактивных пользователей
+
+        Returns:
+            int: сколько пользователей выгружено
+        """
+        deadline = time.monotonic() - self.idle_ttl
+        evicted = 0
+        with self._lock:
+            # Порядок словаря - от давно неактивных к недавним, дальше первого активного не идем
+            overflow = len(self._states) - self.max_users
+            candidates = []
+            for index, (user_id, state) in enumerate(self._states.items()):
+                if state.last_access >= deadline and index >= overflow:
+                    break
+                candidates.append(user_id)
+        for user_id in candidates:
+            self.flush(user_id, wait=True)
+            with self._lock:
+                state = self._states.get(user_id)
+                if state is not None and not state.is_dirty and (
+                        state.last_access < deadline or len(self._states) > self.max_users):
+                    del self._states[user_id]
+                    evicted += 1
+        with self._lock:
+            self.evictions += evicted
+        return evicted
+
+    def close(self):
+        """Записать все изменения и закрыть хранилище"""
+        with self._lock:
+            user_ids = [user_id for user_id, state in self._states.items() if state.is_dirty]
+        for user_id in user_ids:
+            self.flush(user_id, wait=True)
+        self.backend.close()
+
+    def stats(self):
+        """
+        Статистика
+
+        Returns:
+            dict: users (в памяти), loads, load_failures, writes, evictions
+        """
+        with self._lock:
+            return {
+                'users': len(self._states),
+                'loads': self.loads,
+                'load_failures': self.load_failures,
+                'writes': self.writes,
+                'evictions': self.evictions,
+            }
+
+
+def create_backend(name, sqlite_path='state.sqlite3'):
+    """
+    Создать хранилище по имени из настроек
+
+    Args:
+        name: postgres, sqlite или memory
+        sqlite_path: путь к файлу для sqlite
+    """
+    if name == 'postgres':
+        return PostgresStateBackend()
+    if name == 'sqlite':
+        return SQLiteStateBackend(sqlite_path)
+    if name == 'memory':
+        return MemoryStateBackend()
+    raise ValueError(f"Неизвестное хранилище состояния: {name}")
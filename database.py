@@ -1,10 +1,33 @@
 """
 Модуль для работы с базой данных
 """
+import csv
 import logging
+import sys
+import threading
+from contextlib import contextmanager
+
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from config import DATABASE_URL
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from config import (
+    DATABASE_URL,
+    DB_POOL_MIN,
+    DB_POOL_MAX,
+    DB_POOL_TIMEOUT,
+    DB_POOL_HEALTHCHECK_IDLE,
+    DB_CONNECT_TIMEOUT,
+    DB_STATEMENT_TIMEOUT,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    USER_CACHE_NEGATIVE_TTL,
+    DB_BREAKER_THRESHOLD,
+    DB_BREAKER_PROBE_INTERVAL,
+)
+from db_pool import ConnectionPool, PooledConnection, PoolTimeout
+from circuit_breaker import CircuitBreaker
+from metrics import REGISTRY
+from user_cache import TTLCache, MISSING
 from urllib.parse import urlparse, uses_netloc
 
 logger = logging.getLogger(__name__)
@@ -16,172 +39,530 @@ if 'postgresql' not in uses_netloc:
     uses_netloc.append('postgresql')
 
 
+def _parse_database_url(url):
+    """Разобрать DATABASE_URL в параметры psycopg2.connect"""
+    parsed = urlparse(url)
+
+    # Получаем имя базы данных (убираем первый слэш)
+    database = parsed.path[1:] if parsed.path and parsed.path.startswith('/') else parsed.path
+
+    connect_kwargs = {
+        'host': parsed.hostname,
+        'port': parsed.port or 5432,
+        'user': parsed.username,
+        'password': parsed.password,
+        'database': database or 'postgres',
+        'connect_timeout': DB_CONNECT_TIMEOUT,
+    }
+    if DB_STATEMENT_TIMEOUT > 0:
+        # Зависший запрос не должен навсегда занимать поток и соединение
+        connect_kwargs['options'] = f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+    return connect_kwargs
+
+
+# DATABASE_URL разбираем один раз при импорте модуля
+CONNECT_KWARGS = _parse_database_url(DATABASE_URL)
+
+# Подготовленные запросы для горячих путей: имя -> (типы параметров, текст запроса)
+PREPARED_STATEMENTS = {
+    'get_user_by_id': ('bigint', "SELECT * FROM users WHERE id = $1"),
+    'load_user_state': ('bigint', "SELECT key, value FROM conversation_state WHERE user_id = $1"),
+    'get_active_order': (
+        'bigint',
+        """
+        SELECT id, user_id, status, amount, cost, is_gift, created_at, expires_at
+        FROM orders
+        WHERE user_id = $1 AND status = 'pending' AND expires_at > CURRENT_TIMESTAMP
+        """,
+    ),
+    'upsert_user': (
+        'bigint, varchar, varchar, varchar, varchar, boolean',
+        """
+        INSERT INTO users (id, username, first_name, last_name, language_code, is_premium)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (id) DO UPDATE
+        SET username = EXCLUDED.username,
+            first_name = EXCLUDED.first_name,
+            last_name = EXCLUDED.last_name,
+            language_code = EXCLUDED.language_code,
+            is_premium = EXCLUDED.is_premium,
+            blocked_at = NULL,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE (users.username, users.first_name, users.last_name,
+               users.language_code, users.is_premium)
+              IS DISTINCT FROM
+              (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name,
+               EXCLUDED.language_code, EXCLUDED.is_premium)
+           OR users.blocked_at IS NOT NULL
+        RETURNING (xmax = 0) AS inserted
+        """,
+    ),
+}
+
+
+
+def _query_label(query):
+    """
+    Метка запроса для метрик: имя подготовленного запроса для EXECUTE,
+    иначе имя функции этого модуля, которая выполняет запрос
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    words = str(query).lstrip().split(None, 2)
+    if words and words[0].upper() == 'EXECUTE' and len(words) > 1:
+        return words[1].split('(')[0]
+    if words and words[0].upper() == 'PREPARE':
+        return 'prepare'
+    # Пропускаем кадры psycopg2 (например, execute_values)
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_globals.get('__name__', '').startswith('psycopg2'):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else 'unknown'
+
+
+class _TimedCursorMixin:
+    """Время каждого запроса в db_query_duration_seconds{query=...}, ошибки в db_query_errors_total"""
+
+    def execute(self, query, vars=None):
+        with REGISTRY.timer('db_query_duration_seconds', 'db_query_errors_total', query=_query_label(query)):
+            return super().execute(query, vars)
+
+
+_timed_cursor_classes = {}
+
+
+def _timed_cursor_class(base):
+    """Подкласс курсора base с замером времени запросов (создается один раз на класс)"""
+    cls = _timed_cursor_classes.get(base)
+    if cls is None:
+        cls = _timed_cursor_classes[base] = type(f'Timed{base.__name__}', (_TimedCursorMixin, base), {})
+    return cls
+
+
+class InstrumentedConnection(PooledConnection):
+    """Соединение пула, курсоры которого измеряют время запросов"""
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _timed_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _probe_database():
+    """Проверка связи с базой для выключателя: отдельное соединение в обход пула"""
+    conn = psycopg2.connect(**CONNECT_KWARGS)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+    finally:
+        conn.close()
+
+
+# SQLSTATE, означающие потерю связи: класс 08 (connection exception) и остановка сервера
+_CONNECTION_SQLSTATES = ('08', '57P01', '57P02', '57P03')
+
+
+def is_connection_error(error, conn=None):
+    """
+    Ошибка связи с базой, которую считает выключатель
+
+    statement_timeout (QueryCanceledError), взаимоблокировки, ошибки сериализации
+    и DiskFull - тоже OperationalError, но это ошибки запроса: соединение
+    исправно, и выключатель их не считает.
+
+    Args:
+        error: исключение
+        conn: соединение, на котором оно возникло (если есть)
+
+    Returns:
+        bool: True, если потеряна связь с базой
+    """
+    if isinstance(error, (psycopg2.InterfaceError, PoolTimeout)):
+        return True
+    if conn is not None and conn.closed:
+        return True
+    if isinstance(error, psycopg2.OperationalError):
+        # Без SQLSTATE - ошибка libpq: не удалось подключиться или связь оборвалась
+        return error.pgcode is None or error.pgcode.startswith(_CONNECTION_SQLSTATES)
+    return False
+
+# После серии ошибок связи запросы сразу получают CircuitOpen вместо ожидания таймаута
+_breaker = CircuitBreaker(
+    _probe_database,
+    failure_threshold=DB_BREAKER_THRESHOLD,
+    probe_interval=DB_BREAKER_PROBE_INTERVAL,
+    name='database',
+)
+
+# Кэш строк users по Telegram user ID для get_user
+_user_cache = TTLCache(
+    maxsize=USER_CACHE_SIZE,
+    ttl=USER_CACHE_TTL,
+    negative_ttl=USER_CACHE_NEGATIVE_TTL,
+)
+
+# Счетчики записей профиля: пропущенные (данные не изменились), обновленные, новые
+_write_stats = {'skipped': 0, 'applied': 0, 'inserted': 0}
+_write_stats_lock = threading.Lock()
+
+
+def get_pool():
+    """Получить пул соединений (создается при первом обращении)"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(
+                    CONNECT_KWARGS,
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    healthcheck_idle=DB_POOL_HEALTHCHECK_IDLE,
+                    connection_factory=InstrumentedConnection,
+                )
+                try:
+                    pool.fill()
+                except Exception as e:
+                    # Недостающие соединения откроются при первом запросе
+                    logger.warning(f"Не удалось заранее открыть соединения с базой данных: {e}")
+                _pool = pool
+    return _pool
+
+
+def close_pool():
+    """Закрыть пул соединений (при остановке бота)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def pool_stats():
+    """
+    Статистика пула соединений
+
+    Returns:
+        dict: занятые и свободные соединения, время ожидания, таймауты, переподключения
+    """
+    return get_pool().stats()
+
+
+def db_available():
+    """Доступна ли база данных (выключатель замкнут)"""
+    return _breaker.is_closed
+
+
+def breaker_stats():
+    """
+    Статистика выключателя базы данных
+
+    Returns:
+        dict: open, consecutive_failures, opened, rejected
+    """
+    return _breaker.stats()
+
+
+def invalidate_user(user_id):
+    """
+    Сбросить пользователя из кэша get_user
+
+    Вызывается после любой записи в строку users (профиль, баланс).
+    """
+    _user_cache.invalidate(user_id)
+
+
+def user_cache_stats():
+    """
+    Статистика кэша пользователей
+
+    Returns:
+        dict: размер, попадания, промахи, вытеснения, инвалидации
+    """
+    return _user_cache.stats()
+
+
+def profile_write_stats():
+    """
+    Статистика записей профиля пользователей
+
+    Returns:
+        dict: skipped - данные не изменились и запись не выполнялась,
+              applied - профиль обновлен, inserted - добавлен новый пользователь
+    """
+    with _write_stats_lock:
+        return dict(_write_stats)
+
+
+def _count_writes(skipped=0, applied=0, inserted=0):
+    with _write_stats_lock:
+        _write_stats['skipped'] += skipped
+        _write_stats['applied'] += applied
+        _write_stats['inserted'] += inserted
+
+
+def _reset_connection(conn, deallocate=True):
+    """
+    Откатить транзакцию после ошибки и сбросить подготовленные запросы
+
+    Args:
+        conn: соединение из пула
+        deallocate: сбросить и подготовленные запросы (после ошибки базы данных)
+    """
+    conn.rollback()
+    if deallocate and conn.prepared:
+        # После ошибки не знаем, какие PREPARE успели выполниться - начинаем с чистого листа
+        with conn.cursor() as cursor:
+            cursor.execute("DEALLOCATE ALL")
+        conn.commit()
+        conn.prepared.clear()
+
+
+@contextmanager
 def get_connection():
-    """Получить соединение с базой данных"""
+    """
+    Получить соединение с базой данных из пула
+
+    Соединение возвращается в пул при выходе из блока with.
+    При ошибке транзакция откатывается; соединения с оборванной связью закрываются.
+    Пока выключатель разомкнут, сразу выбрасывается CircuitOpen.
+    Выключатель считает только ошибки связи (is_connection_error).
+    """
+    _breaker.check()
+    pool = get_pool()
     try:
-        # Парсим DATABASE_URL
-        parsed = urlparse(DATABASE_URL)
-        
-        # Получаем имя базы данных (убираем первый слэш)
-        database = parsed.path[1:] if parsed.path and parsed.path.startswith('/') else parsed.path
-        
-        # Создаем соединение
-        conn = psycopg2.connect(
-            host=parsed.hostname,
-            port=parsed.port or 5432,
-            user=parsed.username,
-            password=parsed.password,
-            database=database or 'postgres',
-        )
-        return conn
+        conn = pool.getconn()
     except Exception as e:
+        if is_connection_error(e):
+            _breaker.record_failure(e)
         logger.error(f"Ошибка при подключении к базе данных: {e}")
         raise
 
-
-def init_db():
-    """Инициализация базы данных - создание таблиц"""
-    conn = None
+    discard = False
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        # Создаем таблицу и все необходимые объекты напрямую
-        # Это более надежно, чем выполнение SQL файла
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id BIGINT PRIMARY KEY,
-                username VARCHAR(255),
-                first_name VARCHAR(255) NOT NULL,
-                last_name VARCHAR(255),
-                language_code VARCHAR(10),
-                is_premium BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                stars_balance INTEGER DEFAULT 0,
-                total_spent INTEGER DEFAULT 0
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_users_username 
-            ON users(username) WHERE username IS NOT NULL
-        """)
-        
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_users_created_at 
-            ON users(created_at)
-        """)
-        
-        cursor.execute("""
-            CREATE OR REPLACE FUNCTION update_updated_at_column()
-            RETURNS TRIGGER AS $$
-            BEGIN
-                NEW.updated_at = CURRENT_TIMESTAMP;
-                RETURN NEW;
-            END;
-            $$ language 'plpgsql'
-        """)
-        
-        cursor.execute("""
-            DROP TRIGGER IF EXISTS update_users_updated_at ON users
-        """)
-        
-        cursor.execute("""
-            CREATE TRIGGER update_users_updated_at 
-            BEFORE UPDATE ON users
-            FOR EACH ROW EXECUTE FUNCTION update_updated_at_column()
-        """)
-        
-        conn.commit()
-        logger.info("Таблицы базы данных созданы/проверены")
-        
+        yield conn
     except Exception as e:
-        if conn:
-            conn.rollback()
-        error_msg = str(e)
-        # Игнорируем ошибки о существующих объектах
-        if 'already exists' not in error_msg.lower():
-            logger.error(f"Ошибка при инициализации базы данных: {e}")
+        if is_connection_error(e, conn):
+            discard = True
+            _breaker.record_failure(e)
             raise
-        else:
-            logger.info("Таблицы базы данных уже существуют")
+        # Ошибка запроса: соединение исправно, откатываем транзакцию и возвращаем его в пул.
+        # Ошибка в коде (не в базе) подготовленные запросы не затрагивает
+        try:
+            _reset_connection(conn, deallocate=isinstance(e, psycopg2.Error))
+        except psycopg2.Error:
+            discard = True
+        raise
+    else:
+        _breaker.record_success()
     finally:
-        if conn:
-            conn.close()
+        pool.putconn(conn, discard=discard)
+
+
+def execute_prepared(cursor, name, params=()):
+    """
+    Выполнить подготовленный запрос из PREPARED_STATEMENTS
+
+    PREPARE выполняется один раз на соединение, дальше используется только EXECUTE.
+
+    Args:
+        cursor: курсор соединения из пула
+        name: имя запроса в PREPARED_STATEMENTS
+        params: параметры запроса
+    """
+    conn = cursor.connection
+    if name not in conn.prepared:
+        types, query = PREPARED_STATEMENTS[name]
+        cursor.execute(f"PREPARE {name} ({types}) AS {query}")
+        conn.prepared.add(name)
+    if params:
+        placeholders = ', '.join(['%s'] * len(params))
+        cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
+
+
+def user_row(user):
+    """
+    Преобразовать пользователя Telegram в кортеж значений для таблицы users
+
+    Args:
+        user: объект User из telegram
+
+    Returns:
+        tuple: (id, username, first_name, last_name, language_code, is_premium)
+    """
+    return (
+        user.id,
+        user.username,
+        user.first_name,
+        user.last_name,
+        user.language_code,
+        bool(getattr(user, 'is_premium', False)),
+    )
 
 
 def add_user(user):
     """
     Добавить нового пользователя или обновить существующего
+
+    Выполняется одним запросом INSERT ... ON CONFLICT, поэтому одновременные
+    /start от одного пользователя не приводят к ошибке дубликата ключа.
+    Строка обновляется только при реальном изменении профиля или если
+    пользователь отмечен заблокировавшим бота (blocked_at); иначе запрос
+    ничего не пишет. Отметку blocked_at могла поставить рассылка в другом
+    процессе, поэтому запрос выполняется при каждом /start, без кэша в памяти.
     
     Args:
         user: объект User из telegram
         
     Returns:
-        bool: True если пользователь был добавлен, False если обновлен
+        bool: True если пользователь был добавлен, False если уже существовал
     """
-    conn = None
+    row = user_row(user)
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        # Проверяем, существует ли пользователь
-        cursor.execute("SELECT id FROM users WHERE id = %s", (user.id,))
-        exists = cursor.fetchone()
-        
-        if exists:
-            # Обновляем данные пользователя
-            cursor.execute("""
-                UPDATE users 
-                SET username = %s,
-                    first_name = %s,
-                    last_name = %s,
-                    language_code = %s,
-                    is_premium = %s,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            """, (
-                user.username,
-                user.first_name,
-                user.last_name,
-                user.language_code,
-                getattr(user, 'is_premium', False),
-                user.id
-            ))
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            # xmax = 0 только у только что вставленной строки;
+            # если данные не изменились, UPDATE не выполняется и строки нет
+            execute_prepared(cursor, 'upsert_user', row)
+            result = cursor.fetchone()
             conn.commit()
-            logger.info(f"Пользователь {user.id} обновлен в базе данных")
+
+        if result is None:
+            _count_writes(skipped=1)
             return False
+
+        invalidate_user(user.id)
+        if result[0]:
+            _count_writes(inserted=1)
+            logger.info("Новый пользователь %s добавлен в базу данных", user.id,
+                        extra={'event': 'user_inserted', 'user_id': user.id})
         else:
-            # Добавляем нового пользователя
-            cursor.execute("""
+            _count_writes(applied=1)
+            logger.info("Пользователь %s обновлен в базе данных", user.id,
+                        extra={'event': 'user_updated', 'user_id': user.id})
+        return result[0]
+
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении/обновлении пользователя: {e}")
+        raise
+
+
+def add_users_bulk(rows):
+    """
+    Добавить или обновить пачку пользователей одним запросом
+
+    Строки пользователей, чей профиль не изменился и кто не отмечен
+    в blocked_at, не перезаписываются.
+
+    Args:
+        rows: список кортежей из user_row(); для каждого id берется последний кортеж
+
+    Returns:
+        int: количество новых пользователей
+    """
+    # В одном INSERT ... ON CONFLICT строка не может обновляться дважды
+    unique_rows = list({row[0]: row for row in rows}.values())
+    if not unique_rows:
+        return 0
+
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            written = execute_values(cursor, """
                 INSERT INTO users (id, username, first_name, last_name, language_code, is_premium)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (
-                user.id,
-                user.username,
-                user.first_name,
-                user.last_name,
-                user.language_code,
-                getattr(user, 'is_premium', False)
-            ))
+                VALUES %s
+                ON CONFLICT (id) DO UPDATE
+                SET username = EXCLUDED.username,
+                    first_name = EXCLUDED.first_name,
+                    last_name = EXCLUDED.last_name,
+                    language_code = EXCLUDED.language_code,
+                    is_premium = EXCLUDED.is_premium,
+                    blocked_at = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE (users.username, users.first_name, users.last_name,
+                       users.language_code, users.is_premium)
+                      IS DISTINCT FROM
+                      (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name,
+                       EXCLUDED.language_code, EXCLUDED.is_premium)
+                   OR users.blocked_at IS NOT NULL
+                RETURNING id, (xmax = 0)
+            """, unique_rows, page_size=len(unique_rows), fetch=True)
             conn.commit()
-            logger.info(f"Новый пользователь {user.id} добавлен в базу данных")
-            return True
-            
+
+        for user_id, _ in written:
+            invalidate_user(user_id)
+
+        new_users = sum(1 for _, is_new in written if is_new)
+        skipped = len(unique_rows) - len(written)
+        _count_writes(skipped=skipped, applied=len(written) - new_users, inserted=new_users)
+        logger.info("Сохранено пользователей: %s, из них новых: %s, без изменений: %s",
+                    len(written), new_users, skipped, extra={'event': 'users_saved'})
+        return new_users
+
     except Exception as e:
-        if conn:
-            conn.rollback()
-        logger.error(f"Ошибка при добавлении/обновлении пользователя: {e}")
+        logger.error(f"Ошибка при пакетном сохранении пользователей: {e}")
         raise
-    finally:
-        if conn:
-            conn.close()
+
+
+def replay_users(entries):
+    """
+    Сохранить регистрации из журнала, не затирая более новые данные
+
+    Строка обновляется, только если в базе она изменена раньше, чем
+    регистрация попала в журнал: после восстановления связи /start мог
+    успеть записать более свежий профиль.
+
+    Args:
+        entries: список (кортеж из user_row(), время записи в журнал datetime)
+
+    Returns:
+        int: количество новых пользователей
+    """
+    if not entries:
+        return 0
+    values = [row + (observed_at, observed_at) for row, observed_at in entries]
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        written = execute_values(cursor, """
+            INSERT INTO users AS u (id, username, first_name, last_name, language_code, is_premium,
+                                    created_at, updated_at)
+            VALUES %s
+            ON CONFLICT (id) DO UPDATE
+            SET username = EXCLUDED.username,
+                first_name = EXCLUDED.first_name,
+                last_name = EXCLUDED.last_name,
+                language_code = EXCLUDED.language_code,
+                is_premium = EXCLUDED.is_premium,
+                blocked_at = NULL
+            WHERE u.updated_at < EXCLUDED.updated_at
+              AND ((u.username, u.first_name, u.last_name, u.language_code, u.is_premium)
+                   IS DISTINCT FROM
+                   (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name,
+                    EXCLUDED.language_code, EXCLUDED.is_premium)
+                   OR u.blocked_at IS NOT NULL)
+            RETURNING id, (xmax = 0)
+        """, values, page_size=len(values), fetch=True)
+        conn.commit()
+
+    for user_id, _ in written:
+        invalidate_user(user_id)
+    new_users = sum(1 for _, is_new in written if is_new)
+    logger.info("Из журнала сохранено пользователей: %s, из них новых: %s, без изменений или устарели: %s",
+                len(written), new_users, len(values) - len(written))
+    return new_users
 
 
 def get_user(user_id):
     """
     Получить информацию о пользователе по ID
+
+    Сначала смотрит в кэш; отсутствие пользователя тоже кэшируется (на меньший срок).
     
     Args:
         user_id: Telegram user ID
@@ -189,21 +570,858 @@ def get_user(user_id):
     Returns:
         dict: информация о пользователе или None
     """
-    conn = None
-    try:
-        conn = get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-        user = cursor.fetchone()
-        
-        if user:
-            return dict(user)
+    cached = _user_cache.get(user_id)
+    if cached is MISSING:
         return None
-        
+    if cached is not None:
+        return dict(cached)
+
+    generation = _user_cache.generation()
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+            execute_prepared(cursor, 'get_user_by_id', (user_id,))
+            user = cursor.fetchone()
+
     except Exception as e:
         logger.error(f"Ошибка при получении пользователя: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
+
+    if user:
+        user = dict(user)
+        _user_cache.set(user_id, user, generation)
+        return dict(user)
+    _user_cache.set(user_id, MISSING, generation)
+    return None
+
+
+def get_user_stats(days=7):
+    """
+    Статистика пользователей из счетчиков user_stats и user_stats_daily
+
+    Счетчики ведут триггеры на users, поэтому время запроса не зависит
+    от числа пользователей. Каждый ключ разбит на несколько строк
+    (shard), они суммируются здесь.
+
+    Args:
+        days: за сколько последних дней (включая сегодня) вернуть новых пользователей
+
+    Returns:
+        dict: total, premium, languages (список (код языка, число) по убыванию),
+              daily (список (дата, новых пользователей) от новых к старым)
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT language_code, is_premium, SUM(users)
+            FROM user_stats
+            GROUP BY 1, 2
+            HAVING SUM(users) > 0
+        """)
+        groups = cursor.fetchall()
+        cursor.execute("""
+            SELECT day.day::date, COALESCE(SUM(d.new_users), 0)
+            FROM generate_series(CURRENT_DATE - %s + 1, CURRENT_DATE, INTERVAL '1 day') AS day(day)
+            LEFT JOIN user_stats_daily d ON d.day = day.day::date
+            GROUP BY 1
+            ORDER BY 1 DESC
+        """, (days,))
+        daily = cursor.fetchall()
+
+    languages = {}
+    premium = 0
+    for language_code, is_premium, users in groups:
+        languages[language_code] = languages.get(language_code, 0) + users
+        if is_premium:
+            premium += users
+    return {
+        'total': sum(languages.values()),
+        'premium': premium,
+        'languages': sorted(languages.items(), key=lambda item: (-item[1], item[0])),
+        'daily': daily,
+    }
+
+
+def load_user_state(user_id):
+    """
+    Загрузить состояние диалога пользователя
+
+    Args:
+        user_id: Telegram user ID
+
+    Returns:
+        dict: ключи и значения состояния
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        execute_prepared(cursor, 'load_user_state', (user_id,))
+        rows = cursor.fetchall()
+        conn.commit()
+    return dict(rows)
+
+
+def save_user_state(user_id, changed, deleted):
+    """
+    Записать измененные ключи состояния диалога пользователя
+
+    Args:
+        user_id: Telegram user ID
+        changed: dict измененных ключей и их новых значений
+        deleted: список удаленных ключей
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        if changed:
+            execute_values(cursor, """
+                INSERT INTO conversation_state (user_id, key, value)
+                VALUES %s
+                ON CONFLICT (user_id, key) DO UPDATE
+                SET value = EXCLUDED.value,
+                    updated_at = CURRENT_TIMESTAMP
+            """, [(user_id, key, Json(value)) for key, value in changed.items()])
+        if deleted:
+            cursor.execute(
+                "DELETE FROM conversation_state WHERE user_id = %s AND key = ANY(%s)",
+                (user_id, list(deleted)),
+            )
+        conn.commit()
+
+
+def create_order(user_id, amount, cost, is_gift, ttl_seconds):
+    """
+    Создать заказ; предыдущий активный заказ пользователя отменяется
+
+    Args:
+        user_id: Telegram user ID
+        amount: количество звезд
+        cost: стоимость в рублях
+        is_gift: звезды в подарок
+        ttl_seconds: сколько секунд счет активен
+
+    Returns:
+        dict: id, created_at, expires_at нового заказа
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        # Оба запроса уходят одним обращением к базе
+        cursor.execute("""
+            UPDATE orders SET status = 'cancelled'
+            WHERE user_id = %(user_id)s AND status = 'pending';
+
+            INSERT INTO orders (user_id, amount, cost, is_gift, expires_at)
+            VALUES (%(user_id)s, %(amount)s, %(cost)s, %(is_gift)s,
+                    CURRENT_TIMESTAMP + make_interval(secs => %(ttl)s))
+            RETURNING id, created_at, expires_at
+        """, {'user_id': user_id, 'amount': amount, 'cost': cost, 'is_gift': is_gift, 'ttl': ttl_seconds})
+        order = dict(cursor.fetchone())
+        conn.commit()
+    logger.info("Заказ %s создан: пользователь %s, %s звезд", order['id'], user_id, amount,
+                extra={'event': 'order_created', 'user_id': user_id})
+    return order
+
+
+def get_active_order(user_id):
+    """
+    Получить активный (неоплаченный и непросроченный) заказ пользователя
+
+    Args:
+        user_id: Telegram user ID
+
+    Returns:
+        dict: заказ или None
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        execute_prepared(cursor, 'get_active_order', (user_id,))
+        order = cursor.fetchone()
+        conn.commit()
+    return dict(order) if order else None
+
+
+def get_user_orders(user_id, limit=10):
+    """
+    История заказов пользователя, новые первыми
+
+    Args:
+        user_id: Telegram user ID
+        limit: сколько заказов вернуть
+
+    Returns:
+        list: заказы (dict)
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("""
+            SELECT id, status, amount, cost, is_gift, created_at, expires_at
+            FROM orders
+            WHERE user_id = %s
+            ORDER BY created_at DESC
+            LIMIT %s
+        """, (user_id, limit))
+        orders = [dict(order) for order in cursor.fetchall()]
+        conn.commit()
+    return orders
+
+
+def expire_orders(batch_size=1000):
+    """
+    Перевести просроченные заказы в статус expired пачками
+
+    Каждая пачка - один UPDATE в отдельной транзакции; строки, заблокированные
+    другими транзакциями, пропускаются до следующего запуска.
+
+    Args:
+        batch_size: сколько заказов обновлять за один запрос
+
+    Returns:
+        int: сколько заказов просрочено
+    """
+    expired = 0
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        while True:
+            cursor.execute("""
+                WITH batch AS (
+                    SELECT id FROM orders
+                    WHERE status = 'pending' AND expires_at <= CURRENT_TIMESTAMP
+                    ORDER BY expires_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE orders SET status = 'expired'
+                FROM batch
+                WHERE orders.id = batch.id
+            """, (batch_size,))
+            count = cursor.rowcount
+            conn.commit()
+            expired += count
+            if count < batch_size:
+                break
+    if expired:
+        logger.info("Просрочено заказов: %s", expired, extra={'event': 'orders_expired'})
+    return expired
+
+
+def tariffs_version():
+    """
+    Отпечаток таблицы тарифов: меняется при любом добавлении, изменении или удалении
+
+    Returns:
+        tuple: (количество тарифов, время последнего изменения)
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*), MAX(updated_at) FROM tariffs")
+        version = tuple(cursor.fetchone())
+        conn.commit()
+    return version
+
+
+def load_tariffs():
+    """
+    Загрузить тарифы, действующие сейчас
+
+    Returns:
+        dict: tariffs - список dict (min_amount, max_amount, price_per_star, priority),
+              version - отпечаток таблицы (см. tariffs_version),
+              next_change_in - через сколько секунд начнется или закончится
+              какая-нибудь акция (None, если таких нет)
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        # Сначала отпечаток, потом тарифы: если таблицу изменят между запросами,
+        # отпечаток окажется старым и тарифы просто перезагрузятся еще раз
+        cursor.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM tariffs) AS count,
+                (SELECT MAX(updated_at) FROM tariffs) AS updated_at,
+                (SELECT EXTRACT(EPOCH FROM MIN(boundary) - CURRENT_TIMESTAMP)
+                 FROM (
+                     SELECT valid_from AS boundary FROM tariffs
+                     WHERE is_active AND valid_from > CURRENT_TIMESTAMP
+                     UNION ALL
+                     SELECT valid_until FROM tariffs
+                     WHERE is_active AND valid_until > CURRENT_TIMESTAMP
+                 ) boundaries) AS next_change_in
+        """)
+        meta = cursor.fetchone()
+
+        cursor.execute("""
+            SELECT min_amount, max_amount, price_per_star, priority
+            FROM tariffs
+            WHERE is_active
+              AND (valid_from IS NULL OR valid_from <= CURRENT_TIMESTAMP)
+              AND (valid_until IS NULL OR valid_until > CURRENT_TIMESTAMP)
+        """)
+        tariffs = [dict(tariff) for tariff in cursor.fetchall()]
+        conn.commit()
+
+    next_change_in = meta['next_change_in']
+    return {
+        'tariffs': tariffs,
+        'version': (meta['count'], meta['updated_at']),
+        'next_change_in': float(next_change_in) if next_change_in is not None else None,
+    }
+
+
+def post_ledger_entry(user_id, stars_delta, idempotency_key, reason, spent_delta=0, order_id=None):
+    """
+    Записать операцию в журнал звезд и изменить баланс пользователя
+
+    Запись в журнал и изменение stars_balance/total_spent выполняются одним
+    запросом в одной транзакции, без чтения баланса в коде (нет потерянных
+    обновлений при параллельных операциях). Повтор с тем же idempotency_key
+    ничего не меняет.
+
+    Args:
+        user_id: Telegram user ID
+        stars_delta: изменение баланса звезд
+        idempotency_key: уникальный ключ операции, например 'order:42:credit'
+        reason: причина (purchase, gift, refund, adjustment)
+        spent_delta: изменение суммы потраченного
+        order_id: связанный заказ
+
+    Returns:
+        dict: новые stars_balance и total_spent или None, если операция уже была применена
+
+    Raises:
+        LookupError: если пользователя нет в базе
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("""
+            WITH entry AS (
+                INSERT INTO stars_ledger (user_id, idempotency_key, stars_delta, spent_delta, reason, order_id)
+                VALUES (%(user_id)s, %(key)s, %(stars_delta)s, %(spent_delta)s, %(reason)s, %(order_id)s)
+                ON CONFLICT (idempotency_key) DO NOTHING
+                RETURNING user_id, stars_delta, spent_delta
+            ), updated AS (
+                UPDATE users
+                SET stars_balance = stars_balance + entry.stars_delta,
+                    total_spent = total_spent + entry.spent_delta
+                FROM entry
+                WHERE users.id = entry.user_id
+                RETURNING users.stars_balance, users.total_spent
+            )
+            SELECT (SELECT COUNT(*) FROM entry) AS inserted, updated.stars_balance, updated.total_spent
+            FROM (SELECT 1) AS one
+            LEFT JOIN updated ON TRUE
+        """, {
+            'user_id': user_id,
+            'key': idempotency_key,
+            'stars_delta': stars_delta,
+            'spent_delta': spent_delta,
+            'reason': reason,
+            'order_id': order_id,
+        })
+        result = cursor.fetchone()
+        if not result['inserted']:
+            conn.commit()
+            logger.info("Операция %s уже применена", idempotency_key, extra={'event': 'stars_duplicate'})
+            return None
+        if result['stars_balance'] is None:
+            conn.rollback()
+        else:
+            conn.commit()
+
+    # Исключение выбрасываем после возврата соединения в пул: транзакция уже откатена
+    if result['stars_balance'] is None:
+        raise LookupError(f"Пользователь {user_id} не найден")
+    invalidate_user(user_id)
+    return {'stars_balance': result['stars_balance'], 'total_spent': result['total_spent']}
+
+
+def reconcile_ledger(lag_seconds=60, repair=False):
+    """
+    Свернуть новые записи журнала звезд и сверить их с балансами в users
+
+    Свертка инкрементальная: обрабатываются только записи после водяного знака
+    и старше lag_seconds (чтобы не пропустить записи из еще не завершенных
+    транзакций с меньшим id). Проверяются только затронутые пользователи.
+
+    Args:
+        lag_seconds: не сворачивать записи моложе этого возраста
+        repair: исправить stars_balance/total_spent по журналу при расхождении
+
+    Returns:
+        list: расхождения - dict (user_id, stars_balance, expected_stars_balance,
+              total_spent, expected_total_spent)
+    """
+    with get_connection() as conn:
+        # Снимок на всю сверку, чтобы параллельные операции не давали ложных расхождений
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute("SELECT last_ledger_id FROM stars_ledger_watermark WHERE id = 1 FOR UPDATE")
+        since = cursor.fetchone()['last_ledger_id']
+        cursor.execute("""
+            SELECT COALESCE(MAX(id), %(since)s) AS upto
+            FROM stars_ledger
+            WHERE id > %(since)s
+              AND created_at < CURRENT_TIMESTAMP - make_interval(secs => %(lag)s)
+        """, {'since': since, 'lag': lag_seconds})
+        upto = cursor.fetchone()['upto']
+        if upto == since:
+            conn.commit()
+            return []
+
+        cursor.execute("""
+            INSERT INTO stars_ledger_rollup (user_id, stars_balance, total_spent)
+            SELECT user_id, SUM(stars_delta), SUM(spent_delta)
+            FROM stars_ledger
+            WHERE id > %(since)s AND id <= %(upto)s
+            GROUP BY user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET stars_balance = stars_ledger_rollup.stars_balance + EXCLUDED.stars_balance,
+                total_spent = stars_ledger_rollup.total_spent + EXCLUDED.total_spent,
+                updated_at = CURRENT_TIMESTAMP
+            RETURNING user_id
+        """, {'since': since, 'upto': upto})
+        touched = [row['user_id'] for row in cursor.fetchall()]
+        cursor.execute(
+            "UPDATE stars_ledger_watermark SET last_ledger_id = %s WHERE id = 1", (upto,)
+        )
+
+        # Ожидаемый баланс = свертка + записи, которые еще не свернуты
+        cursor.execute("""
+            SELECT u.id AS user_id,
+                   u.stars_balance,
+                   r.stars_balance + COALESCE(p.stars, 0) AS expected_stars_balance,
+                   u.total_spent,
+                   r.total_spent + COALESCE(p.spent, 0) AS expected_total_spent
+            FROM users u
+            JOIN stars_ledger_rollup r ON r.user_id = u.id
+            LEFT JOIN (
+                SELECT user_id, SUM(stars_delta) AS stars, SUM(spent_delta) AS spent
+                FROM stars_ledger
+                WHERE id > %(upto)s AND user_id = ANY(%(users)s)
+                GROUP BY user_id
+            ) p ON p.user_id = u.id
+            WHERE u.id = ANY(%(users)s)
+              AND (u.stars_balance <> r.stars_balance + COALESCE(p.stars, 0)
+                   OR u.total_spent <> r.total_spent + COALESCE(p.spent, 0))
+        """, {'upto': upto, 'users': touched})
+        mismatches = [dict(row) for row in cursor.fetchall()]
+
+        if mismatches and repair:
+            execute_values(cursor, """
+                UPDATE users
+                SET stars_balance = fix.stars_balance, total_spent = fix.total_spent
+                FROM (VALUES %s) AS fix (user_id, stars_balance, total_spent)
+                WHERE users.id = fix.user_id
+            """, [
+                (m['user_id'], m['expected_stars_balance'], m['expected_total_spent'])
+                for m in mismatches
+            ])
+        conn.commit()
+
+    for mismatch in mismatches:
+        logger.warning(
+            f"Расхождение баланса пользователя {mismatch['user_id']}: "
+            f"stars_balance={mismatch['stars_balance']} (по журналу {mismatch['expected_stars_balance']}), "
+            f"total_spent={mismatch['total_spent']} (по журналу {mismatch['expected_total_spent']})"
+        )
+        if repair:
+            invalidate_user(mismatch['user_id'])
+    logger.info(f"Сверка журнала звезд: записей до {upto}, пользователей {len(touched)}, расхождений {len(mismatches)}")
+    return mismatches
+
+
+def create_broadcast(text, parse_mode=None, language_code=None, is_premium=None,
+                     created_from=None, created_to=None):
+    """
+    Создать рассылку (ее отправит запущенный бот)
+
+    Args:
+        text: текст сообщения
+        parse_mode: HTML, Markdown или None
+        language_code: только пользователям с этим языком
+        is_premium: только с Telegram Premium (True) или без него (False)
+        created_from, created_to: только зарегистрированным в этом интервале
+
+    Returns:
+        int: ID рассылки
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO broadcasts (text, parse_mode, language_code, is_premium, created_from, created_to)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
+        """, (text, parse_mode, language_code, is_premium, created_from, created_to))
+        broadcast_id = cursor.fetchone()[0]
+        conn.commit()
+    logger.info(f"Создана рассылка {broadcast_id}")
+    return broadcast_id
+
+
+def get_broadcasts(limit=20):
+    """
+    Последние рассылки
+
+    Returns:
+        list: dict со строками broadcasts, от новых к старым
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT %s", (limit,))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def claim_broadcast(owner, lease_seconds):
+    """
+    Взять следующую рассылку для отправки: брошенную начатую или самую старую новую
+
+    Начатая рассылка забирается, только если ее владелец не обновлял
+    heartbeat_at дольше lease_seconds, поэтому два процесса не отправляют
+    одну рассылку одновременно.
+
+    Args:
+        owner: идентификатор процесса (записывается в claimed_by)
+        lease_seconds: через сколько секунд без heartbeat рассылка считается брошенной
+
+    Returns:
+        dict: строка broadcasts со статусом running или None, если рассылок нет
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("""
+            UPDATE broadcasts
+            SET status = 'running',
+                claimed_by = %s,
+                heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT id FROM broadcasts
+                WHERE status = 'pending'
+                   OR (status = 'running'
+                       AND (heartbeat_at IS NULL
+                            OR heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)))
+                ORDER BY status = 'running' DESC, id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING *
+        """, (owner, lease_seconds))
+        row = cursor.fetchone()
+        conn.commit()
+        return dict(row) if row else None
+
+
+def heartbeat_broadcast(broadcast_id, owner):
+    """
+    Продлить владение рассылкой
+
+    Returns:
+        bool: True если рассылка все еще принадлежит owner и идет
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE broadcasts SET heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND claimed_by = %s AND status = 'running'
+        """, (broadcast_id, owner))
+        owned = cursor.rowcount == 1
+        conn.commit()
+        return owned
+
+
+def finish_broadcast(broadcast_id, owner):
+    """
+    Отметить рассылку завершенной, если она все еще принадлежит owner
+
+    Returns:
+        bool: True если рассылка завершена этим вызовом
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE broadcasts SET status = 'finished', finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND claimed_by = %s AND status = 'running'
+        """, (broadcast_id, owner))
+        finished = cursor.rowcount == 1
+        conn.commit()
+        return finished
+
+
+def release_broadcast(broadcast_id, owner):
+    """Отпустить начатую рассылку при остановке процесса: другой процесс заберет ее сразу"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE broadcasts SET claimed_by = NULL, heartbeat_at = NULL
+            WHERE id = %s AND claimed_by = %s AND status = 'running'
+        """, (broadcast_id, owner))
+        conn.commit()
+
+
+def set_broadcast_status(broadcast_id, status):
+    """
+    Изменить статус рассылки (например, отменить)
+
+    Returns:
+        bool: True если рассылка найдена и еще не завершена
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE broadcasts
+            SET status = %s,
+                finished_at = CASE WHEN %s IN ('finished', 'cancelled') THEN CURRENT_TIMESTAMP END
+            WHERE id = %s AND status IN ('pending', 'running')
+        """, (status, status, broadcast_id))
+        updated = cursor.rowcount == 1
+        conn.commit()
+        return updated
+
+
+def get_broadcast_recipients(broadcast, after_user_id, limit):
+    """
+    Следующая страница получателей рассылки
+
+    Постраничная выборка по первичному ключу (id > последний обработанный),
+    поэтому каждая страница - короткий запрос без OFFSET, и вся рассылка
+    читает таблицу users ровно один раз.
+
+    Args:
+        broadcast: строка broadcasts (фильтры)
+        after_user_id: последний обработанный user ID
+        limit: размер страницы
+
+    Returns:
+        list: user ID по возрастанию
+    """
+    conditions = ["id > %s", "blocked_at IS NULL"]
+    params = [after_user_id]
+    if broadcast.get('language_code') is not None:
+        conditions.append("language_code = %s")
+        params.append(broadcast['language_code'])
+    if broadcast.get('is_premium') is not None:
+        conditions.append("is_premium = %s")
+        params.append(broadcast['is_premium'])
+    if broadcast.get('created_from') is not None:
+        conditions.append("created_at >= %s")
+        params.append(broadcast['created_from'])
+    if broadcast.get('created_to') is not None:
+        conditions.append("created_at < %s")
+        params.append(broadcast['created_to'])
+    params.append(limit)
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT id FROM users WHERE {' AND '.join(conditions)} ORDER BY id LIMIT %s",
+            params,
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def save_broadcast_progress(broadcast_id, owner, last_user_id, sent, failed, blocked_user_ids):
+    """
+    Записать контрольную точку рассылки и отметить заблокировавших бота пользователей
+
+    Выполняется одной транзакцией: после перезапуска рассылка продолжится
+    со страницы, следующей за last_user_id. Заодно продлевается владение
+    рассылкой; если ее забрал другой процесс, контрольная точка не пишется.
+
+    Args:
+        broadcast_id: ID рассылки
+        owner: идентификатор процесса, который взял рассылку в claim_broadcast
+        last_user_id: последний обработанный user ID
+        sent: сколько сообщений доставлено на этой странице
+        failed: сколько сообщений не удалось отправить
+        blocked_user_ids: пользователи, заблокировавшие бота
+
+    Returns:
+        str: текущий статус рассылки (если не running - рассылку надо остановить)
+             или None, если рассылка принадлежит другому процессу
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        if blocked_user_ids:
+            cursor.execute("""
+                UPDATE users SET blocked_at = CURRENT_TIMESTAMP
+                WHERE id = ANY(%s) AND blocked_at IS NULL
+            """, (list(blocked_user_ids),))
+        cursor.execute("""
+            UPDATE broadcasts
+            SET last_user_id = GREATEST(last_user_id, %s),
+                sent = sent + %s,
+                failed = failed + %s,
+                blocked = blocked + %s,
+                heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND claimed_by = %s
+            RETURNING status
+        """, (last_user_id, sent, failed, len(blocked_user_ids), broadcast_id, owner))
+        row = cursor.fetchone()
+        conn.commit()
+
+    for user_id in blocked_user_ids:
+        invalidate_user(user_id)
+    return row[0] if row else None
+
+
+# Колонки users в файлах выгрузки (в этом порядке)
+USER_EXPORT_COLUMNS = (
+    'id', 'username', 'first_name', 'last_name', 'language_code', 'is_premium',
+    'stars_balance', 'total_spent', 'blocked_at', 'created_at', 'updated_at',
+)
+
+# COPY в формате csv с символами-разделителями, которых нет в JSON: строка выводится как есть
+_JSONL_COPY_OPTIONS = "FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02'"
+
+# Размер блока, которым COPY FROM читает файл загрузки
+_COPY_BUFFER_SIZE = 1 << 20
+
+
+def export_users(output, fmt='csv', since=None, lag_seconds=60):
+    """
+    Выгрузить пользователей через COPY ... TO STDOUT
+
+    Строки потоком пишутся в output, в памяти выгрузка не накапливается.
+    Выгружаются строки с updated_at не позже watermark (сейчас минус lag_seconds,
+    чтобы не пропустить изменения еще не завершенных транзакций); следующую
+    инкрементальную выгрузку нужно начинать с since=watermark.
+
+    Args:
+        output: двоичный файл для записи
+        fmt: csv (с заголовком) или jsonl (объект JSON на строку)
+        since: выгрузить только строки с updated_at позже этого момента (None - все)
+        lag_seconds: отступ watermark от текущего времени, секунд
+
+    Returns:
+        dict: rows (выгружено строк), watermark (datetime)
+    """
+    columns = ', '.join(USER_EXPORT_COLUMNS)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        # Один снимок на выгрузку и расчет watermark
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cursor.execute("SET LOCAL statement_timeout = 0")
+        cursor.execute("SELECT LOCALTIMESTAMP - make_interval(secs => %s)", (lag_seconds,))
+        watermark = cursor.fetchone()[0]
+
+        if since is None:
+            query = cursor.mogrify(
+                f"SELECT {columns} FROM users WHERE updated_at <= %s OR updated_at IS NULL",
+                (watermark,),
+            )
+        else:
+            query = cursor.mogrify(
+                f"SELECT {columns} FROM users WHERE updated_at > %s::timestamp AND updated_at <= %s",
+                (since, watermark),
+            )
+        query = query.decode(psycopg2.extensions.encodings[conn.encoding])
+
+        if fmt == 'csv':
+            cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", output)
+        elif fmt == 'jsonl':
+            cursor.copy_expert(
+                f"COPY (SELECT row_to_json(u) FROM ({query}) u) TO STDOUT WITH ({_JSONL_COPY_OPTIONS})",
+                output,
+            )
+        else:
+            raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+        rows = cursor.rowcount
+        conn.commit()
+
+    logger.info(f"Выгружено пользователей: {rows}, watermark {watermark.isoformat()}")
+    return {'rows': rows, 'watermark': watermark}
+
+
+def import_users(source, fmt='csv', force=False):
+    """
+    Загрузить пользователей через COPY ... FROM STDIN во временную таблицу
+    и слить в users одним upsert
+
+    Загружаются профиль, created_at (берется более ранний) и blocked_at.
+    stars_balance и total_spent не загружаются: они производные от журнала
+    stars_ledger, который не переносится. Если пользователь встречается в файле
+    несколько раз, берется строка с самым поздним updated_at. Если created_at
+    стал раньше, триггер user_stats_update переносит пользователя в другой
+    день user_stats_daily.
+
+    Существующая строка обновляется, только если в файле она новее (updated_at
+    позже, чем в базе), как в replay_users: загрузка старой выгрузки не откатывает
+    профили и отметки blocked_at. Строки файла без updated_at только добавляют
+    новых пользователей.
+
+    Args:
+        source: двоичный файл для чтения (формат export_users)
+        fmt: csv (с заголовком) или jsonl
+        force: перезаписать существующих пользователей без проверки updated_at
+
+    Returns:
+        dict: staged (строк в файле), inserted (новых пользователей), updated (измененных)
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SET LOCAL statement_timeout = 0")
+        cursor.execute("CREATE TEMP TABLE users_import (LIKE users INCLUDING DEFAULTS) ON COMMIT DROP")
+
+        if fmt == 'csv':
+            header = next(csv.reader([source.readline().decode('utf-8')]), [])
+            unknown = set(header) - set(USER_EXPORT_COLUMNS)
+            if 'id' not in header or unknown:
+                raise ValueError(f"Неверный заголовок CSV: {header}")
+            cursor.copy_expert(
+                f"COPY users_import ({', '.join(header)}) FROM STDIN WITH (FORMAT csv)",
+                source,
+                size=_COPY_BUFFER_SIZE,
+            )
+            staged = cursor.rowcount
+        elif fmt == 'jsonl':
+            cursor.execute("CREATE TEMP TABLE users_import_json (doc json) ON COMMIT DROP")
+            cursor.copy_expert(
+                f"COPY users_import_json FROM STDIN WITH ({_JSONL_COPY_OPTIONS})",
+                source,
+                size=_COPY_BUFFER_SIZE,
+            )
+            staged = cursor.rowcount
+            cursor.execute("""
+                INSERT INTO users_import
+                SELECT r.* FROM users_import_json j, json_populate_record(NULL::users_import, j.doc) r
+            """)
+        else:
+            raise ValueError(f"Неизвестный формат загрузки: {fmt}")
+
+        if not force:
+            # Без updated_at нельзя понять, новее ли строка: существующих пользователей не трогаем
+            cursor.execute("""
+                DELETE FROM users_import i USING users u
+                WHERE i.id = u.id AND i.updated_at IS NULL
+            """)
+        cursor.execute("ANALYZE users_import")
+        cursor.execute("""
+            WITH merged AS (
+                INSERT INTO users AS u (id, username, first_name, last_name, language_code, is_premium,
+                                        blocked_at, created_at, updated_at)
+                SELECT DISTINCT ON (id)
+                       id, username, first_name, last_name, language_code, COALESCE(is_premium, FALSE),
+                       blocked_at, COALESCE(created_at, LOCALTIMESTAMP), COALESCE(updated_at, LOCALTIMESTAMP)
+                FROM users_import
+                ORDER BY id, updated_at DESC NULLS LAST
+                ON CONFLICT (id) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    first_name = EXCLUDED.first_name,
+                    last_name = EXCLUDED.last_name,
+                    language_code = EXCLUDED.language_code,
+                    is_premium = EXCLUDED.is_premium,
+                    blocked_at = EXCLUDED.blocked_at,
+                    created_at = LEAST(u.created_at, EXCLUDED.created_at)
+                WHERE (%(force)s OR u.updated_at < EXCLUDED.updated_at)
+                  AND (u.username, u.first_name, u.last_name, u.language_code, u.is_premium, u.blocked_at,
+                       u.created_at)
+                      IS DISTINCT FROM
+                      (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name, EXCLUDED.language_code,
+                       EXCLUDED.is_premium, EXCLUDED.blocked_at, LEAST(u.created_at, EXCLUDED.created_at))
+                RETURNING (xmax = 0) AS inserted
+            )
+            SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM merged
+        """, {'force': force})
+        inserted, updated = cursor.fetchone()
+        conn.commit()
+
+    # Кэш этого процесса; запущенный бот перечитает пользователей через USER_CACHE_TTL
+    _user_cache.clear()
+    logger.info(f"Загружено строк: {staged}, новых пользователей: {inserted}, изменено: {updated}")
+    return {'staged': staged, 'inserted': inserted, 'updated': updated}
@@ -0,0 +1,137 @@
+"""
+Выполнение запросов к базе данных вне потоков обработчиков
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutorFull(Exception):
+    """Очередь задач переполнена, задача не принята"""
+
+
+class KeyedExecutor:
+    """
+    Ограниченный пул потоков с сохранением порядка задач по ключу
+
+    Задачи с одинаковым ключом (Telegram user ID) всегда попадают в один и тот же
+    поток и выполняются строго в порядке постановки; задачи разных пользователей
+    распределяются по потокам и выполняются параллельно.
+
+    У каждого потока своя очередь размером не больше queue_size: при переполнении
+    submit сразу выбрасывает ExecutorFull, а не блокирует обработчик. Задача,
+    простоявшая в очереди дольше task_timeout секунд, не выполняется
+    и завершается с TimeoutError.
+    """
+
+    def __init__(self, workers=4, queue_size=1000, task_timeout=5.0, name='db'):
+        if workers < 1:
+            raise ValueError("Нужен хотя бы один поток")
+        self.task_timeout = task_timeout
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+        # Статистика
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._expired = 0
+
+        self._threads = []
+        for index, tasks in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(tasks,), name=f'{name}-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Поставить задачу в очередь
+
+        Args:
+            key: ключ упорядочивания (задачи с одним ключом выполняются по порядку)
+            func: функция для выполнения
+            *args, **kwargs: аргументы функции
+
+        Returns:
+            Future: результат выполнения
+
+        Raises:
+            ExecutorFull: если очередь для этого ключа заполнена
+        """
+        if self._shutdown:
+            raise RuntimeError("Пул потоков базы данных остановлен")
+        future = Future()
+        task = (time.monotonic() + self.task_timeout, future, func, args, kwargs)
+        try:
+            self._queues[hash(key) % len(self._queues)].put_nowait(task)
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise ExecutorFull("Очередь запросов к базе данных переполнена")
+        with self._lock:
+            self._submitted += 1
+        return future
+
+    def _work(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            deadline, future, func, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            if time.monotonic() > deadline:
+                with self._lock:
+                    self._expired += 1
+                future.set_exception(TimeoutError("Задача слишком долго ждала в очереди"))
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                with self._lock:
+                    self._failed += 1
+                future.set_exception(e)
+            else:
+                with self._lock:
+                    self._completed += 1
+                future.set_result(result)
+
+    def shutdown(self, wait=True):
+        """
+        Остановить потоки
+
+        Args:
+            wait: дождаться выполнения всех уже поставленных задач
+        """
+        self._shutdown = True
+        for tasks in self._queues:
+            tasks.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def stats(self):
+        """
+        Статистика пула
+
+        Returns:
+            dict: queue_depth (всего задач в очередях), max_queue_depth (в самой длинной),
+                  submitted, completed, failed, rejected, expired
+        """
+        depths = [tasks.qsize() for tasks in self._queues]
+        with self._lock:
+            return {
+                'queue_depth': sum(depths),
+                'max_queue_depth': max(depths),
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+                'expired': self._expired,
+            }
@@ -0,0 +1,215 @@
+"""
+Пул соединений с PostgreSQL
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведенное время"""
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение, которое помнит подготовленные на нем запросы и время последнего использования"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+class ConnectionPool:
+    """
+    Потокобезопасный пул соединений с ограничением размера
+
+    Если все соединения заняты, поток ждет освобождения не дольше timeout секунд.
+    При выдаче соединения, простоявшего дольше healthcheck_idle секунд,
+    выполняется проверка SELECT 1; мертвые соединения (например, после
+    переключения мастера) закрываются и открываются заново.
+
+    connection_factory должен быть подклассом PooledConnection.
+    """
+
+    def __init__(self, connect_kwargs, minconn=1, maxconn=10, timeout=5.0, healthcheck_idle=30.0,
+                 connection_factory=PooledConnection):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Некорректные размеры пула: min={minconn}, max={maxconn}")
+        self._connect_kwargs = dict(connect_kwargs)
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._connection_factory = connection_factory
+
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._opened = 0
+        self._in_use = 0
+        self._closed = False
+
+        # Статистика
+        self._checkouts = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._reconnects = 0
+
+    def _connect(self):
+        """Открыть новое физическое соединение"""
+        return psycopg2.connect(connection_factory=self._connection_factory, **self._connect_kwargs)
+
+    def fill(self):
+        """Заранее открыть minconn соединений"""
+        with self._cond:
+            missing = self.minconn - self._opened
+            self._opened += max(missing, 0)
+        for _ in range(max(missing, 0)):
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._opened -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append(conn)
+                self._cond.notify()
+
+    def _is_alive(self, conn):
+        """Проверить, что соединение живое"""
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.last_used < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout=None):
+        """
+        Взять соединение из пула
+
+        Args:
+            timeout: сколько секунд ждать свободное соединение (по умолчанию self.timeout)
+
+        Returns:
+            PooledConnection: соединение, которое нужно вернуть через putconn
+
+        Raises:
+            PoolTimeout: если соединение не освободилось за timeout секунд
+        """
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        conn = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.InterfaceError("Пул соединений закрыт")
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._opened < self.maxconn:
+                    # Резервируем место под новое соединение, открываем его вне блокировки
+                    self._opened += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"Нет свободных соединений в пуле за {timeout} с")
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_time += time.monotonic() - started
+
+        try:
+            if conn is not None and not self._is_alive(conn):
+                with self._cond:
+                    self._reconnects += 1
+                logger.warning("Соединение с базой данных потеряно, переподключаемся")
+                self._close_quietly(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """
+        Вернуть соединение в пул
+
+        Args:
+            conn: соединение, полученное через getconn
+            discard: закрыть соединение вместо возврата (например, после ошибки связи)
+        """
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed or self._closed:
+                self._opened -= 1
+            else:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._close_quietly(conn)
+
+    def closeall(self):
+        """Закрыть все свободные соединения и запретить выдачу новых"""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._opened -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        """
+        Статистика пула
+
+        Returns:
+            dict: in_use, idle, opened, checkouts, wait_time_total, wait_time_avg,
+                  timeouts, reconnects
+        """
+        with self._cond:
+            return {
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'opened': self._opened,
+                'max': self.maxconn,
+                'checkouts': self._checkouts,
+                'wait_time_total': self._wait_time,
+                'wait_time_avg': self._wait_time / self._checkouts if self._checkouts else 0.0,
+                'timeouts': self._timeouts,
+                'reconnects': self._reconnects,
+            }
@@ -0,0 +1,415 @@
+"""
+Метрики бота: задержки обработчиков и запросов к базе, счетчики ошибок,
+глубина очередей и профилировщик самых медленных обновлений
+
+Метрики отдаются в текстовом формате Prometheus встроенным HTTP-сервером:
+    GET  /metrics                    - метрики
+    GET  /debug/slow                 - самые медленные обновления со стеками
+    POST /debug/profiler?enabled=1   - включить (0 - выключить) профилировщик
+"""
+import functools
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from structured_logging import bind
+
+logger = logging.getLogger(__name__)
+
+# Квантили, которые считаются для каждой метрики задержки
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Сколько последних значений хранить для расчета квантилей
+_SUMMARY_SAMPLES = 1024
+
+# Глубина стека, которую сохраняет профилировщик
+_STACK_DEPTH = 40
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+class Summary:
+    """Количество, сумма и квантили по последним _SUMMARY_SAMPLES значениям"""
+
+    __slots__ = ('count', 'total', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=_SUMMARY_SAMPLES)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def quantiles(self):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {quantile: 0.0 for quantile in QUANTILES}
+        return {
+            quantile: ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+            for quantile in QUANTILES
+        }
+
+
+class MetricsRegistry:
+    """
+    Хранилище метрик процесса
+
+    - observe()/timer() - задержки (summary с квантилями p50/p95/p99);
+    - inc() - счетчики;
+    - register_gauges() - функция, возвращающая dict статистики (например,
+      OutboundScheduler.stats); числовые значения отдаются как gauge.
+    """
+
+    def __init__(self, prefix='telestars'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._summaries = {}  # (name, labels) -> Summary
+        self._counters = {}  # (name, labels) -> int
+        self._gauges = []  # (name, func)
+
+    def observe(self, name, value, **labels):
+        """Записать значение задержки в секундах"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = Summary()
+            summary.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        """Увеличить счетчик"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, errors_name=None, **labels):
+        """
+        Измерить время выполнения блока with
+
+        Исключение из блока увеличивает счетчик errors_name (если задан)
+        с теми же метками и пробрасывается дальше.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            if errors_name:
+                self.inc(errors_name, **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def register_gauges(self, name, func):
+        """
+        Отдавать числовые значения из func() как gauge {prefix}_{name}_{ключ}
+
+        Args:
+            name: префикс метрик, например outbound
+            func: функция без аргументов, возвращающая dict
+        """
+        with self._lock:
+            self._gauges.append((name, func))
+
+    def render(self):
+        """
+        Метрики в текстовом формате Prometheus
+
+        Returns:
+            str: текст для ответа на /metrics
+        """
+        with self._lock:
+            summaries = [(key, summary.count, summary.total, summary.quantiles())
+                         for key, summary in self._summaries.items()]
+            counters = list(self._counters.items())
+            gauges = list(self._gauges)
+
+        lines = []
+        declared = set()
+
+        def declare(metric, kind):
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f'# TYPE {metric} {kind}')
+
+        for (name, labels), count, total, quantiles in sorted(summaries):
+            metric = f'{self.prefix}_{name}'
+            declare(metric, 'summary')
+            for quantile, value in quantiles.items():
+                lines.append(f'{metric}{_format_labels(labels + (("quantile", quantile),))} {value:.6f}')
+            lines.append(f'{metric}_sum{_format_labels(labels)} {total:.6f}')
+            lines.append(f'{metric}_count{_format_labels(labels)} {count}')
+
+        for (name, labels), value in sorted(counters):
+            metric = f'{self.prefix}_{name}'
+            declare(metric, 'counter')
+            lines.append(f'{metric}{_format_labels(labels)} {value}')
+
+        for name, func in gauges:
+            try:
+                values = func()
+            except Exception as e:
+                logger.warning(f"Не удалось получить статистику {name}: {e}")
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                metric = f'{self.prefix}_{name}_{key}'
+                declare(metric, 'gauge')
+                lines.append(f'{metric} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class _Trace:
+    """Обработка одного обновления, за которой следит профилировщик"""
+
+    __slots__ = ('label', 'update_id', 'thread_id', 'started', 'duration', 'samples')
+
+    def __init__(self, label, update_id):
+        self.label = label
+        self.update_id = update_id
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.samples = Counter()  # стек -> сколько раз попал в выборку
+
+
+class SlowUpdateProfiler:
+    """
+    Семплирующий профилировщик обработки обновлений
+
+    Пока включен, фоновый поток каждые interval секунд снимает стеки потоков,
+    которые сейчас обрабатывают обновления. По завершении обработки
+    сохраняются top самых медленных обновлений вместе с их стеками.
+    Выключенный профилировщик не стоит ничего, кроме одной проверки флага.
+    """
+
+    def __init__(self, top=20, interval=0.005):
+        self.top = top
+        self.interval = interval
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._active = {}  # thread_id -> _Trace
+        self._slowest = []  # отсортированы по убыванию длительности
+        self._thread = None
+
+    def enable(self):
+        """Включить профилировщик (результаты прошлого запуска сбрасываются)"""
+        with self._lock:
+            if self.enabled:
+                return
+            self.enabled = True
+            self._slowest = []
+            self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+            self._thread.start()
+        logger.info("Профилировщик обновлений включен")
+
+    def disable(self):
+        """Выключить профилировщик (собранные результаты сохраняются)"""
+        with self._lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            thread = self._thread
+            self._active.clear()
+        thread.join()
+        logger.info("Профилировщик обновлений выключен")
+
+    def begin(self, label, update_id=None):
+        """
+        Отметить начало обработки обновления в текущем потоке
+
+        Returns:
+            _Trace или None, если профилировщик выключен
+        """
+        if not self.enabled:
+            return None
+        trace = _Trace(label, update_id)
+        with self._lock:
+            self._active[trace.thread_id] = trace
+        return trace
+
+    def end(self, trace):
+        """Отметить окончание обработки, начатой begin()"""
+        if trace is None:
+            return
+        trace.duration = time.perf_counter() - trace.started
+        with self._lock:
+            if self._active.get(trace.thread_id) is trace:
+                del self._active[trace.thread_id]
+            if not self.enabled:
+                return
+            if len(self._slowest) < self.top or trace.duration > self._slowest[-1].duration:
+                self._slowest.append(trace)
+                self._slowest.sort(key=lambda item: item.duration, reverse=True)
+                del self._slowest[self.top:]
+
+    def _sample(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, trace in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is None:
+                        continue
+                    stack = tuple(
+                        (entry.filename, entry.lineno, entry.name)
+                        for entry in traceback.extract_stack(frame, limit=_STACK_DEPTH)
+                    )
+                    trace.samples[stack] += 1
+
+    def report(self, stacks=3):
+        """
+        Самые медленные обновления с наиболее частыми стеками
+
+        Args:
+            stacks: сколько разных стеков показывать для каждого обновления
+
+        Returns:
+            str: текстовый отчет
+        """
+        with self._lock:
+            slowest = list(self._slowest)
+            enabled = self.enabled
+        lines = [f"Профилировщик {'включен' if enabled else 'выключен'}, медленных обновлений: {len(slowest)}"]
+        for trace in slowest:
+            total = sum(trace.samples.values())
+            lines.append('')
+            lines.append(f"update_id={trace.update_id} handler={trace.label} "
+                         f"{trace.duration * 1000:.1f} мс, выборок {total}")
+            for stack, hits in trace.samples.most_common(stacks):
+                lines.append(f"  {hits}/{total}:")
+                for filename, lineno, name in stack:
+                    lines.append(f"    {filename}:{lineno} {name}")
+        return '\n'.join(lines) + '\n'
+
+
+# Метрики и профилировщик процесса
+REGISTRY = MetricsRegistry()
+PROFILER = SlowUpdateProfiler()
+
+
+def instrument(handler):
+    """
+    Обернуть обработчик Telegram: время в handler_duration_seconds{handler=...},
+    ошибки в handler_errors_total, трассировка для профилировщика
+
+    Записи лога внутри обработчика получают поля handler и user_id, по
+    завершении пишется событие update_handled со временем обработки.
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    def wrapper(update, context):
+        update_id = getattr(update, 'update_id', None)
+        user = getattr(update, 'effective_user', None)
+        trace = PROFILER.begin(name, update_id)
+        started = time.perf_counter()
+        try:
+            with bind(handler=name, user_id=user.id if user else None), \
+                    REGISTRY.timer('handler_duration_seconds', 'handler_errors_total', handler=name):
+                return handler(update, context)
+        finally:
+            PROFILER.end(trace)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "Обновление обработано",
+                    extra={
+                        'event': 'update_handled',
+                        'handler': name,
+                        'user_id': user.id if user else None,
+                        'update_id': update_id,
+                        'latency_ms': round((time.perf_counter() - started) * 1000, 3),
+                    },
+                )
+
+    return wrapper
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Отдает метрики и отчет профилировщика"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'telestars-metrics'
+
+    def do_GET(self):
+        server = self.server.metrics
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self._respond(200, server.registry.render(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif path == '/debug/slow':
+            self._respond(200, server.profiler.report(), 'text/plain; charset=utf-8')
+        else:
+            self._respond(404, '')
+
+    def do_POST(self):
+        server = self.server.metrics
+        parsed = urlparse(self.path)
+        if parsed.path != '/debug/profiler':
+            self._respond(404, '')
+            return
+        enabled = parse_qs(parsed.query).get('enabled', ['1'])[0] not in ('0', 'false', 'no')
+        if enabled:
+            server.profiler.enable()
+        else:
+            server.profiler.disable()
+        self._respond(200, f"enabled={int(server.profiler.enabled)}\n", 'text/plain; charset=utf-8')
+
+    def _respond(self, code, body, content_type='text/plain'):
+        data = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    """HTTP-сервер для /metrics и управления профилировщиком"""
+
+    def __init__(self, registry=REGISTRY, profiler=PROFILER, listen='127.0.0.1', port=9108):
+        self.registry = registry
+        self.profiler = profiler
+        self.listen = listen
+        self._httpd = ThreadingHTTPServer((listen, port), _MetricsRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.metrics = self
+        self._thread = None
+
+    @property
+    def port(self):
+        """Порт, на котором фактически слушает сервер"""
+        return self._httpd.server_address[1]
+
+    def start(self):
+        """Запустить сервер в фоновом потоке"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='metrics-http', daemon=True)
+        self._thread.start()
+        logger.info(f"Метрики доступны на http://{self.listen}:{self.port}/metrics")
+
+    def stop(self):
+        """Остановить сервер"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,169 @@
+"""
+Версионные миграции схемы базы данных
+
+Файлы миграций лежат в каталоге migrations/ и называются NNNN_описание.sql.
+Применённые версии записываются в таблицу schema_version.
+
+Использование:
+    python migrate.py           # применить все новые миграции
+    python migrate.py status    # показать текущую и последнюю версии
+"""
+import argparse
+import logging
+import os
+import re
+
+from psycopg2 import errors
+from database import get_connection, close_pool
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+_MIGRATION_FILE_RE = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+# Ключ advisory lock, чтобы две копии migrate.py не применяли миграции одновременно
+_MIGRATION_LOCK_KEY = 7_115_301
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """
+    Прочитать список миграций из каталога
+
+    Returns:
+        list: кортежи (версия, имя, путь к файлу), отсортированные по версии
+    """
+    migrations = []
+    for filename in os.listdir(directory):
+        match = _MIGRATION_FILE_RE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(directory, filename)))
+    migrations.sort()
+
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Повторяющиеся номера миграций в {directory}")
+    return migrations
+
+
+def latest_version(directory=MIGRATIONS_DIR):
+    """Номер последней миграции в каталоге"""
+    migrations = load_migrations(directory)
+    return migrations[-1][0] if migrations else 0
+
+
+def current_version(conn):
+    """
+    Версия схемы в базе одним запросом
+
+    Returns:
+        int: номер последней применённой миграции (0, если миграций ещё не было)
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        version = cursor.fetchone()[0]
+        conn.commit()
+        return version
+    except errors.UndefinedTable:
+        conn.rollback()
+        return 0
+
+
+def check_schema():
+    """
+    Быстрая проверка при запуске бота: схема актуальна или нет (без DDL)
+
+    Returns:
+        bool: True если все миграции применены
+    """
+    with get_connection() as conn:
+        version = current_version(conn)
+    latest = latest_version()
+    if version < latest:
+        logger.warning(
+            f"Схема базы данных устарела: версия {version}, последняя {latest}. "
+            "Выполните: python migrate.py"
+        )
+        return False
+    logger.info(f"Схема базы данных актуальна (версия {version})")
+    return True
+
+
+def apply_migrations(directory=MIGRATIONS_DIR):
+    """
+    Применить все миграции новее текущей версии
+
+    Каждая миграция выполняется в отдельной транзакции вместе с записью в schema_version.
+
+    Returns:
+        list: номера применённых миграций
+    """
+    applied = []
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        # Миграции (например, построение индексов) могут идти дольше обычного statement_timeout
+        cursor.execute("SET statement_timeout = 0")
+        cursor.execute("SELECT pg_advisory_lock(%s)", (_MIGRATION_LOCK_KEY,))
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            conn.commit()
+
+            version = current_version(conn)
+            for number, name, path in load_migrations(directory):
+                if number <= version:
+                    continue
+                logger.info(f"Применяем миграцию {number:04d}_{name}")
+                with open(path, encoding='utf-8') as f:
+                    sql = f.read()
+                try:
+                    cursor.execute(sql)
+                    cursor.execute(
+                        "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                        (number, name),
+                    )
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    logger.error(f"Ошибка в миграции {number:04d}_{name}: {e}")
+                    raise
+                applied.append(number)
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (_MIGRATION_LOCK_KEY,))
+            conn.commit()
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы базы данных")
+    parser.add_argument('command', nargs='?', default='apply', choices=['apply', 'status'])
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    try:
+        if args.command == 'status':
+            with get_connection() as conn:
+                version = current_version(conn)
+            print(f"Текущая версия: {version}, последняя: {latest_version()}")
+        else:
+            applied = apply_migrations()
+            if applied:
+                print(f"Применены миграции: {', '.join(str(v) for v in applied)}")
+            else:
+                print("Схема уже актуальна")
+    finally:
+        close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+-- Состояние диалога пользователей (текущий заказ, выбор количества звезд и т.п.)
+-- Одна строка на ключ, чтобы записывать только измененные значения
+CREATE TABLE IF NOT EXISTS conversation_state (
+    user_id BIGINT NOT NULL,  -- Telegram user ID
+    key VARCHAR(64) NOT NULL,  -- Имя ключа состояния
+    value JSONB NOT NULL,  -- Значение
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- Время последней записи
+    PRIMARY KEY (user_id, key)
+);
@@ -0,0 +1,26 @@
+-- Заказы звезд
+CREATE TABLE IF NOT EXISTS orders (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,  -- Telegram user ID покупателя
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',  -- pending, paid, expired, cancelled
+    amount INTEGER NOT NULL,  -- Количество звезд
+    cost NUMERIC(12, 2) NOT NULL,  -- Стоимость в рублях
+    is_gift BOOLEAN NOT NULL DEFAULT FALSE,  -- Звезды в подарок
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- Дата создания
+    expires_at TIMESTAMP NOT NULL,  -- До какого момента счет активен
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP  -- Дата последнего изменения
+);
+
+-- Индекс для пакетного поиска просроченных заказов
+CREATE INDEX IF NOT EXISTS idx_orders_status_expires_at ON orders(status, expires_at);
+
+-- У пользователя не больше одного активного заказа; по этому же индексу он быстро находится
+CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_user_pending ON orders(user_id) WHERE status = 'pending';
+
+-- Индекс для истории заказов пользователя
+CREATE INDEX IF NOT EXISTS idx_orders_user_created_at ON orders(user_id, created_at DESC);
+
+-- Триггер для автоматического обновления updated_at при изменении записи
+DROP TRIGGER IF EXISTS update_orders_updated_at ON orders;
+CREATE TRIGGER update_orders_updated_at BEFORE UPDATE ON orders
+FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
@@ -0,0 +1,23 @@
+-- Тарифы на звезды: ступени по количеству и промо-акции
+CREATE TABLE IF NOT EXISTS tariffs (
+    id SERIAL PRIMARY KEY,
+    min_amount INTEGER NOT NULL DEFAULT 1,  -- Тариф действует от этого количества звезд
+    max_amount INTEGER,  -- И до этого количества включительно (NULL - без ограничения)
+    price_per_star NUMERIC(10, 4) NOT NULL,  -- Цена одной звезды в рублях
+    priority INTEGER NOT NULL DEFAULT 0,  -- При пересечении тарифов действует тариф с большим приоритетом
+    valid_from TIMESTAMP,  -- Начало действия (NULL - без ограничения)
+    valid_until TIMESTAMP,  -- Окончание действия (NULL - без ограничения)
+    is_active BOOLEAN NOT NULL DEFAULT TRUE,  -- Выключенные тарифы не применяются
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- Дата создания
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP  -- Дата последнего изменения
+);
+
+-- Базовый тариф, который раньше был зашит в код
+INSERT INTO tariffs (min_amount, price_per_star)
+SELECT 1, 1.47
+WHERE NOT EXISTS (SELECT 1 FROM tariffs);
+
+-- Триггер для автоматического обновления updated_at при изменении записи
+DROP TRIGGER IF EXISTS update_tariffs_updated_at ON tariffs;
+CREATE TRIGGER update_tariffs_updated_at BEFORE UPDATE ON tariffs
+FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
@@ -0,0 +1,32 @@
+-- Журнал движения звезд: только добавление записей, баланс в users - производное значение
+CREATE TABLE IF NOT EXISTS stars_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,  -- Telegram user ID
+    idempotency_key VARCHAR(128) NOT NULL,  -- Ключ операции: повтор с тем же ключом не применяется
+    stars_delta INTEGER NOT NULL,  -- Изменение баланса звезд (+ начисление, - списание)
+    spent_delta INTEGER NOT NULL DEFAULT 0,  -- Изменение суммы потраченного
+    reason VARCHAR(32) NOT NULL,  -- purchase, gift, refund, adjustment
+    order_id BIGINT,  -- Заказ, к которому относится операция
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP  -- Время операции
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_stars_ledger_idempotency_key ON stars_ledger(idempotency_key);
+CREATE INDEX IF NOT EXISTS idx_stars_ledger_user_id ON stars_ledger(user_id, id);
+
+-- Свертка журнала по пользователям, которую ведет задача сверки
+CREATE TABLE IF NOT EXISTS stars_ledger_rollup (
+    user_id BIGINT PRIMARY KEY,  -- Telegram user ID
+    stars_balance BIGINT NOT NULL DEFAULT 0,  -- Сумма stars_delta
+    total_spent BIGINT NOT NULL DEFAULT 0,  -- Сумма spent_delta
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP  -- Время последней свертки
+);
+
+-- До какой записи журнала свертка уже выполнена
+CREATE TABLE IF NOT EXISTS stars_ledger_watermark (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    last_ledger_id BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO stars_ledger_watermark (id, last_ledger_id) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;
+
+-- Баланс не может уйти в минус: операция, которая это сделала бы, откатывается целиком
+ALTER TABLE users ADD CONSTRAINT users_stars_balance_non_negative CHECK (stars_balance >= 0) NOT VALID;
@@ -0,0 +1,27 @@
+-- Пользователи, заблокировавшие бота, пропускаются при рассылках
+ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP;  -- Когда Telegram ответил, что бот заблокирован (NULL - не заблокирован)
+
+-- Рассылки по пользователям
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id BIGSERIAL PRIMARY KEY,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',  -- pending, running, finished, cancelled
+    text TEXT NOT NULL,  -- Текст сообщения
+    parse_mode VARCHAR(16),  -- HTML, Markdown или NULL
+    language_code VARCHAR(10),  -- Фильтр по языку (NULL - все)
+    is_premium BOOLEAN,  -- Фильтр по Telegram Premium (NULL - все)
+    created_from TIMESTAMP,  -- Фильтр: зарегистрированы не раньше
+    created_to TIMESTAMP,  -- Фильтр: зарегистрированы раньше
+    last_user_id BIGINT NOT NULL DEFAULT 0,  -- Контрольная точка: последний обработанный user ID
+    sent INTEGER NOT NULL DEFAULT 0,  -- Доставлено
+    failed INTEGER NOT NULL DEFAULT 0,  -- Ошибки отправки
+    blocked INTEGER NOT NULL DEFAULT 0,  -- Пользователи, заблокировавшие бота
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- Время создания
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- Время последнего обновления
+    finished_at TIMESTAMP  -- Время завершения
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status, id);
+
+DROP TRIGGER IF EXISTS update_broadcasts_updated_at ON broadcasts;
+CREATE TRIGGER update_broadcasts_updated_at BEFORE UPDATE ON broadcasts
+FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
@@ -0,0 +1,108 @@
+-- Счетчики пользователей для /stats: поддерживаются триггерами на users,
+-- поэтому статистика читается без сканирования таблицы пользователей
+
+-- Число пользователей по языку и Telegram Premium
+CREATE TABLE IF NOT EXISTS user_stats (
+    language_code VARCHAR(10) NOT NULL,  -- Код языка ('' - не указан)
+    is_premium BOOLEAN NOT NULL,  -- Наличие Telegram Premium
+    users BIGINT NOT NULL DEFAULT 0,  -- Число пользователей
+    PRIMARY KEY (language_code, is_premium)
+);
+
+-- Новые пользователи по дням регистрации
+CREATE TABLE IF NOT EXISTS user_stats_daily (
+    day DATE PRIMARY KEY,  -- Дата регистрации
+    new_users BIGINT NOT NULL DEFAULT 0  -- Число зарегистрированных в этот день
+);
+
+-- Вставка: одна агрегированная запись на группу за весь оператор (в том числе пакетный upsert)
+CREATE OR REPLACE FUNCTION user_stats_on_insert()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO user_stats AS s (language_code, is_premium, users)
+    SELECT COALESCE(language_code, ''), COALESCE(is_premium, FALSE), COUNT(*)
+    FROM inserted_users
+    GROUP BY 1, 2
+    ON CONFLICT (language_code, is_premium) DO UPDATE SET users = s.users + EXCLUDED.users;
+
+    INSERT INTO user_stats_daily AS d (day, new_users)
+    SELECT created_at::date, COUNT(*)
+    FROM inserted_users
+    WHERE created_at IS NOT NULL
+    GROUP BY 1
+    ON CONFLICT (day) DO UPDATE SET new_users = d.new_users + EXCLUDED.new_users;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Удаление: вычитаем удаленных пользователей из их групп и дней
+CREATE OR REPLACE FUNCTION user_stats_on_delete()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE user_stats s SET users = s.users - deleted.users
+    FROM (
+        SELECT COALESCE(language_code, '') AS language_code, COALESCE(is_premium, FALSE) AS is_premium, COUNT(*) AS users
+        FROM deleted_users
+        GROUP BY 1, 2
+    ) deleted
+    WHERE s.language_code = deleted.language_code AND s.is_premium = deleted.is_premium;
+
+    UPDATE user_stats_daily d SET new_users = d.new_users - deleted.new_users
+    FROM (
+        SELECT created_at::date AS day, COUNT(*) AS new_users
+        FROM deleted_users
+        WHERE created_at IS NOT NULL
+        GROUP BY 1
+    ) deleted
+    WHERE d.day = deleted.day;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Обновление: переносим пользователя между группами, только если сменился язык или Premium
+CREATE OR REPLACE FUNCTION user_stats_on_update()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE user_stats SET users = users - 1
+    WHERE language_code = COALESCE(OLD.language_code, '') AND is_premium = COALESCE(OLD.is_premium, FALSE);
+
+    INSERT INTO user_stats AS s (language_code, is_premium, users)
+    VALUES (COALESCE(NEW.language_code, ''), COALESCE(NEW.is_premium, FALSE), 1)
+    ON CONFLICT (language_code, is_premium) DO UPDATE SET users = s.users + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Пока строятся счетчики, изменения users ждут (чтобы ни одно не потерялось)
+LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE;
+
+DROP TRIGGER IF EXISTS user_stats_insert ON users;
+CREATE TRIGGER user_stats_insert AFTER INSERT ON users
+REFERENCING NEW TABLE AS inserted_users
+FOR EACH STATEMENT EXECUTE FUNCTION user_stats_on_insert();
+
+DROP TRIGGER IF EXISTS user_stats_delete ON users;
+CREATE TRIGGER user_stats_delete AFTER DELETE ON users
+REFERENCING OLD TABLE AS deleted_users
+FOR EACH STATEMENT EXECUTE FUNCTION user_stats_on_delete();
+
+DROP TRIGGER IF EXISTS user_stats_update ON users;
+CREATE TRIGGER user_stats_update AFTER UPDATE OF language_code, is_premium ON users
+FOR EACH ROW
+WHEN (COALESCE(OLD.language_code, '') IS DISTINCT FROM COALESCE(NEW.language_code, '')
+      OR COALESCE(OLD.is_premium, FALSE) IS DISTINCT FROM COALESCE(NEW.is_premium, FALSE))
+EXECUTE FUNCTION user_stats_on_update();
+
+-- Начальные значения по уже зарегистрированным пользователям
+DELETE FROM user_stats;
+INSERT INTO user_stats (language_code, is_premium, users)
+SELECT COALESCE(language_code, ''), COALESCE(is_premium, FALSE), COUNT(*)
+FROM users
+GROUP BY 1, 2;
+
+DELETE FROM user_stats_daily;
+INSERT INTO user_stats_daily (day, new_users)
+SELECT created_at::date, COUNT(*)
+FROM users
+WHERE created_at IS NOT NULL
+GROUP BY 1;
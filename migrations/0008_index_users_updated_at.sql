@@ -0,0 +1,2 @@
+-- Индекс для инкрементальной выгрузки пользователей по updated_at (user_transfer.py export --since)
+CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users(updated_at);
@@ -0,0 +1,111 @@
+-- Счетчики user_stats и user_stats_daily разбиваются на 16 строк на ключ (shard = id % 16):
+-- одновременные регистрации разных пользователей обновляют разные строки и не ждут
+-- друг друга на одной блокировке. /stats суммирует строки ключа при чтении.
+-- Все триггеры обновляют строки счетчиков в порядке ключа, поэтому встречные
+-- изменения (перенос пользователя из группы A в B и из B в A) не дают взаимной блокировки.
+
+-- Пока перестраиваются счетчики, изменения users ждут (чтобы ни одно не потерялось)
+LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE;
+
+ALTER TABLE user_stats ADD COLUMN IF NOT EXISTS shard SMALLINT NOT NULL DEFAULT 0;  -- Строка счетчика: id % 16
+ALTER TABLE user_stats DROP CONSTRAINT IF EXISTS user_stats_pkey;
+ALTER TABLE user_stats ADD PRIMARY KEY (language_code, is_premium, shard);
+
+ALTER TABLE user_stats_daily ADD COLUMN IF NOT EXISTS shard SMALLINT NOT NULL DEFAULT 0;  -- Строка счетчика: id % 16
+ALTER TABLE user_stats_daily DROP CONSTRAINT IF EXISTS user_stats_daily_pkey;
+ALTER TABLE user_stats_daily ADD PRIMARY KEY (day, shard);
+
+-- Вставка: одна запись на группу и строку счетчика за весь оператор
+CREATE OR REPLACE FUNCTION user_stats_on_insert()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO user_stats AS s (language_code, is_premium, shard, users)
+    SELECT COALESCE(language_code, ''), COALESCE(is_premium, FALSE), id % 16, COUNT(*)
+    FROM inserted_users
+    GROUP BY 1, 2, 3
+    ORDER BY 1, 2, 3
+    ON CONFLICT (language_code, is_premium, shard) DO UPDATE SET users = s.users + EXCLUDED.users;
+
+    INSERT INTO user_stats_daily AS d (day, shard, new_users)
+    SELECT created_at::date, id % 16, COUNT(*)
+    FROM inserted_users
+    WHERE created_at IS NOT NULL
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    ON CONFLICT (day, shard) DO UPDATE SET new_users = d.new_users + EXCLUDED.new_users;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Удаление: вычитаем удаленных пользователей из их групп и дней
+CREATE OR REPLACE FUNCTION user_stats_on_delete()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO user_stats AS s (language_code, is_premium, shard, users)
+    SELECT COALESCE(language_code, ''), COALESCE(is_premium, FALSE), id % 16, -COUNT(*)
+    FROM deleted_users
+    GROUP BY 1, 2, 3
+    ORDER BY 1, 2, 3
+    ON CONFLICT (language_code, is_premium, shard) DO UPDATE SET users = s.users + EXCLUDED.users;
+
+    INSERT INTO user_stats_daily AS d (day, shard, new_users)
+    SELECT created_at::date, id % 16, -COUNT(*)
+    FROM deleted_users
+    WHERE created_at IS NOT NULL
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+    ON CONFLICT (day, shard) DO UPDATE SET new_users = d.new_users + EXCLUDED.new_users;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Обновление: переносим пользователя между группами (язык, Premium) и днями (created_at,
+-- например после import_users). Обе строки счетчика меняются одним оператором в порядке ключа.
+CREATE OR REPLACE FUNCTION user_stats_on_update()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF (COALESCE(OLD.language_code, ''), COALESCE(OLD.is_premium, FALSE))
+       IS DISTINCT FROM (COALESCE(NEW.language_code, ''), COALESCE(NEW.is_premium, FALSE)) THEN
+        INSERT INTO user_stats AS s (language_code, is_premium, shard, users)
+        SELECT language_code, is_premium, NEW.id % 16, delta
+        FROM (VALUES
+            (COALESCE(OLD.language_code, ''), COALESCE(OLD.is_premium, FALSE), -1),
+            (COALESCE(NEW.language_code, ''), COALESCE(NEW.is_premium, FALSE), 1)
+        ) AS change(language_code, is_premium, delta)
+        ORDER BY 1, 2
+        ON CONFLICT (language_code, is_premium, shard) DO UPDATE SET users = s.users + EXCLUDED.users;
+    END IF;
+
+    IF OLD.created_at::date IS DISTINCT FROM NEW.created_at::date THEN
+        INSERT INTO user_stats_daily AS d (day, shard, new_users)
+        SELECT day, NEW.id % 16, delta
+        FROM (VALUES (OLD.created_at::date, -1), (NEW.created_at::date, 1)) AS change(day, delta)
+        WHERE day IS NOT NULL
+        ORDER BY 1
+        ON CONFLICT (day, shard) DO UPDATE SET new_users = d.new_users + EXCLUDED.new_users;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_stats_update ON users;
+CREATE TRIGGER user_stats_update AFTER UPDATE OF language_code, is_premium, created_at ON users
+FOR EACH ROW
+WHEN (COALESCE(OLD.language_code, '') IS DISTINCT FROM COALESCE(NEW.language_code, '')
+      OR COALESCE(OLD.is_premium, FALSE) IS DISTINCT FROM COALESCE(NEW.is_premium, FALSE)
+      OR OLD.created_at::date IS DISTINCT FROM NEW.created_at::date)
+EXECUTE FUNCTION user_stats_on_update();
+
+-- Пересчитываем счетчики по строкам (в том числе дни, которые могли устареть после import_users)
+DELETE FROM user_stats;
+INSERT INTO user_stats (language_code, is_premium, shard, users)
+SELECT COALESCE(language_code, ''), COALESCE(is_premium, FALSE), id % 16, COUNT(*)
+FROM users
+GROUP BY 1, 2, 3;
+
+DELETE FROM user_stats_daily;
+INSERT INTO user_stats_daily (day, shard, new_users)
+SELECT created_at::date, id % 16, COUNT(*)
+FROM users
+WHERE created_at IS NOT NULL
+GROUP BY 1, 2;
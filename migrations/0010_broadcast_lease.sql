@@ -0,0 +1,4 @@
+-- Владелец рассылки: running-рассылку отправляет только один процесс. Другой процесс
+-- забирает ее, только если владелец давно не обновлял heartbeat_at (упал или завис)
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(128);  -- Процесс, который отправляет рассылку (хост:pid:случайный суффикс)
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP;  -- Когда владелец последний раз подтвердил, что рассылка идет
@@ -0,0 +1,327 @@
+"""
+Планировщик исходящих сообщений с учетом лимитов Telegram
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше - раньше
+PRIORITY_INTERACTIVE = 0  # Ответы на действия пользователя
+PRIORITY_BULK = 10  # Рассылки и прочие фоновые сообщения
+
+# Параметры sendMessage, которые можно перенести в editMessageText
+_EDITABLE_FIELDS = {'chat_id', 'text', 'reply_markup', 'parse_mode', 'disable_web_page_preview'}
+
+# Сколько последних задержек отправки хранить для перцентилей
+_LATENCY_SAMPLES = 1000
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен (0 - доступен сейчас)"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Забрать токен (вызывать только если delay() == 0)"""
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Message:
+    """Исходящий вызов Bot API в очереди"""
+
+    __slots__ = ('method', 'kwargs', 'priority', 'seq', 'future', 'enqueued', 'coalesce_key', 'placeholder')
+
+    def __init__(self, method, kwargs, priority, seq, coalesce_key=None, placeholder=False):
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.coalesce_key = coalesce_key
+        self.placeholder = placeholder
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Chat:
+    """Очередь и лимит одного чата"""
+
+    __slots__ = ('queue', 'bucket', 'blocked_until', 'inflight', 'scheduled')
+
+    def __init__(self, rate, burst):
+        self.queue = []
+        self.bucket = TokenBucket(rate, burst)
+        self.blocked_until = 0.0
+        self.inflight = False
+        self.scheduled = False
+
+
+class OutboundScheduler:
+    """
+    Очередь исходящих сообщений с глобальным и початовым ограничением скорости
+
+    - Глобальная корзина ограничивает общее число вызовов в секунду,
+      початовая - число сообщений в один чат.
+    - Сообщения одного чата уходят по одному и по порядку; среди ожидающих
+      раньше уходят интерактивные ответы, затем массовые сообщения.
+    - Ответ 429 (RetryAfter) не блокирует поток обработчика: сообщение
+      возвращается в начало очереди чата, чат ставится на паузу на retry_after.
+    - Правки одного и того же сообщения, ожидающие отправки, схлопываются
+      в последнюю. Правка-заглушка (placeholder=True), за которой в тот же чат
+      идет новое сообщение, заменяется одной правкой с текстом этого сообщения,
+      если у него нет reply-клавиатуры.
+    """
+
+    def __init__(self, bot, global_rate=30.0, chat_rate=1.0, chat_burst=3, workers=8):
+        self._bot = bot
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._chats = {}
+        self._ready = []  # (priority, seq, chat_id) - чаты, готовые к отправке
+        self._delayed = []  # (время, chat_id) - чаты, ждущие токен или конец паузы
+        self._pending = {}  # coalesce_key -> _Message
+        self._stopped = False
+
+        self._sender = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbound')
+        self._thread = threading.Thread(target=self._run, name='outbound-scheduler', daemon=True)
+
+        # Статистика
+        self._queue_depth = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+        self._counters = {'sent': 0, 'failed': 0, 'retry_after': 0, 'coalesced': 0}
+        self._latencies = deque(maxlen=_LATENCY_SAMPLES)
+
+        self._thread.start()
+
+    def send_message(self, chat_id, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """
+        Поставить в очередь sendMessage
+
+        Returns:
+            Future: отправленное сообщение (telegram.Message)
+        """
+        kwargs.update(chat_id=chat_id, text=text)
+        return self._submit(chat_id, 'send_message', kwargs, priority)
+
+    def edit_message_text(self, chat_id, message_id, text, placeholder=False,
+                          priority=PRIORITY_INTERACTIVE, **kwargs):
+        """
+        Поставить в очередь editMessageText
+
+        Args:
+            placeholder: правка-заглушка ("Обработка..."), которую можно заменить
+                следующим сообщением в этот чат, если она еще не отправлена
+
+        Returns:
+            Future: отредактированное сообщение
+        """
+        kwargs.update(chat_id=chat_id, message_id=message_id, text=text)
+        return self._submit(chat_id, 'edit_message_text', kwargs, priority,
+                            coalesce_key=('edit', chat_id, message_id), placeholder=placeholder)
+
+    def _submit(self, chat_id, method, kwargs, priority, coalesce_key=None, placeholder=False):
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Очередь исходящих сообщений остановлена")
+
+            # Повторная правка того же сообщения заменяет ожидающую
+            previous = self._pending.get(coalesce_key) if coalesce_key else None
+            if previous is not None:
+                previous.kwargs = kwargs
+                previous.placeholder = placeholder
+                self._counters['coalesced'] += 1
+                return previous.future
+
+            # Новое сообщение после ожидающей заглушки - одна правка вместо двух вызовов
+            if method == 'send_message':
+                merged = self._merge_into_placeholder(chat_id, kwargs)
+                if merged is not None:
+                    return merged
+
+            message = _Message(method, kwargs, priority, next(self._seq), coalesce_key, placeholder)
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat(self._chat_rate, self._chat_burst)
+            heapq.heappush(chat.queue, message)
+            if coalesce_key:
+                self._pending[coalesce_key] = message
+            self._queue_depth[self._depth_key(priority)] += 1
+            self._schedule(chat_id, chat)
+            self._cond.notify()
+            return message.future
+
+    def _merge_into_placeholder(self, chat_id, kwargs):
+        chat = self._chats.get(chat_id)
+        markup = kwargs.get('reply_markup')
+        if chat is None or not chat.queue:
+            return None
+        if not (markup is None or isinstance(markup, InlineKeyboardMarkup)):
+            return None
+        if set(kwargs) - _EDITABLE_FIELDS:
+            return None
+        # Заменять можно только последнюю заглушку в очереди чата, иначе нарушится порядок
+        last = max(chat.queue, key=lambda message: message.seq)
+        if not last.placeholder:
+            return None
+        last.kwargs = dict(kwargs, message_id=last.kwargs['message_id'])
+        last.placeholder = False
+        self._counters['coalesced'] += 1
+        return last.future
+
+    @staticmethod
+    def _depth_key(priority):
+        return PRIORITY_INTERACTIVE if priority <= PRIORITY_INTERACTIVE else PRIORITY_BULK
+
+    def _schedule(self, chat_id, chat):
+        """Поставить чат в очередь готовых (под блокировкой)"""
+        if chat.scheduled or chat.inflight or not chat.queue:
+            return
+        chat.scheduled = True
+        head = chat.queue[0]
+        heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                message, chat_id = self._next_message()
+                if message is None:
+                    return
+            self._sender.submit(self._send, chat_id, message)
+
+    def _next_message(self):
+        """Дождаться следующего сообщения, которое можно отправить (под блокировкой)"""
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, chat_id = heapq.heappop(self._delayed)
+                chat = self._chats.get(chat_id)
+                if chat is not None:
+                    chat.scheduled = False
+                    self._schedule(chat_id, chat)
+
+            if not self._ready:
+                if self._stopped and not self._delayed and not any(c.inflight for c in self._chats.values()):
+                    return None, None
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout if not self._stopped else min(timeout or 0.1, 0.1))
+                continue
+
+            global_delay = self._global.delay(now)
+            if global_delay > 0:
+                self._cond.wait(global_delay)
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            chat_delay = max(chat.bucket.delay(now), chat.blocked_until - now)
+            if chat_delay > 0:
+                heapq.heappush(self._delayed, (now + chat_delay, chat_id))
+                continue
+
+            chat.scheduled = False
+            message = heapq.heappop(chat.queue)
+            if message.coalesce_key:
+                self._pending.pop(message.coalesce_key, None)
+            self._queue_depth[self._depth_key(message.priority)] -= 1
+            self._global.take(now)
+            chat.bucket.take(now)
+            chat.inflight = True
+            return message, chat_id
+
+    def _send(self, chat_id, message):
+        try:
+            result = getattr(self._bot, message.method)(**message.kwargs)
+        except RetryAfter as e:
+            logger.warning("Лимит Telegram для чата %s, повтор через %s с", chat_id, e.retry_after,
+                           extra={'event': 'outbound_retry_after'})
+            with self._cond:
+                self._counters['retry_after'] += 1
+                chat = self._chats[chat_id]
+                chat.blocked_until = time.monotonic() + e.retry_after
+                heapq.heappush(chat.queue, message)
+                self._queue_depth[self._depth_key(message.priority)] += 1
+                chat.inflight = False
+                self._schedule(chat_id, chat)
+                self._cond.notify()
+            return
+        except Exception as e:
+            logger.error("Ошибка при отправке сообщения в чат %s: %s", chat_id, e,
+                         extra={'event': 'outbound_failed'})
+            message.future.set_exception(e)
+            failed = True
+        else:
+            message.future.set_result(result)
+            failed = False
+
+        with self._cond:
+            self._counters['failed' if failed else 'sent'] += 1
+            self._latencies.append(time.monotonic() - message.enqueued)
+            chat = self._chats[chat_id]
+            chat.inflight = False
+            if chat.queue:
+                self._schedule(chat_id, chat)
+            elif chat.blocked_until <= time.monotonic():
+                # Пустые чаты не храним, чтобы память не росла с числом пользователей
+                del self._chats[chat_id]
+            self._cond.notify()
+
+    def stop(self):
+        """Отправить все, что уже в очереди, и остановиться"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        self._sender.shutdown(wait=True)
+
+    def stats(self):
+        """
+        Статистика очереди
+
+        Returns:
+            dict: queue_depth, queue_depth_interactive, queue_depth_bulk, sent, failed,
+                  retry_after, coalesced, latency_p50, latency_p95, latency_max (секунды
+                  от постановки в очередь до ответа Telegram)
+        """
+        with self._cond:
+            latencies = sorted(self._latencies)
+            stats = dict(self._counters)
+            stats['queue_depth_interactive'] = self._queue_depth[PRIORITY_INTERACTIVE]
+            stats['queue_depth_bulk'] = self._queue_depth[PRIORITY_BULK]
+        stats['queue_depth'] = stats['queue_depth_interactive'] + stats['queue_depth_bulk']
+        if latencies:
+            stats['latency_p50'] = latencies[len(latencies) // 2]
+            stats['latency_p95'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            stats['latency_max'] = latencies[-1]
+        else:
+            stats['latency_p50'] = stats['latency_p95'] = stats['latency_max'] = 0.0
+        return stats
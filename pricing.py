@@ -0,0 +1,144 @@
+"""
+Расчет стоимости звезд по тарифам из базы данных
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from decimal import Decimal, ROUND_CEILING
+
+from database import load_tariffs, tariffs_version
+
+logger = logging.getLogger(__name__)
+
+# Допустимое количество звезд в одном заказе
+MIN_STARS = 50
+MAX_STARS = 10000
+
+# Цена округляется в большую сторону до целых рублей
+_COST_STEP = Decimal('1')
+
+# Расчет стоимости: количество звезд, цена за звезду, итоговая стоимость в рублях
+Quote = namedtuple('Quote', ['amount', 'price_per_star', 'cost'])
+
+
+def format_price(price):
+    """Цена без лишних нулей: Decimal('1.4700') -> '1.47', Decimal('2.00') -> '2'"""
+    text = f"{price:f}"
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    return text
+
+
+def build_quote_table(tariffs, min_amount=MIN_STARS, max_amount=MAX_STARS):
+    """
+    Рассчитать стоимость для каждого допустимого количества звезд
+
+    Для каждого количества выбирается подходящий по диапазону тариф с наибольшим
+    приоритетом (при равном приоритете - с меньшей ценой).
+
+    Args:
+        tariffs: список dict с ключами min_amount, max_amount, price_per_star, priority
+        min_amount: минимальное количество звезд
+        max_amount: максимальное количество звезд
+
+    Returns:
+        tuple: Quote для каждого количества, начиная с min_amount (None, если тарифа нет)
+    """
+    ordered = sorted(
+        tariffs,
+        key=lambda tariff: (-tariff.get('priority', 0), Decimal(tariff['price_per_star'])),
+    )
+    table = []
+    for amount in range(min_amount, max_amount + 1):
+        quote = None
+        for tariff in ordered:
+            if amount < tariff['min_amount']:
+                continue
+            if tariff['max_amount'] is not None and amount > tariff['max_amount']:
+                continue
+            price = Decimal(tariff['price_per_star'])
+            cost = (price * amount).quantize(_COST_STEP, rounding=ROUND_CEILING)
+            quote = Quote(amount, price, cost)
+            break
+        table.append(quote)
+    return tuple(table)
+
+
+class PricingEngine:
+    """
+    Таблица цен, рассчитанная заранее для всех допустимых количеств звезд
+
+    quote() - поиск в готовой таблице без обращения к базе. refresh() одним
+    запросом проверяет, менялись ли тарифы (или началась/закончилась акция),
+    и при необходимости строит новую таблицу и подменяет ее целиком.
+    """
+
+    def __init__(self, default_price, min_amount=MIN_STARS, max_amount=MAX_STARS,
+                 loader=load_tariffs, version_func=tariffs_version):
+        """
+        Args:
+            default_price: цена за звезду, пока тарифы не загружены из базы
+            min_amount, max_amount: диапазон допустимого количества звезд
+            loader: функция загрузки тарифов (см. database.load_tariffs)
+            version_func: функция отпечатка тарифов (см. database.tariffs_version)
+        """
+        self.min_amount = min_amount
+        self.max_amount = max_amount
+        self._loader = loader
+        self._version_func = version_func
+        self._reload_lock = threading.Lock()
+        self._version = None
+        self._next_change_at = None
+        self._table = build_quote_table(
+            [{'min_amount': min_amount, 'max_amount': None, 'price_per_star': Decimal(default_price), 'priority': 0}],
+            min_amount, max_amount,
+        )
+
+    def quote(self, amount):
+        """
+        Стоимость заказа
+
+        Args:
+            amount: количество звезд
+
+        Returns:
+            Quote: расчет стоимости
+
+        Raises:
+            ValueError: если количество вне допустимого диапазона или для него нет тарифа
+        """
+        if not self.min_amount <= amount <= self.max_amount:
+            raise ValueError(f"Количество звезд должно быть от {self.min_amount} до {self.max_amount}")
+        quote = self._table[amount - self.min_amount]
+        if quote is None:
+            raise ValueError(f"Нет тарифа для {amount} звезд")
+        return quote
+
+    def reload(self):
+        """Загрузить тарифы из базы и подменить таблицу цен"""
+        with self._reload_lock:
+            loaded = self._loader()
+            table = build_quote_table(loaded['tariffs'], self.min_amount, self.max_amount)
+            # Подмена ссылки атомарна: читатели видят либо старую, либо новую таблицу целиком
+            self._table = table
+            self._version = loaded['version']
+            next_change_in = loaded['next_change_in']
+            self._next_change_at = time.monotonic() + next_change_in if next_change_in is not None else None
+        missing = sum(1 for quote in table if quote is None)
+        if missing:
+            logger.warning(f"Для {missing} значений количества звезд нет действующего тарифа")
+        logger.info(f"Тарифы загружены: {len(loaded['tariffs'])}")
+
+    def refresh(self):
+        """
+        Перезагрузить тарифы, если они изменились или наступило время начала/окончания акции
+
+        Returns:
+            bool: True если таблица цен перестроена
+        """
+        due = self._next_change_at is not None and time.monotonic() >= self._next_change_at
+        if not due and self._version is not None and self._version_func() == self._version:
+            return False
+        self.reload()
+        return True
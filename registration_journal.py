@@ -0,0 +1,150 @@
+"""
+Локальный журнал регистраций на время недоступности базы данных
+"""
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class RegistrationJournal:
+    """
+    Файл, в который дописываются регистрации, пока база недоступна
+
+    Каждая запись - строка JSON с кортежем из user_row() и временем записи.
+    replay() переименовывает файл, сохраняет записи пачками (для каждого
+    пользователя - только последнюю) и удаляет файл после успешной записи.
+    Если сохранить не удалось, файл остается и будет обработан при следующем
+    вызове replay(). Запись в базу - upsert с проверкой времени, поэтому
+    повторное воспроизведение ничего не портит.
+    """
+
+    def __init__(self, path, fsync=False):
+        """
+        Args:
+            path: путь к файлу журнала
+            fsync: сбрасывать каждую запись на диск (надежнее, но медленнее)
+        """
+        self.path = path
+        self.replay_path = path + '.replay'
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._file = None
+        self._appended = 0
+        self._replayed = 0
+
+    def append(self, row):
+        """Дописать регистрацию в журнал"""
+        line = json.dumps({'row': list(row), 'ts': time.time()}, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = self._open()
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._appended += 1
+
+    def _open(self):
+        """Открыть файл на дозапись; недописанную после аварии строку завершаем"""
+        f = open(self.path, 'a+b')
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        f.close()
+        return open(self.path, 'a', encoding='utf-8')
+
+    def stats(self):
+        """
+        Статистика
+
+        Returns:
+            dict: appended (записано в журнал), replayed (сохранено в базу)
+        """
+        with self._lock:
+            return {'appended': self._appended, 'replayed': self._replayed}
+
+    def has_pending(self):
+        """Есть ли записи для воспроизведения"""
+        return os.path.exists(self.replay_path) or (
+            os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        )
+
+    def _rotate(self):
+        """Переименовать текущий файл, чтобы новые записи шли в новый"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.path):
+                os.replace(self.path, self.replay_path)
+
+    def _read(self):
+        """
+        Последняя запись для каждого пользователя из файла воспроизведения
+
+        Returns:
+            list: (кортеж из user_row(), время записи datetime)
+        """
+        entries = {}
+        with open(self.replay_path, encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                    row = tuple(record['row'])
+                    observed_at = datetime.fromtimestamp(record['ts'], timezone.utc)
+                except (ValueError, TypeError, KeyError):
+                    # Недописанная строка после аварийной остановки
+                    logger.warning(f"Пропущена поврежденная строка {number} журнала {self.replay_path}")
+                    continue
+                entries[row[0]] = (row, observed_at)
+        return list(entries.values())
+
+    def replay(self, flush_func, batch_size=1000):
+        """
+        Сохранить записи журнала в базу
+
+        Args:
+            flush_func: функция, сохраняющая список (строка, время записи) (replay_users)
+            batch_size: сколько пользователей сохранять одним вызовом
+
+        Returns:
+            int: сколько пользователей сохранено
+        """
+        with self._replay_lock:
+            if not self.has_pending():
+                return 0
+            # Файл, не обработанный в прошлый раз, сначала дописываем к новому
+            if os.path.exists(self.replay_path) and os.path.exists(self.path):
+                with self._lock:
+                    if self._file is not None:
+                        self._file.close()
+                        self._file = None
+                    with open(self.path, encoding='utf-8') as src, \
+                            open(self.replay_path, 'a', encoding='utf-8') as dst:
+                        dst.writelines(src)
+                    os.remove(self.path)
+            elif not os.path.exists(self.replay_path):
+                self._rotate()
+
+            entries = self._read()
+            for start in range(0, len(entries), batch_size):
+                flush_func(entries[start:start + batch_size])
+            os.remove(self.replay_path)
+            with self._lock:
+                self._replayed += len(entries)
+        logger.info(f"Из журнала {self.path} воспроизведено пользователей: {len(entries)}")
+        return len(entries)
+
+    def close(self):
+        """Закрыть файл журнала"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
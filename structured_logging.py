@@ -0,0 +1,210 @@
+"""
+Асинхронное структурированное логирование
+
+Обработчики Telegram только кладут запись в очередь; форматирование в JSON
+и запись в поток вывода выполняет фоновый поток. Частые события (регистрации,
+обработанные обновления) можно записывать выборочно; WARNING и выше
+пишутся всегда, а ERROR и выше не теряются даже при переполненной очереди.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Поля записи, которые переносятся в JSON (передаются через extra= или bind())
+CONTEXT_FIELDS = ('event', 'user_id', 'handler', 'update_id', 'latency_ms')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_context = threading.local()
+
+
+def parse_sample_rates(value):
+    """
+    Доли записи событий из строки 'event=rate,event=rate'
+
+    Returns:
+        dict: событие -> доля от 0 до 1
+    """
+    rates = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        event, _, rate = item.partition('=')
+        rates[event.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+@contextmanager
+def bind(**fields):
+    """
+    Добавить поля (user_id, handler, ...) ко всем записям лога текущего потока
+
+    Используется на время обработки обновления.
+    """
+    previous = getattr(_context, 'fields', None)
+    _context.fields = dict(previous or {}, **fields)
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога в виде одной строки JSON"""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _SamplingQueueHandler(logging.Handler):
+    """
+    Кладет записи в очередь, не блокируя поток, который пишет в лог
+
+    Записи с полем event пишутся с долей из sample_rates (или default_rate);
+    WARNING и выше не отбрасываются никогда. Когда в очереди больше
+    queue_size записей, новые записи ниже ERROR отбрасываются, а ERROR и
+    выше все равно попадают в очередь (она не ограничена).
+    """
+
+    def __init__(self, log_queue, queue_size, default_rate=1.0, sample_rates=None):
+        super().__init__()
+        self.queue = log_queue
+        self.queue_size = queue_size
+        self.default_rate = default_rate
+        self.sample_rates = sample_rates or {}
+        self._stats_lock = threading.Lock()
+        self.sampled_out = 0
+        self.dropped = 0
+
+    def _keep(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        event = getattr(record, 'event', None)
+        if event is None:
+            return True
+        rate = self.sample_rates.get(event, self.default_rate)
+        return rate >= 1.0 or random.random() < rate
+
+    def emit(self, record):
+        fields = getattr(_context, 'fields', None)
+        if fields:
+            for name, value in fields.items():
+                if getattr(record, name, None) is None:
+                    setattr(record, name, value)
+
+        if not self._keep(record):
+            with self._stats_lock:
+                self.sampled_out += 1
+            return
+        if record.levelno < logging.ERROR and self.queue.qsize() >= self.queue_size:
+            with self._stats_lock:
+                self.dropped += 1
+            return
+
+        try:
+            # Подставляем аргументы сейчас: к моменту записи объекты могут измениться
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class LogPipeline:
+    """Очередь записей лога и фоновый поток, который пишет их в поток вывода"""
+
+    def __init__(self, level=logging.INFO, fmt='json', queue_size=10000, sample_rate=1.0,
+                 sample_rates=None, stream=None):
+        """
+        Args:
+            level: уровень корневого логгера
+            fmt: json или text
+            queue_size: сколько записей ниже ERROR держать в очереди
+            sample_rate: доля записываемых событий (записи с полем event)
+            sample_rates: доли для отдельных событий, dict
+            stream: куда писать (по умолчанию sys.stderr, как logging.basicConfig)
+        """
+        self._queue = queue.Queue()
+        self.handler = _SamplingQueueHandler(self._queue, queue_size, sample_rate, sample_rates)
+
+        output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+        self._listener = logging.handlers.QueueListener(self._queue, output)
+
+        self.level = level
+        self._started = False
+
+    def start(self):
+        """Заменить обработчики корневого логгера очередью и запустить поток записи"""
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+        self._listener.start()
+        self._started = True
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Записать оставшиеся записи и остановить поток записи"""
+        if not self._started:
+            return
+        self._started = False
+        logging.getLogger().removeHandler(self.handler)
+        self._listener.stop()
+
+    def stats(self):
+        """
+        Статистика
+
+        Returns:
+            dict: queue_depth, sampled_out (не записаны по выборке), dropped (очередь переполнена)
+        """
+        return {
+            'queue_depth': self._queue.qsize(),
+            'sampled_out': self.handler.sampled_out,
+            'dropped': self.handler.dropped,
+        }
+
+
+def setup_logging(level='INFO', fmt='json', queue_size=10000, sample_rate=1.0, sample_rates=None):
+    """
+    Настроить логирование процесса через очередь
+
+    Returns:
+        LogPipeline: запущенный конвейер (stop() вызывается и при выходе)
+    """
+    pipeline = LogPipeline(
+        level=logging.getLevelName(level.upper()) if isinstance(level, str) else level,
+        fmt=fmt,
+        queue_size=queue_size,
+        sample_rate=sample_rate,
+        sample_rates=sample_rates,
+    )
+    pipeline.start()
+    return pipeline
+
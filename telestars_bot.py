@@ -1,51 +1,199 @@
 import logging
-import math
-from telegram import ReplyKeyboardMarkup, Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
-from config import BOT_TOKEN
-from database import init_db, add_user
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import Future
+from telegram import Bot, Update
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler, TypeHandler, Dispatcher, JobQueue
+from telegram.utils.request import Request
+from config import (
+    BOT_TOKEN,
+    DB_WRITE_BEHIND,
+    DB_WRITE_BEHIND_BATCH,
+    DB_WRITE_BEHIND_INTERVAL,
+    DB_EXECUTOR_WORKERS,
+    DB_EXECUTOR_QUEUE_SIZE,
+    DB_TASK_TIMEOUT,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_QUEUE_SIZE,
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_CHAT_RATE,
+    OUTBOUND_CHAT_BURST,
+    OUTBOUND_WORKERS,
+    STATE_BACKEND,
+    STATE_SQLITE_PATH,
+    STATE_IDLE_TTL,
+    STATE_MAX_USERS,
+    ORDER_TTL,
+    ORDER_SWEEP_INTERVAL,
+    ORDER_SWEEP_BATCH,
+    PRICE_PER_STAR,
+    PRICING_RELOAD_INTERVAL,
+    LEDGER_RECONCILE_INTERVAL,
+    LEDGER_RECONCILE_LAG,
+    LEDGER_RECONCILE_REPAIR,
+    BROADCAST_POLL_INTERVAL,
+    BROADCAST_PAGE_SIZE,
+    BROADCAST_LEASE,
+    METRICS_LISTEN,
+    METRICS_PORT,
+    PROFILER_ENABLED,
+    PROFILER_INTERVAL,
+    PROFILER_TOP,
+    REGISTRATION_JOURNAL_PATH,
+    REGISTRATION_JOURNAL_FSYNC,
+    JOURNAL_REPLAY_INTERVAL,
+    JOURNAL_REPLAY_BATCH,
+    BOT_WORKERS,
+    WORKER_QUEUE_SIZE,
+    LOCALES_DIR,
+    DEFAULT_LOCALE,
+    LOG_LEVEL,
+    LOG_FORMAT,
+    LOG_QUEUE_SIZE,
+    LOG_SAMPLE_RATE,
+    LOG_SAMPLE_RATES,
+    ADMIN_IDS,
+    STATS_DAYS,
+)
+from database import add_user, add_users_bulk, get_user, get_user_stats, user_row, close_pool, create_order, expire_orders, reconcile_ledger, pool_stats, user_cache_stats, profile_write_stats, db_available, breaker_stats, is_connection_error, replay_users
+from write_behind import RegistrationBuffer
+from db_executor import KeyedExecutor
+from outbound import OutboundScheduler, PRIORITY_INTERACTIVE
+from conversation_state import StateStore, create_backend
+from pricing import PricingEngine, format_price, MIN_STARS, MAX_STARS
+from migrate import check_schema
+from webhook import WebhookServer
+from broadcast import BroadcastRunner
+from metrics import REGISTRY, PROFILER, MetricsServer, instrument
+from circuit_breaker import CircuitOpen
+from registration_journal import RegistrationJournal
+from workers import WorkerPool
+from templates import TemplateRegistry
+from structured_logging import setup_logging, parse_sample_rates
+
+# Настройка логирования: записи пишет фоновый поток, обработчики не ждут вывода
+log_pipeline = setup_logging(
+    level=LOG_LEVEL,
+    fmt=LOG_FORMAT,
+    queue_size=LOG_QUEUE_SIZE,
+    sample_rate=LOG_SAMPLE_RATE,
+    sample_rates=parse_sample_rates(LOG_SAMPLE_RATES)
 )
 logger = logging.getLogger(__name__)
 
+# Таблица цен; до загрузки тарифов из базы действует цена PRICE_PER_STAR
+pricing = PricingEngine(PRICE_PER_STAR)
+
+# Тексты и клавиатуры на всех языках, загружаются один раз при старте
+templates = TemplateRegistry(LOCALES_DIR, DEFAULT_LOCALE)
+
+
+def locale_for(update: Update):
+    """Тексты и клавиатуры на языке пользователя (по language_code из Telegram)"""
+    user = update.effective_user
+    return templates.get(user.language_code if user else None)
+
+
+def user_state(update: Update, context: CallbackContext):
+    """
+    Состояние диалога пользователя
+
+    Берется из хранилища состояний (загружается при первом обращении),
+    если оно не настроено - из context.user_data. Все обработчики одного
+    обновления получают один и тот же объект, даже если загрузка не удалась.
+    """
+    store = context.bot_data.get('state_store')
+    if store is None:
+        return context.user_data
+    # PTB создает один CallbackContext на обновление
+    state = getattr(context, 'conversation_state', None)
+    if state is None:
+        state = context.conversation_state = store.get(update.effective_user.id)
+    return state
+
+
+def flush_user_state(update: Update, context: CallbackContext) -> None:
+    """Записать изменения состояния пользователя после обработки обновления"""
+    store = context.bot_data.get('state_store')
+    if store is not None and update.effective_user:
+        store.flush(update.effective_user.id)
+
+
+def evict_idle_states(context: CallbackContext) -> None:
+    """Выгрузить из памяти состояния неактивных пользователей (задача JobQueue)"""
+    store = context.bot_data.get('state_store')
+    if store is None:
+        return
+    evicted = store.evict_idle()
+    if evicted:
+        logger.info(f"Выгружено неактивных состояний пользователей: {evicted}")
+
+    # Диспетчер заводит пустой user_data для каждого пользователя - не копим их
+    user_data = context.dispatcher.user_data
+    for user_id in [user_id for user_id, data in list(user_data.items()) if not data]:
+        user_data.pop(user_id, None)
+
+
+def _run_now(func, *args, **kwargs) -> Future:
+    """Выполнить функцию в текущем потоке и вернуть результат как Future"""
+    future = Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
 
-def get_reply_keyboard():
-    """Создает reply keyboard с основными кнопками"""
-    keyboard = [
-        ['⭐ Купить звезды', '💎 Купить Premium'],
-        ['👤 Профиль', '🆘 Поддержка']
-    ]
-    return ReplyKeyboardMarkup(
-        keyboard,
-        resize_keyboard=True,
-        one_time_keyboard=False
-    )
 
+def run_db(context: CallbackContext, user_id: int, func, *args) -> Future:
+    """
+    Выполнить запрос к базе данных в пуле потоков базы данных
 
-def get_stars_selection_keyboard():
-    """Создает inline keyboard для выбора количества звезд"""
-    keyboard = [
-        [
-            InlineKeyboardButton("⭐ 50", callback_data="stars_50"),
-            InlineKeyboardButton("⭐ 100", callback_data="stars_100")
-        ],
-        [
-            InlineKeyboardButton("⭐ 200", callback_data="stars_200"),
-            InlineKeyboardButton("⭐ 500", callback_data="stars_500")
-        ],
-        [
-            InlineKeyboardButton("⭐ 1000", callback_data="stars_1000"),
-            InlineKeyboardButton("⭐ 5000", callback_data="stars_5000")
-        ],
-        [
-            InlineKeyboardButton("🎁 В подарок", callback_data="stars_gift")
-        ]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    Запросы одного пользователя выполняются строго по порядку.
+    Если пул не настроен, запрос выполняется сразу в текущем потоке.
+    """
+    executor = context.bot_data.get('db_executor')
+    if executor is not None:
+        return executor.submit(user_id, func, *args)
+    return _run_now(func, *args)
+
+
+def send_message(context: CallbackContext, chat_id: int, text: str,
+                 priority: int = PRIORITY_INTERACTIVE, **kwargs) -> Future:
+    """
+    Отправить сообщение через очередь исходящих сообщений
+
+    Если очередь не настроена, сообщение отправляется сразу.
+    """
+    outbound = context.bot_data.get('outbound')
+    if outbound is not None:
+        return outbound.send_message(chat_id, text, priority=priority, **kwargs)
+    return _run_now(context.bot.send_message, chat_id=chat_id, text=text, **kwargs)
+
+
+def edit_message_text(context: CallbackContext, chat_id: int, message_id: int, text: str,
+                      placeholder: bool = False, **kwargs) -> Future:
+    """
+    Отредактировать сообщение через очередь исходящих сообщений
+
+    placeholder=True - временный текст ("Обработка..."), который очередь может
+    заменить следующим сообщением в этот чат.
+    """
+    outbound = context.bot_data.get('outbound')
+    if outbound is not None:
+        return outbound.edit_message_text(chat_id, message_id, text, placeholder=placeholder, **kwargs)
+    return _run_now(context.bot.edit_message_text, chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+
+
+def reply(update: Update, context: CallbackContext, text: str, **kwargs) -> Future:
+    """Ответить в чат, из которого пришло обновление"""
+    return send_message(context, update.effective_chat.id, text, **kwargs)
 
 
 def show_order_message(update: Update, context: CallbackContext, amount: int, is_gift: bool = False, chat_id: int = None) -> None:
@@ -62,126 +210,311 @@ def show_order_message(update: Update, context: CallbackContext, amount: int, is
         user = update.effective_user if not update.callback_query else update.callback_query.from_user
     
     username = user.username if user.username else "username"
+    locale = locale_for(update)
     
-    # Цена за одну звезду
-    price_per_star = 1.47
-    
-    # Рассчитываем стоимость
-    total_cost = amount * price_per_star
-    # Округляем в большую сторону
-    final_cost = math.ceil(total_cost)
+    # Стоимость берется из заранее рассчитанной таблицы цен (точная десятичная арифметика,
+    # округление в большую сторону до рубля)
+    try:
+        quote = pricing.quote(amount)
+    except ValueError as e:
+        logger.error("Не удалось рассчитать стоимость %s звезд: %s", amount, e,
+                     extra={'event': 'order_price_failed', 'user_id': user.id})
+        send_message(
+            context,
+            chat_id,
+            locale.text('order_price_unavailable'),
+            reply_markup=locale.main_keyboard
+        )
+        return
+    final_cost = quote.cost
+    price_per_star = format_price(quote.price_per_star)
     
     # Определяем получателя
-    if is_gift:
-        recipient_text = f"⭐ Звёзды для аккаунта @{username} (в подарок)"
-    else:
-        recipient_text = f"⭐ Звёзды для аккаунта @{username}"
-    
-    message = (
-        "⏳ Счёт активен 30 минут\n\n"
-        "🧾 Ваш заказ:\n"
-        f"{recipient_text}\n\n"
-        "💰 Стоимость:\n"
-        f" ⭐ Количество звезд = {final_cost} ₽ (исходя из цены {price_per_star} за звезду)\n"
-        "Итоговая сумма округлена в большую сторону\n\n"
-        "👇 Ссылка на оплату ниже"
+    recipient_text = locale.text('order_recipient_gift' if is_gift else 'order_recipient', username=username)
+    message = locale.text(
+        'order',
+        ttl_minutes=ORDER_TTL // 60,
+        recipient=recipient_text,
+        cost=final_cost,
+        price=price_per_star
     )
     
-    # Сохраняем информацию о заказе
-    context.user_data['current_order'] = {
+    # Счет показываем только после того, как заказ записан в базу.
+    # Дольше DB_TASK_TIMEOUT ответа не ждем
+    try:
+        order = run_db(
+            context, user.id, create_order, user.id, amount, final_cost, is_gift, ORDER_TTL
+        ).result(timeout=DB_TASK_TIMEOUT)
+    except Exception as e:
+        # Очередь запросов к базе переполнена, база недоступна или запрос не выполнился:
+        # сообщение заменит заглушку "Обработка заказа..."
+        logger.error("Ошибка при создании заказа пользователя %s: %s", user.id, e,
+                     extra={'event': 'order_failed', 'user_id': user.id})
+        send_message(
+            context,
+            chat_id,
+            locale.text('order_unavailable'),
+            reply_markup=None if update.callback_query else locale.main_keyboard
+        )
+        return
+
+    # Сохраняем информацию о заказе (со ссылкой на строку orders)
+    state = user_state(update, context)
+    state['current_order'] = {
+        'id': order['id'],
         'amount': amount,
-        'cost': final_cost,
-        'is_gift': is_gift
+        'cost': str(final_cost),
+        'is_gift': is_gift,
+        'expires_at': order['expires_at'].isoformat()
     }
     
-    # Отправляем сообщение
-    context.bot.send_message(
-        chat_id=chat_id,
-        text=message,
-        reply_markup=get_reply_keyboard()
+    # Отправляем сообщение. После inline-кнопки reply-клавиатура уже на экране,
+    # а без нее заказ можно показать одной правкой сообщения-заглушки
+    send_message(
+        context,
+        chat_id,
+        message,
+        reply_markup=None if update.callback_query else locale.main_keyboard
     )
     
     # Сбрасываем состояние покупки
-    context.user_data.pop('buying_stars', None)
-    context.user_data.pop('stars_amount', None)
+    state.pop('buying_stars', None)
+    state.pop('stars_amount', None)
+
+
+def refresh_pricing(context: CallbackContext) -> None:
+    """Перестроить таблицу цен, если тарифы изменились (задача JobQueue)"""
+    try:
+        pricing.refresh()
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении тарифов: {e}")
+
+
+def expire_stale_orders(context: CallbackContext) -> None:
+    """Перевести просроченные заказы в статус expired (задача JobQueue)"""
+    try:
+        expire_orders(ORDER_SWEEP_BATCH)
+    except Exception as e:
+        logger.error(f"Ошибка при проверке просроченных заказов: {e}")
+
+
+def reconcile_stars_ledger(context: CallbackContext) -> None:
+    """Свернуть журнал звезд и сверить его с балансами пользователей (задача JobQueue)"""
+    try:
+        reconcile_ledger(LEDGER_RECONCILE_LAG, LEDGER_RECONCILE_REPAIR)
+    except Exception as e:
+        logger.error(f"Ошибка при сверке журнала звезд: {e}")
+
+
+def poll_broadcasts(context: CallbackContext) -> None:
+    """Запустить следующую рассылку, если есть (задача JobQueue)"""
+    try:
+        context.bot_data['broadcasts'].poll()
+    except Exception as e:
+        logger.error(f"Ошибка при запуске рассылки: {e}")
+
+
+def _database_down(error) -> bool:
+    """Запрос не выполнен из-за недоступности базы (а не из-за ошибки в самом запросе)"""
+    return isinstance(error, CircuitOpen) or is_connection_error(error)
+
+
+def _log_registration(user, future: Future, journal=None) -> None:
+    """Записать в лог результат сохранения пользователя (при потере связи с базой - в журнал)"""
+    try:
+        is_new_user = future.result()
+    except Exception as e:
+        if journal is None or not _database_down(e):
+            logger.error("Ошибка при сохранении пользователя %s в БД: %s", user.id, e,
+                         extra={'event': 'registration_failed', 'user_id': user.id})
+            return
+        journal.append(user_row(user))
+        logger.warning("База недоступна, пользователь %s записан в журнал: %s", user.id, e,
+                       extra={'event': 'registration_journaled', 'user_id': user.id})
+        return
+    if is_new_user:
+        logger.info("Новый пользователь зарегистрирован: %s (@%s)", user.id, user.username or 'без username',
+                    extra={'event': 'user_registered', 'user_id': user.id})
+    else:
+        logger.info("Пользователь обновлен: %s (@%s)", user.id, user.username or 'без username',
+                    extra={'event': 'user_reregistered', 'user_id': user.id})
+
+
+def save_registrations(journal, rows) -> None:
+    """
+    Сохранить пачку регистраций из буфера write-behind
+
+    Если база недоступна, регистрации дописываются в журнал и будут
+    сохранены, когда связь восстановится.
+    """
+    if journal is not None and not db_available():
+        for row in rows:
+            journal.append(row)
+        logger.warning("База недоступна, регистрации записаны в журнал: %s", len(rows),
+                       extra={'event': 'registrations_journaled'})
+        return
+    try:
+        add_users_bulk(rows)
+    except Exception as e:
+        if journal is None or not _database_down(e):
+            raise
+        for row in rows:
+            journal.append(row)
+        logger.warning("База недоступна, регистрации записаны в журнал: %s (%s)", len(rows), e,
+                       extra={'event': 'registrations_journaled'})
+
+
+def replay_registration_journal(context: CallbackContext) -> None:
+    """Сохранить в базу регистрации из журнала, когда база снова доступна (задача JobQueue)"""
+    journal = context.bot_data.get('journal')
+    if journal is None or not db_available() or not journal.has_pending():
+        return
+    try:
+        journal.replay(replay_users, JOURNAL_REPLAY_BATCH)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить регистрации из журнала: {e}")
 
 
 def start(update: Update, context: CallbackContext) -> None:
     """Обработчик команды /start"""
     user = update.effective_user
     
-    # Добавляем пользователя в базу данных
+    # Добавляем пользователя в базу данных; ответ не ждет завершения записи
     try:
-        is_new_user = add_user(user)
-        if is_new_user:
-            logger.info(f"Новый пользователь зарегистрирован: {user.id} (@{user.username or 'без username'})")
+        registrations = context.bot_data.get('registrations')
+        journal = context.bot_data.get('journal')
+        if journal is not None and not db_available():
+            # База недоступна: запись в локальный журнал, в базу попадет после восстановления
+            journal.append(user_row(user))
+            logger.info("База недоступна, пользователь записан в журнал: %s", user.id,
+                        extra={'event': 'registration_journaled'})
+        elif registrations is not None:
+            # Режим write-behind: запись уйдет в базу пачкой в фоне
+            registrations.add(user.id, user_row(user))
+            logger.info("Пользователь поставлен в очередь на сохранение: %s", user.id,
+                        extra={'event': 'registration_queued'})
         else:
-            logger.info(f"Пользователь обновлен: {user.id} (@{user.username or 'без username'})")
+            future = run_db(context, user.id, add_user, user)
+            future.add_done_callback(lambda f: _log_registration(user, f, journal))
     except Exception as e:
-        logger.error(f"Ошибка при сохранении пользователя в БД: {e}")
+        logger.error("Ошибка при сохранении пользователя %s в БД: %s", user.id, e,
+                     extra={'event': 'registration_failed', 'user_id': user.id})
     
-    welcome_message = (
-        f"Привет, {user.first_name}! 👋\n\n"
-        "Добро пожаловать в бот для покупки звезд Telegram! ⭐\n\n"
-        "Выберите действие из меню ниже:"
-    )
-    update.message.reply_text(
-        welcome_message,
-        reply_markup=get_reply_keyboard()
+    locale = locale_for(update)
+    reply(
+        update,
+        context,
+        locale.text('welcome', first_name=user.first_name),
+        reply_markup=locale.main_keyboard
     )
 
 
 def handle_buy_stars(update: Update, context: CallbackContext) -> None:
     """Обработчик кнопки '⭐ Купить звезды'"""
     # Устанавливаем состояние выбора количества звезд
-    context.user_data['buying_stars'] = True
-    context.user_data.pop('stars_amount', None)
+    state = user_state(update, context)
+    state['buying_stars'] = True
+    state.pop('stars_amount', None)
     
-    message = (
-        "⭐ Покупка звёзд\n\n"
-        "Выберите количество звёзд ниже\n"
-        "или введите число от 50 до 10 000\n\n"
-        "Хотите отправить звёзды другу?\n"
-        "Нажмите «🎁 В подарок»"
-    )
-    update.message.reply_text(
-        message,
-        reply_markup=get_stars_selection_keyboard()
+    locale = locale_for(update)
+    reply(
+        update,
+        context,
+        locale.text('buy_stars'),
+        reply_markup=locale.stars_keyboard
     )
 
 
 def handle_buy_premium(update: Update, context: CallbackContext) -> None:
     """Обработчик кнопки '💎 Купить Premium'"""
-    message = (
-        "💎 Купить Premium\n\n"
-        "Здесь будет функционал для покупки Telegram Premium.\n"
-        "Функция в разработке..."
-    )
-    update.message.reply_text(message)
+    reply(update, context, locale_for(update).text('buy_premium'))
 
 
 def handle_profile(update: Update, context: CallbackContext) -> None:
     """Обработчик кнопки '👤 Профиль'"""
     user = update.effective_user
-    message = (
-        f"👤 Профиль\n\n"
-        f"ID: {user.id}\n"
-        f"Имя: {user.first_name or 'Не указано'}\n"
-        f"Username: @{user.username if user.username else 'не указан'}\n\n"
-        "Здесь будет отображаться статистика и баланс."
+
+    # Данные берутся из кэша get_user, запрос в базу - только при промахе.
+    # Дольше DB_TASK_TIMEOUT ответа не ждем - показываем профиль без статистики
+    try:
+        db_user = run_db(context, user.id, get_user, user.id).result(timeout=DB_TASK_TIMEOUT)
+    except Exception as e:
+        logger.error("Не удалось получить профиль пользователя %s: %s", user.id, e,
+                     extra={'event': 'profile_failed', 'user_id': user.id})
+        db_user = None
+    locale = locale_for(update)
+    if db_user:
+        stats_text = locale.text(
+            'profile_stats',
+            balance=db_user.get('stars_balance') or 0,
+            spent=db_user.get('total_spent') or 0,
+            registered=locale.format_date(db_user.get('created_at'))
+        )
+    else:
+        stats_text = locale.text('profile_stats_unavailable')
+
+    message = locale.text(
+        'profile',
+        user_id=user.id,
+        first_name=user.first_name or locale.text('profile_no_first_name'),
+        username=user.username if user.username else locale.text('profile_no_username'),
+        stats=stats_text
     )
-    update.message.reply_text(message)
+    reply(update, context, message)
 
 
 def handle_support(update: Update, context: CallbackContext) -> None:
     """Обработчик кнопки '🆘 Поддержка'"""
-    message = (
-        "🆘 Поддержка\n\n"
-        "Если у вас возникли вопросы или проблемы, "
-        "свяжитесь с нашей службой поддержки.\n\n"
-        "Функция в разработке..."
+    reply(update, context, locale_for(update).text('support'))
+
+
+def _share(part, total) -> str:
+    """Доля в процентах с одним знаком после запятой"""
+    return f"{part * 100 / total:.1f}%" if total else "0%"
+
+
+def handle_stats(update: Update, context: CallbackContext) -> None:
+    """Обработчик команды /stats (только для ADMIN_IDS)"""
+    user = update.effective_user
+    locale = locale_for(update)
+    if user is None or user.id not in ADMIN_IDS:
+        reply(update, context, locale.text('use_menu'), reply_markup=locale.main_keyboard)
+        return
+
+    # Счетчики ведут триггеры базы, запрос не сканирует таблицу users
+    try:
+        stats = run_db(context, user.id, get_user_stats, STATS_DAYS).result(timeout=DB_TASK_TIMEOUT)
+    except Exception as e:
+        logger.error("Не удалось получить статистику пользователей: %s", e,
+                     extra={'event': 'stats_failed', 'user_id': user.id})
+        reply(update, context, locale.text('stats_unavailable'))
+        return
+
+    total = stats['total']
+    daily = stats['daily']
+    message = locale.text(
+        'stats',
+        total=total,
+        premium=stats['premium'],
+        premium_share=_share(stats['premium'], total),
+        today=daily[0][1] if daily else 0,
+        days=STATS_DAYS,
+        recent=sum(users for _, users in daily),
+        daily='\n'.join(
+            locale.text('stats_day', day=locale.format_date(day), users=users) for day, users in daily
+        ),
+        languages='\n'.join(
+            locale.text(
+                'stats_language',
+                language=language or locale.text('stats_no_language'),
+                users=users,
+                share=_share(users, total)
+            )
+            # Не больше 10 языков, чтобы сообщение не упиралось в лимит длины
+            for language, users in stats['languages'][:10]
+        )
     )
-    update.message.reply_text(message)
+    reply(update, context, message)
 
 
 def handle_callback_query(update: Update, context: CallbackContext) -> None:
@@ -190,129 +523,422 @@ def handle_callback_query(update: Update, context: CallbackContext) -> None:
     query.answer()
     
     callback_data = query.data
+    state = user_state(update, context)
+    locale = locale_for(update)
     
     if callback_data.startswith("stars_"):
         if callback_data == "stars_gift":
             # Устанавливаем флаг подарка и возвращаем к выбору количества
-            context.user_data['buying_stars'] = True
-            context.user_data['is_gift'] = True
-            query.edit_message_text(
-                "🎁 Отправка звёзд в подарок\n\n"
-                "Выберите количество звёзд ниже\n"
-                "или введите число от 50 до 10 000",
-                reply_markup=get_stars_selection_keyboard()
+            state['buying_stars'] = True
+            state['is_gift'] = True
+            edit_message_text(
+                context,
+                query.message.chat_id,
+                query.message.message_id,
+                locale.text('gift'),
+                reply_markup=locale.stars_keyboard
             )
         else:
             # Извлекаем количество звезд из callback_data
             amount = int(callback_data.split("_")[1])
             
             # Проверяем валидность количества
-            if amount < 50:
-                query.answer("❌ Минимум — 50 звёзд", show_alert=True)
+            if amount < MIN_STARS:
+                query.answer(locale.text('stars_below_min'), show_alert=True)
                 return
-            elif amount > 10000:
-                query.answer("❌ Максимум — 10 000 звёзд", show_alert=True)
+            elif amount > MAX_STARS:
+                query.answer(locale.text('stars_above_max'), show_alert=True)
                 return
             
             # Проверяем, является ли это подарком
-            is_gift = context.user_data.get('is_gift', False)
+            is_gift = state.get('is_gift', False)
             
             # Закрываем inline сообщение и показываем заказ
-            query.edit_message_text("✅ Обработка заказа...")
+            edit_message_text(
+                context,
+                query.message.chat_id,
+                query.message.message_id,
+                locale.text('order_processing'),
+                placeholder=True
+            )
             show_order_message(update, context, amount, is_gift, chat_id=query.message.chat_id)
             
             # Сбрасываем флаг подарка
-            context.user_data.pop('is_gift', None)
+            state.pop('is_gift', None)
 
 
 def handle_message(update: Update, context: CallbackContext) -> None:
     """Обработчик текстовых сообщений"""
     text = update.message.text
+    state = user_state(update, context)
+    locale = locale_for(update)
     
     # Проверяем, находится ли пользователь в процессе покупки звезд (выбор количества)
-    if context.user_data.get('buying_stars'):
+    if state.get('buying_stars'):
         # Проверяем, является ли введенный текст числом
         try:
             amount = int(text)
             
             # Проверка валидности количества
-            if amount < 50:
-                update.message.reply_text(
-                    "❌ Минимум — 50 звёзд\n\n"
-                    "Попробуйте еще раз или выберите из предложенных вариантов:",
-                    reply_markup=get_stars_selection_keyboard()
+            if amount < MIN_STARS:
+                reply(
+                    update,
+                    context,
+                    locale.text('stars_below_min_retry'),
+                    reply_markup=locale.stars_keyboard
                 )
                 return
-            elif amount > 10000:
-                update.message.reply_text(
-                    "❌ Максимум — 10 000 звёзд\n\n"
-                    "Попробуйте еще раз или выберите из предложенных вариантов:",
-                    reply_markup=get_stars_selection_keyboard()
+            elif amount > MAX_STARS:
+                reply(
+                    update,
+                    context,
+                    locale.text('stars_above_max_retry'),
+                    reply_markup=locale.stars_keyboard
                 )
                 return
             else:
                 # Корректное число - показываем заказ
-                is_gift = context.user_data.get('is_gift', False)
+                is_gift = state.get('is_gift', False)
                 show_order_message(update, context, amount, is_gift)
                 
                 # Сбрасываем флаг подарка
-                context.user_data.pop('is_gift', None)
+                state.pop('is_gift', None)
                 return
                 
         except ValueError:
             # Не число - показываем ошибку и возвращаем к выбору
-            update.message.reply_text(
-                "❌ Введите число от 50 до 10 000\n\n"
-                "Или выберите из предложенных вариантов:",
-                reply_markup=get_stars_selection_keyboard()
+            reply(
+                update,
+                context,
+                locale.text('stars_not_a_number'),
+                reply_markup=locale.stars_keyboard
             )
             return
     
-    # Обработка основных команд меню
-    if text == "⭐ Купить звезды":
+    # Обработка основных команд меню (подписи кнопок на любом языке)
+    action = templates.action(text)
+    if action == 'buy_stars':
         handle_buy_stars(update, context)
-    elif text == "💎 Купить Premium":
+    elif action == 'buy_premium':
         handle_buy_premium(update, context)
-    elif text == "👤 Профиль":
+    elif action == 'profile':
         handle_profile(update, context)
-    elif text == "🆘 Поддержка":
+    elif action == 'support':
         handle_support(update, context)
     else:
         # Неизвестное сообщение
-        update.message.reply_text(
-            "Пожалуйста, используйте кнопки меню для навигации.",
-            reply_markup=get_reply_keyboard()
+        reply(
+            update,
+            context,
+            locale.text('use_menu'),
+            reply_markup=locale.main_keyboard
         )
 
 
+def register_handlers(dispatcher) -> None:
+    """Зарегистрировать обработчики бота (с замером времени каждого)"""
+    dispatcher.add_handler(CommandHandler("start", instrument(start)))
+    dispatcher.add_handler(CommandHandler("stats", instrument(handle_stats)))
+    dispatcher.add_handler(CallbackQueryHandler(instrument(handle_callback_query)))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, instrument(handle_message)))
+    # После основных обработчиков записываем изменения состояния пользователя
+    dispatcher.add_handler(TypeHandler(Update, flush_user_state), group=1)
+
+
+def start_webhook(updater: Updater) -> WebhookServer:
+    """Запустить прием обновлений через встроенный webhook-сервер"""
+    dispatcher = updater.dispatcher
+
+    def on_update(data):
+        update = Update.de_json(data, updater.bot)
+        # Не даем очереди диспетчера расти бесконечно: пока она полна, запросы
+        # копятся в очереди webhook, а когда заполнится и она - получают 429
+        while dispatcher.update_queue.qsize() >= WEBHOOK_QUEUE_SIZE:
+            time.sleep(0.01)
+        dispatcher.update_queue.put(update)
+
+    webhook = WebhookServer(
+        on_update,
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+        secret=WEBHOOK_SECRET,
+        queue_size=WEBHOOK_QUEUE_SIZE,
+    )
+    threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+    updater.job_queue.start()
+    webhook.start()
+    REGISTRY.register_gauges('webhook', webhook.stats)
+
+    updater.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    return webhook
+
+
+def wait_for_stop_signal() -> None:
+    """Ждать SIGINT/SIGTERM/SIGABRT"""
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda *args: stop.set())
+    while not stop.is_set():
+        stop.wait(1)
+
+
+def setup_services(dispatcher, job_queue, bot, worker_index=None, worker_count=1):
+    """
+    Создать очереди, пулы потоков, хранилища и фоновые задачи процесса,
+    который обрабатывает обновления, и зарегистрировать обработчики
+
+    Args:
+        dispatcher: Dispatcher процесса
+        job_queue: JobQueue процесса
+        bot: Bot для исходящих вызовов
+        worker_index: номер процесса-обработчика (None - бот работает одним процессом)
+        worker_count: сколько всего процессов-обработчиков
+
+    Returns:
+        function: остановка - отправить оставшиеся сообщения, дождаться записей,
+                  закрыть соединения
+    """
+    # Общие для всего бота задачи (заказы, сверка, рассылки) выполняет только один процесс
+    primary = worker_index is None or worker_index == 0
+
+    # Очередь исходящих сообщений с учетом лимитов Telegram; общий лимит бота
+    # делится между процессами, початовый остается прежним (чат всегда в одном процессе)
+    outbound = OutboundScheduler(
+        bot,
+        global_rate=OUTBOUND_GLOBAL_RATE / worker_count,
+        chat_rate=OUTBOUND_CHAT_RATE,
+        chat_burst=OUTBOUND_CHAT_BURST,
+        workers=OUTBOUND_WORKERS,
+    )
+    dispatcher.bot_data['outbound'] = outbound
+
+    # Отдельный пул потоков для запросов к базе данных
+    db_executor = KeyedExecutor(
+        workers=DB_EXECUTOR_WORKERS,
+        queue_size=DB_EXECUTOR_QUEUE_SIZE,
+        task_timeout=DB_TASK_TIMEOUT,
+    )
+    dispatcher.bot_data['db_executor'] = db_executor
+
+    # Состояние диалога пользователей хранится вне памяти процесса
+    state_store = StateStore(
+        create_backend(STATE_BACKEND, STATE_SQLITE_PATH),
+        idle_ttl=STATE_IDLE_TTL,
+        max_users=STATE_MAX_USERS,
+        executor=db_executor,
+        timeout=DB_TASK_TIMEOUT,
+    )
+    dispatcher.bot_data['state_store'] = state_store
+    job_queue.run_repeating(evict_idle_states, interval=60, first=60)
+
+    # Тарифы загружаются сразу и перечитываются только при изменении
+    try:
+        pricing.reload()
+    except Exception as e:
+        logger.error(f"Не удалось загрузить тарифы, используется цена по умолчанию: {e}")
+    job_queue.run_repeating(refresh_pricing, interval=PRICING_RELOAD_INTERVAL, first=PRICING_RELOAD_INTERVAL)
+
+    broadcasts = None
+    if primary:
+        # Просроченные заказы закрываются пачками в фоне
+        job_queue.run_repeating(expire_stale_orders, interval=ORDER_SWEEP_INTERVAL, first=ORDER_SWEEP_INTERVAL)
+
+        # Балансы в users сверяются с журналом звезд
+        job_queue.run_repeating(reconcile_stars_ledger, interval=LEDGER_RECONCILE_INTERVAL,
+                                first=LEDGER_RECONCILE_INTERVAL)
+
+        # Рассылки отправляются через ту же очередь исходящих сообщений с низким приоритетом
+        broadcasts = BroadcastRunner(outbound, page_size=BROADCAST_PAGE_SIZE, lease=BROADCAST_LEASE)
+        dispatcher.bot_data['broadcasts'] = broadcasts
+        job_queue.run_repeating(poll_broadcasts, interval=BROADCAST_POLL_INTERVAL, first=5)
+
+    # Журнал регистраций на время недоступности базы; сохраняется в базу после восстановления.
+    # У каждого процесса свой файл
+    journal_path = REGISTRATION_JOURNAL_PATH if worker_index is None else f"{REGISTRATION_JOURNAL_PATH}.{worker_index}"
+    journal = RegistrationJournal(journal_path, fsync=REGISTRATION_JOURNAL_FSYNC)
+    dispatcher.bot_data['journal'] = journal
+    job_queue.run_repeating(replay_registration_journal, interval=JOURNAL_REPLAY_INTERVAL, first=1)
+
+    # Буфер для пакетного сохранения регистраций
+    registrations = None
+    if DB_WRITE_BEHIND:
+        registrations = RegistrationBuffer(
+            lambda rows: save_registrations(journal, rows),
+            batch_size=DB_WRITE_BEHIND_BATCH,
+            flush_interval=DB_WRITE_BEHIND_INTERVAL,
+        )
+        dispatcher.bot_data['registrations'] = registrations
+
+    # Метрики: задержки обработчиков и запросов к базе, ошибки, глубина очередей.
+    # Процесс-обработчик N отдает метрики на METRICS_PORT + 1 + N
+    REGISTRY.register_gauges('dispatcher', lambda: {'queue_depth': dispatcher.update_queue.qsize()})
+    REGISTRY.register_gauges('outbound', outbound.stats)
+    REGISTRY.register_gauges('db_executor', db_executor.stats)
+    REGISTRY.register_gauges('db_pool', pool_stats)
+    REGISTRY.register_gauges('db_breaker', breaker_stats)
+    REGISTRY.register_gauges('journal', journal.stats)
+    REGISTRY.register_gauges('user_cache', user_cache_stats)
+    REGISTRY.register_gauges('profile_writes', profile_write_stats)
+    REGISTRY.register_gauges('state', state_store.stats)
+    REGISTRY.register_gauges('log', log_pipeline.stats)
+    if registrations is not None:
+        REGISTRY.register_gauges('registrations', lambda: {'queue_depth': len(registrations)})
+    metrics_server = None
+    if METRICS_PORT:
+        port = METRICS_PORT if worker_index is None else METRICS_PORT + 1 + worker_index
+        metrics_server = MetricsServer(listen=METRICS_LISTEN, port=port)
+        metrics_server.start()
+    PROFILER.top = PROFILER_TOP
+    PROFILER.interval = PROFILER_INTERVAL
+    if PROFILER_ENABLED:
+        PROFILER.enable()
+
+    # Регистрируем обработчики
+    register_handlers(dispatcher)
+
+    def shutdown():
+        # Останавливаем рассылку, отправляем оставшиеся сообщения, дожидаемся уже
+        # поставленных запросов, сохраняем накопленные регистрации и закрываем
+        # соединения с базой данных
+        if broadcasts is not None:
+            broadcasts.stop()
+        outbound.stop()
+        state_store.close()
+        db_executor.shutdown(wait=True)
+        if registrations is not None:
+            try:
+                registrations.close()
+            except Exception as e:
+                logger.error(f"Не удалось сохранить регистрации при остановке: {e}")
+        journal.close()
+        close_pool()
+        PROFILER.disable()
+        if metrics_server is not None:
+            metrics_server.stop()
+
+    return shutdown
+
+
+def run_worker(worker_index: int, worker_count: int, updates) -> None:
+    """
+    Процесс-обработчик: обрабатывает обновления своих пользователей из очереди updates
+
+    Останавливается, получив None, после обработки всех полученных ранее обновлений.
+    """
+    # Сигналы остановки получает вся группа процессов; останавливает обработчики
+    # процесс приема, когда перестанет принимать обновления
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logger.info(f"Процесс-обработчик {worker_index} из {worker_count} запущен")
+
+    bot = Bot(BOT_TOKEN, request=Request(con_pool_size=OUTBOUND_WORKERS + 4))
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot, queue.Queue(), job_queue=job_queue, use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+    shutdown = setup_services(dispatcher, job_queue, bot, worker_index, worker_count)
+
+    threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+    job_queue.start()
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        dispatcher.update_queue.put(Update.de_json(data, bot))
+
+    # Обрабатываем то, что уже принято, и останавливаемся
+    while not dispatcher.update_queue.empty():
+        time.sleep(0.05)
+    dispatcher.stop()
+    job_queue.stop()
+    shutdown()
+    logger.info(f"Процесс-обработчик {worker_index} остановлен")
+
+
+def run_ingestion() -> None:
+    """
+    Процесс приема: получает обновления (polling или webhook) и распределяет
+    их по BOT_WORKERS процессам-обработчикам по user ID
+    """
+    pool = WorkerPool(run_worker, BOT_WORKERS, queue_size=WORKER_QUEUE_SIZE)
+    pool.start()
+    REGISTRY.register_gauges('workers', pool.stats)
+    REGISTRY.register_gauges('log', log_pipeline.stats)
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(listen=METRICS_LISTEN, port=METRICS_PORT)
+        metrics_server.start()
+
+    if BOT_MODE == 'webhook':
+        webhook = WebhookServer(
+            pool.route,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret=WEBHOOK_SECRET,
+            queue_size=WEBHOOK_QUEUE_SIZE,
+        )
+        webhook.start()
+        REGISTRY.register_gauges('webhook', webhook.stats)
+        bot = Bot(BOT_TOKEN)
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        logger.info(f"Бот запущен (webhook, процессов-обработчиков: {BOT_WORKERS})...")
+        wait_for_stop_signal()
+        webhook.stop()
+    else:
+        # Диспетчер процесса приема только пересылает обновления обработчикам
+        updater = Updater(token=BOT_TOKEN, use_context=True)
+        updater.dispatcher.add_handler(TypeHandler(Update, lambda update, context: pool.route(update.to_dict())))
+        updater.start_polling()
+        logger.info(f"Бот запущен (процессов-обработчиков: {BOT_WORKERS})...")
+        updater.idle()
+
+    pool.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+
+
 def main() -> None:
     """Запуск бота"""
-    # Инициализируем базу данных
+    # Проверяем версию схемы базы данных (миграции применяются отдельно: python migrate.py)
     try:
-        logger.info("Инициализация базы данных...")
-        init_db()
-        logger.info("База данных готова")
+        check_schema()
     except Exception as e:
-        logger.error(f"Ошибка при инициализации базы данных: {e}")
+        logger.error(f"Ошибка при проверке схемы базы данных: {e}")
         logger.warning("Бот будет запущен без базы данных")
-    
+
+    if BOT_WORKERS > 1:
+        run_ingestion()
+        return
+
     # Создаем Updater и передаем ему токен бота
     updater = Updater(token=BOT_TOKEN, use_context=True)
     
     # Получаем dispatcher для регистрации обработчиков
     dispatcher = updater.dispatcher
-    
-    # Регистрируем обработчики
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CallbackQueryHandler(handle_callback_query))
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
+
+    # Очереди, пулы, хранилища, фоновые задачи и обработчики
+    shutdown = setup_services(dispatcher, updater.job_queue, updater.bot)
     
     # Запускаем бота
-    logger.info("Бот запущен...")
-    updater.start_polling()
-    
-    # Запускаем бота до тех пор, пока не будет нажато Ctrl-C
-    updater.idle()
+    if BOT_MODE == 'webhook':
+        webhook = start_webhook(updater)
+        logger.info("Бот запущен (webhook)...")
+
+        # Работаем до тех пор, пока не будет нажато Ctrl-C, затем обрабатываем
+        # уже принятые обновления и останавливаем диспетчер
+        wait_for_stop_signal()
+        webhook.stop()
+        dispatcher.stop()
+        updater.job_queue.stop()
+    else:
+        logger.info("Бот запущен...")
+        updater.start_polling()
+
+        # Запускаем бота до тех пор, пока не будет нажато Ctrl-C
+        updater.idle()
+
+    shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,220 @@
+"""
+Тексты и клавиатуры бота на разных языках
+
+Каталоги locales/<язык>.json загружаются один раз при старте. Шаблоны
+сообщений заранее разбираются на постоянные части и подстановки, а
+клавиатуры создаются один раз на язык вместе с готовым JSON, поэтому
+при ответе пользователю подставляются только имя, количество, цена и т.п.
+"""
+import json
+import logging
+import os
+from string import Formatter
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+# Варианты количества звезд на inline-клавиатуре, по две кнопки в ряду
+STAR_OPTIONS = (50, 100, 200, 500, 1000, 5000)
+
+# Кнопки главного меню: ключ каталога buttons == действие, которое возвращает action()
+MENU_ACTIONS = (('buy_stars', 'buy_premium'), ('profile', 'support'))
+
+
+class Template:
+    """
+    Заранее разобранный шаблон str.format
+
+    Шаблон без подстановок отдается как есть, остальные собираются из
+    постоянных частей и значений без повторного разбора строки.
+    """
+
+    __slots__ = ('source', 'parts', 'fields')
+
+    def __init__(self, source):
+        self.source = source
+        parts = []
+        fields = []
+        for literal, field, spec, conversion in Formatter().parse(source):
+            if field is not None and (not field.isidentifier() or conversion):
+                raise ValueError(f"Неподдерживаемая подстановка {{{field}}} в шаблоне {source!r}")
+            parts.append((literal, field, spec or ''))
+            if field is not None:
+                fields.append(field)
+        self.parts = tuple(parts)
+        self.fields = frozenset(fields)
+
+    def render(self, params):
+        if not self.fields:
+            return self.source
+        return ''.join(
+            literal if field is None else literal + format(params[field], spec)
+            for literal, field, spec in self.parts
+        )
+
+
+class _FrozenMarkup:
+    """
+    Клавиатура, которую нельзя изменить после создания
+
+    JSON считается один раз; Bot берет его через to_json() при каждой отправке.
+    """
+
+    def _freeze(self):
+        object.__setattr__(self, '_json', super().to_json())
+        object.__setattr__(self, '_frozen', True)
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f"{type(self).__name__} неизменяема")
+        super().__setattr__(name, value)
+
+    def to_json(self):
+        return self._json
+
+
+class FrozenReplyKeyboardMarkup(_FrozenMarkup, ReplyKeyboardMarkup):
+    """Неизменяемая reply-клавиатура с готовым JSON"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._freeze()
+
+
+class FrozenInlineKeyboardMarkup(_FrozenMarkup, InlineKeyboardMarkup):
+    """Неизменяемая inline-клавиатура с готовым JSON"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._freeze()
+
+
+class Locale:
+    """Тексты и клавиатуры одного языка"""
+
+    def __init__(self, code, catalog):
+        """
+        Args:
+            code: код языка (ru, en, ...)
+            catalog: dict с разделами buttons и messages
+        """
+        self.code = code
+        buttons = catalog['buttons']
+        self.messages = {key: Template(text) for key, text in catalog['messages'].items()}
+        self.date_format = catalog['messages'].get('date_format', '%d.%m.%Y')
+
+        # Подписи кнопок меню -> действие (для разбора входящего текста)
+        self.menu_buttons = {buttons[action]: action for row in MENU_ACTIONS for action in row}
+
+        self.main_keyboard = FrozenReplyKeyboardMarkup(
+            tuple(tuple(buttons[action] for action in row) for row in MENU_ACTIONS),
+            resize_keyboard=True,
+            one_time_keyboard=False
+        )
+        stars_label = Template(buttons['stars'])
+        star_buttons = tuple(
+            InlineKeyboardButton(stars_label.render({'amount': amount}), callback_data=f"stars_{amount}")
+            for amount in STAR_OPTIONS
+        )
+        self.stars_keyboard = FrozenInlineKeyboardMarkup(
+            tuple(star_buttons[i:i + 2] for i in range(0, len(star_buttons), 2))
+            + ((InlineKeyboardButton(buttons['gift'], callback_data="stars_gift"),),)
+        )
+
+    def text(self, key, **params):
+        """
+        Текст сообщения
+
+        Args:
+            key: ключ из раздела messages каталога
+            **params: значения подстановок шаблона
+
+        Returns:
+            str: готовый текст
+        """
+        return self.messages[key].render(params)
+
+    def format_date(self, value):
+        """Дата в формате языка (или 'неизвестно' на этом языке, если даты нет)"""
+        if value is None:
+            return self.text('profile_no_date')
+        return value.strftime(self.date_format)
+
+
+class TemplateRegistry:
+    """
+    Каталоги всех языков
+
+    Отсутствующие в каталоге языка ключи берутся из каталога языка по умолчанию.
+    """
+
+    def __init__(self, directory, default='ru'):
+        """
+        Args:
+            directory: каталог с файлами <язык>.json
+            default: язык по умолчанию (его файл обязателен)
+        """
+        catalogs = {}
+        for filename in sorted(os.listdir(directory)):
+            code, extension = os.path.splitext(filename)
+            if extension != '.json':
+                continue
+            with open(os.path.join(directory, filename), encoding='utf-8') as f:
+                catalogs[code.lower()] = json.load(f)
+        if default not in catalogs:
+            raise ValueError(f"Нет каталога языка по умолчанию: {os.path.join(directory, default + '.json')}")
+
+        base = catalogs[default]
+        self.default = default
+        self._locales = {}
+        for code, catalog in catalogs.items():
+            merged = {section: {**base[section], **catalog.get(section, {})} for section in ('buttons', 'messages')}
+            self._check(code, merged, base)
+            self._locales[code] = Locale(code, merged)
+
+        # Подпись кнопки меню на любом языке -> действие
+        self._actions = {}
+        for locale in self._locales.values():
+            self._actions.update(locale.menu_buttons)
+
+        # language_code из Telegram -> Locale; кодов немного, поэтому кэш не ограничен
+        self._resolved = {}
+        logger.info(f"Загружены тексты на языках: {', '.join(sorted(self._locales))}")
+
+    @staticmethod
+    def _check(code, catalog, base):
+        """Подстановки каждого шаблона должны совпадать с языком по умолчанию"""
+        for key, text in catalog['messages'].items():
+            expected = Template(base['messages'][key]).fields if key in base['messages'] else None
+            if expected is not None and Template(text).fields != expected:
+                raise ValueError(f"Шаблон {key} языка {code}: подстановки {sorted(Template(text).fields)}, "
+                                 f"ожидаются {sorted(expected)}")
+
+    def get(self, language_code=None):
+        """
+        Тексты для языка пользователя
+
+        Args:
+            language_code: код языка из Telegram (en, en-US, pt-br) или None
+
+        Returns:
+            Locale: язык пользователя или язык по умолчанию
+        """
+        locale = self._resolved.get(language_code)
+        if locale is None:
+            code = (language_code or '').lower()
+            locale = (self._locales.get(code)
+                      or self._locales.get(code.split('-')[0])
+                      or self._locales[self.default])
+            self._resolved[language_code] = locale
+        return locale
+
+    def action(self, text):
+        """
+        Действие кнопки меню по ее подписи на любом языке
+
+        Returns:
+            str или None: buy_stars, buy_premium, profile, support
+        """
+        return self._actions.get(text)
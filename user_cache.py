@@ -0,0 +1,124 @@
+"""
+Кэш пользователей в памяти процесса
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# Признак "пользователя нет в базе" (отрицательное кэширование)
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Ограниченный по размеру кэш с временем жизни записей и вытеснением LRU
+
+    Записи старше ttl секунд считаются отсутствующими. При переполнении
+    вытесняется запись, к которой дольше всего не обращались.
+    Отсутствие значения (MISSING) хранится с отдельным, обычно меньшим, negative_ttl.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0, negative_ttl=10.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Счетчик инвалидаций. Для каждого ключа помним номер его последней инвалидации
+        # (не больше maxsize последних): значение этого ключа, прочитанное до нее,
+        # в кэш уже не попадет, а чтения других ключей она не затрагивает
+        self._generation = 0
+        self._invalidated = OrderedDict()
+        # Значения, прочитанные до этого поколения, не сохраняются для любого ключа
+        # (clear() или вытеснение старых отметок об инвалидации)
+        self._floor = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Получить значение из кэша
+
+        Returns:
+            значение, MISSING для закэшированного отсутствия или None, если записи нет
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def generation(self):
+        """Текущее поколение кэша; берется до чтения из базы и передается в set()"""
+        with self._lock:
+            return self._generation
+
+    def set(self, key, value, generation=None):
+        """
+        Положить значение в кэш
+
+        Args:
+            key: ключ
+            value: значение (MISSING - запомнить, что записи нет)
+            generation: поколение на момент чтения из базы; если с тех пор этот
+                ключ инвалидировали, значение могло устареть и не сохраняется
+        """
+        if self.maxsize <= 0:
+            return
+        ttl = self.negative_ttl if value is MISSING else self.ttl
+        with self._lock:
+            if generation is not None and (
+                    generation < self._floor or self._invalidated.get(key, 0) > generation):
+                return
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Удалить запись из кэша"""
+        with self._lock:
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > max(self.maxsize, 1):
+                _, generation = self._invalidated.popitem(last=False)
+                self._floor = max(self._floor, generation)
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """Очистить кэш"""
+        with self._lock:
+            self._generation += 1
+            self._floor = self._generation
+            self._invalidated.clear()
+            self._data.clear()
+
+    def stats(self):
+        """
+        Статистика кэша
+
+        Returns:
+            dict: size, hits, misses, evictions, invalidations, hit_rate
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,178 @@
+"""
+Выгрузка и загрузка таблицы users через COPY
+
+Выгрузка идет потоком в CSV или JSONL (с сжатием по расширению файла:
+.gz, .bz2, .xz), поэтому память не зависит от числа пользователей.
+Загрузка копирует файл во временную таблицу и сливает ее в users одним upsert.
+
+Использование:
+    python user_transfer.py export users.csv.gz
+    python user_transfer.py export users.jsonl.gz --since 2024-01-01T00:00:00
+    python user_transfer.py export changes.csv.gz --watermark-file users.watermark
+    python user_transfer.py export - --format jsonl | ...
+    python user_transfer.py import users.csv.gz
+    python user_transfer.py import users.csv.gz --force
+"""
+import argparse
+import bz2
+import gzip
+import io
+import logging
+import lzma
+import os
+import sys
+from contextlib import contextmanager
+
+from database import export_users, import_users, close_pool
+
+# Размер буферов файлов: COPY отдает данные построчно
+_BUFFER_SIZE = 1 << 20
+
+FORMATS = ('csv', 'jsonl')
+
+
+def _compression(path):
+    """Сжатие по расширению файла: gz, bz2, xz или None"""
+    for extension in ('gz', 'bz2', 'xz'):
+        if path.endswith('.' + extension):
+            return extension
+    return None
+
+
+def detect_format(path):
+    """Формат по расширению файла без учета сжатия (users.jsonl.gz -> jsonl), иначе csv"""
+    compression = _compression(path)
+    if compression:
+        path = path[:-len(compression) - 1]
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def _compressor(raw, compression, level):
+    if compression == 'gz':
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level)
+    if compression == 'bz2':
+        return bz2.BZ2File(raw, mode='wb', compresslevel=max(level, 1))
+    if compression == 'xz':
+        return lzma.LZMAFile(raw, mode='wb', preset=level)
+    return None
+
+
+def _decompressor(raw, compression):
+    if compression == 'gz':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if compression == 'bz2':
+        return bz2.BZ2File(raw, mode='rb')
+    if compression == 'xz':
+        return lzma.LZMAFile(raw, mode='rb')
+    return raw
+
+
+@contextmanager
+def open_output(path, level=6):
+    """
+    Файл для выгрузки ('-' - stdout)
+
+    Пишется во временный файл и переименовывается только после успешной выгрузки.
+    """
+    if path == '-':
+        yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
+        return
+
+    partial = path + '.partial'
+    try:
+        with open(partial, 'wb', buffering=_BUFFER_SIZE) as raw:
+            compressor = _compressor(raw, _compression(path), level)
+            if compressor is None:
+                yield raw
+            else:
+                # Строки от COPY копятся в буфере и сжимаются блоками, а не по одной
+                writer = io.BufferedWriter(compressor, _BUFFER_SIZE)
+                yield writer
+                writer.close()
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+@contextmanager
+def open_input(path):
+    """Файл для загрузки ('-' - stdin), распаковывается по расширению"""
+    if path == '-':
+        yield sys.stdin.buffer
+        return
+    with open(path, 'rb', buffering=_BUFFER_SIZE) as raw:
+        yield _decompressor(raw, _compression(path))
+
+
+def read_watermark(path):
+    """Watermark прошлой выгрузки из файла (None, если файла нет)"""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return f.read().strip() or None
+
+
+def write_watermark(path, watermark):
+    """Сохранить watermark для следующей выгрузки (атомарно)"""
+    partial = path + '.partial'
+    with open(partial, 'w', encoding='utf-8') as f:
+        f.write(watermark.isoformat() + '\n')
+    os.replace(partial, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка пользователей через COPY")
+    commands = parser.add_subparsers(dest='command')
+
+    export = commands.add_parser('export', help="выгрузить пользователей")
+    export.add_argument('path', help="файл (.csv, .jsonl, со сжатием .gz/.bz2/.xz) или - для stdout")
+    export.add_argument('--format', choices=FORMATS, help="формат (по умолчанию по расширению файла)")
+    since = export.add_mutually_exclusive_group()
+    since.add_argument('--since', help="только измененные позже этого момента (ГГГГ-ММ-ДДTЧЧ:ММ:СС)")
+    since.add_argument('--watermark-file',
+                       help="файл с watermark: выгрузить изменения с прошлого запуска и обновить его")
+    export.add_argument('--lag', type=float, default=60,
+                        help="не выгружать изменения моложе стольких секунд (default: %(default)s)")
+    export.add_argument('--level', type=int, default=6, help="уровень сжатия 0-9 (default: %(default)s)")
+
+    load = commands.add_parser('import', help="загрузить пользователей в users")
+    load.add_argument('path', help="файл выгрузки или - для stdin")
+    load.add_argument('--format', choices=FORMATS, help="формат (по умолчанию по расширению файла)")
+    load.add_argument('--force', action='store_true',
+                      help="перезаписать пользователей, даже если в базе они изменены позже, чем в файле")
+
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+        stream=sys.stderr
+    )
+
+    try:
+        if args.command == 'export':
+            fmt = args.format or detect_format(args.path)
+            since = args.since
+            if args.watermark_file:
+                since = read_watermark(args.watermark_file)
+            with open_output(args.path, args.level) as output:
+                result = export_users(output, fmt, since=since, lag_seconds=args.lag)
+            if args.watermark_file:
+                write_watermark(args.watermark_file, result['watermark'])
+            print(f"Выгружено пользователей: {result['rows']}, watermark {result['watermark'].isoformat()}",
+                  file=sys.stderr)
+        elif args.command == 'import':
+            fmt = args.format or detect_format(args.path)
+            with open_input(args.path) as source:
+                result = import_users(source, fmt, force=args.force)
+            print(f"Строк в файле: {result['staged']}, новых пользователей: {result['inserted']}, "
+                  f"изменено: {result['updated']}", file=sys.stderr)
+        else:
+            parser.print_help()
+    finally:
+        close_pool()
+
+
+if __name__ == '__main__':
+    main()
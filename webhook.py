@@ -0,0 +1,170 @@
+"""
+Встроенный HTTP-сервер для приема обновлений Telegram через webhook
+"""
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передает secret_token из setWebhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Принимает POST с обновлением, проверяет секрет и сразу отвечает"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'telestars-webhook'
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        # Ответы до чтения тела закрывают соединение: непрочитанное тело
+        # нельзя оставить в keep-alive соединении
+        if self.path != webhook.path:
+            self._respond(404, close=True)
+            return
+        if webhook.secret and not hmac.compare_digest(
+                self.headers.get(SECRET_HEADER, ''), webhook.secret):
+            webhook._count('unauthorized')
+            self._respond(403, close=True)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = 0
+        if length <= 0:
+            self._respond(400, close=True)
+            return
+        if length > webhook.max_body_size:
+            self._respond(413, close=True)
+            return
+
+        body = self.rfile.read(length)
+        if webhook.enqueue(body):
+            self._respond(200)
+        else:
+            # Очередь полна: Telegram повторит доставку позже
+            self._respond(429, {'Retry-After': '1'})
+
+    def _respond(self, code, headers=None, close=False):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if close:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Не пишем строку в лог на каждый запрос
+        pass
+
+
+class WebhookServer:
+    """
+    HTTP-сервер для webhook с очередью в памяти
+
+    Запрос подтверждается ответом 200 сразу после постановки тела в очередь;
+    разбор JSON и обработка идут в отдельном потоке, который передает
+    обновления в on_update по порядку. Если очередь заполнена, сервер
+    отвечает 429 и Telegram повторяет доставку позже.
+    """
+
+    def __init__(self, on_update, listen='0.0.0.0', port=8443, path='/telegram',
+                 secret=None, queue_size=10000, max_body_size=1024 * 1024):
+        """
+        Args:
+            on_update: функция, принимающая разобранное обновление (dict)
+            listen: адрес для прослушивания
+            port: порт (0 - выбрать свободный)
+            path: путь webhook
+            secret: ожидаемое значение заголовка X-Telegram-Bot-Api-Secret-Token
+            queue_size: максимум обновлений, ожидающих обработки
+            max_body_size: максимальный размер тела запроса в байтах
+        """
+        self._on_update = on_update
+        self.listen = listen
+        self.path = path
+        self.secret = secret
+        self.max_body_size = max_body_size
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        self._httpd = ThreadingHTTPServer((listen, port), _WebhookRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.webhook = self
+        self._server_thread = None
+        self._consumer_thread = None
+
+        self._lock = threading.Lock()
+        self._counters = {'accepted': 0, 'rejected': 0, 'unauthorized': 0, 'processed': 0, 'errors': 0}
+
+    @property
+    def port(self):
+        """Порт, на котором фактически слушает сервер"""
+        return self._httpd.server_address[1]
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def enqueue(self, body):
+        """
+        Поставить тело запроса в очередь
+
+        Returns:
+            bool: False если очередь заполнена
+        """
+        try:
+            self._queue.put_nowait(body)
+        except queue.Full:
+            self._count('rejected')
+            return False
+        self._count('accepted')
+        return True
+
+    def _consume(self):
+        while True:
+            body = self._queue.get()
+            if body is None:
+                return
+            try:
+                self._on_update(json.loads(body))
+                self._count('processed')
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"Ошибка при обработке обновления из webhook: {e}")
+
+    def start(self):
+        """Запустить HTTP-сервер и поток обработки очереди"""
+        self._consumer_thread = threading.Thread(target=self._consume, name='webhook-consumer', daemon=True)
+        self._consumer_thread.start()
+        self._server_thread = threading.Thread(target=self._httpd.serve_forever, name='webhook-http', daemon=True)
+        self._server_thread.start()
+        logger.info(f"Webhook слушает {self.listen}:{self.port}{self.path}")
+
+    def stop(self):
+        """Перестать принимать запросы и обработать то, что уже в очереди"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._queue.put(None)
+        if self._consumer_thread is not None:
+            self._consumer_thread.join()
+
+    def stats(self):
+        """
+        Статистика webhook
+
+        Returns:
+            dict: queue_depth, accepted, rejected (очередь полна), unauthorized,
+                  processed, errors
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
@@ -0,0 +1,148 @@
+"""
+Нагрузочный тест приема обновлений через webhook без Telegram
+
+Отправляет синтетические обновления POST-запросами и измеряет пропускную
+способность и задержку подтверждения.
+
+Использование:
+    python webhook_loadtest.py                       # локальный сервер с пустым обработчиком
+    python webhook_loadtest.py --url http://127.0.0.1:8443/telegram --secret SECRET
+"""
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+from webhook import WebhookServer, SECRET_HEADER
+
+
+def make_update(update_id, user_id, text='/start'):
+    """Синтетическое обновление с текстовым сообщением от пользователя"""
+    user = {
+        'id': user_id,
+        'is_bot': False,
+        'first_name': f'User{user_id}',
+        'username': f'user{user_id}',
+        'language_code': 'ru',
+    }
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private', 'first_name': user['first_name']},
+        'from': user,
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по отсортированному списку"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(url, secret, requests, concurrency, users):
+    """
+    Отправить requests обновлений в concurrency потоков
+
+    Returns:
+        dict: elapsed, rps, статусы ответов и перцентили задержки в миллисекундах
+    """
+    parsed = urlparse(url)
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers[SECRET_HEADER] = secret
+
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    counter = iter(range(1, requests + 1))
+    counter_lock = threading.Lock()
+
+    def worker():
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=10)
+        local_latencies = []
+        local_statuses = Counter()
+        while True:
+            with counter_lock:
+                update_id = next(counter, None)
+            if update_id is None:
+                break
+            body = json.dumps(make_update(update_id, random.randint(1, users)))
+            started = time.perf_counter()
+            try:
+                conn.request('POST', parsed.path or '/', body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                local_statuses[response.status] += 1
+            except (OSError, http.client.HTTPException):
+                local_statuses['error'] += 1
+                conn.close()
+                conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=10)
+            local_latencies.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies.extend(local_latencies)
+            statuses.update(local_statuses)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'elapsed': elapsed,
+        'rps': requests / elapsed if elapsed else 0.0,
+        'statuses': dict(statuses),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест webhook")
+    parser.add_argument('--url', help="адрес webhook; без него запускается локальный сервер")
+    parser.add_argument('--secret', default='loadtest-secret', help="секретный токен webhook")
+    parser.add_argument('--requests', type=int, default=10000, help="сколько обновлений отправить")
+    parser.add_argument('--concurrency', type=int, default=16, help="число параллельных клиентов")
+    parser.add_argument('--users', type=int, default=1000, help="число разных пользователей")
+    parser.add_argument('--queue-size', type=int, default=10000, help="размер очереди локального сервера")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server = WebhookServer(lambda update: None, listen='127.0.0.1', port=0,
+                               secret=args.secret, queue_size=args.queue_size)
+        server.start()
+        url = f'http://127.0.0.1:{server.port}{server.path}'
+
+    try:
+        result = run(url, args.secret, args.requests, args.concurrency, args.users)
+    finally:
+        if server is not None:
+            server.stop()
+
+    print(f"Отправлено: {args.requests} за {result['elapsed']:.2f} с ({result['rps']:.0f} запросов/с)")
+    print(f"Ответы: {result['statuses']}")
+    print(f"Задержка подтверждения: p50={result['p50_ms']:.2f} мс, "
+          f"p95={result['p95_ms']:.2f} мс, p99={result['p99_ms']:.2f} мс")
+    if server is not None:
+        print(f"Сервер: {server.stats()}")
+
+
+if __name__ == '__main__':
+    main()
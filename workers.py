@@ -0,0 +1,174 @@
+"""
+Распределение обновлений по нескольким процессам-обработчикам
+
+Процесс приема (polling или webhook) отправляет обновление в процесс,
+выбранный по согласованному хэшу user ID, поэтому все обновления одного
+пользователя обрабатываются одним процессом по порядку, а его состояние
+диалога и кэши живут только в этом процессе.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Поля обновления, в которых Telegram передает объект с отправителем
+_UPDATE_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'channel_post', 'edited_channel_post',
+    'my_chat_member', 'chat_member', 'poll_answer',
+)
+
+
+def jump_hash(key, buckets):
+    """
+    Согласованный хэш (jump consistent hash, Lamping & Veach)
+
+    При изменении числа процессов с N на N+1 переезжает только 1/(N+1) ключей.
+
+    Args:
+        key: неотрицательное целое (user ID)
+        buckets: число процессов
+
+    Returns:
+        int: номер процесса от 0 до buckets - 1
+    """
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def update_key(data):
+    """
+    Ключ распределения обновления: ID отправителя, иначе ID чата, иначе update_id
+
+    Args:
+        data: обновление Telegram (dict)
+    """
+    for field in _UPDATE_FIELDS:
+        payload = data.get(field)
+        if not payload:
+            continue
+        sender = payload.get('from') or payload.get('user')
+        if sender:
+            return abs(sender['id'])
+        chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+        if chat:
+            return abs(chat['id'])
+    return data.get('update_id', 0)
+
+
+class WorkerPool:
+    """
+    Процессы-обработчики с отдельной очередью у каждого
+
+    target(index, count, queue) запускается в каждом процессе и читает
+    обновления (dict) из очереди, пока не получит None. Упавший процесс
+    перезапускается и продолжает читать ту же очередь.
+    """
+
+    def __init__(self, target, count, queue_size=10000):
+        """
+        Args:
+            target: функция процесса-обработчика (должна импортироваться по имени)
+            count: число процессов
+            queue_size: максимум обновлений в очереди одного процесса
+        """
+        # spawn: процесс приема многопоточный, fork в нем небезопасен
+        self._context = multiprocessing.get_context('spawn')
+        self._target = target
+        self.count = count
+        self._queues = [self._context.Queue(maxsize=queue_size) for _ in range(count)]
+        self._processes = [None] * count
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._monitor = threading.Thread(target=self._watch, name='worker-monitor', daemon=True)
+
+        # Статистика
+        self._routed = [0] * count
+        self._restarts = 0
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=self._target,
+            args=(index, self.count, self._queues[index]),
+            name=f'worker-{index}',
+        )
+        process.start()
+        self._processes[index] = process
+        logger.info(f"Запущен процесс-обработчик {index} (pid {process.pid})")
+
+    def start(self):
+        """Запустить процессы-обработчики"""
+        for index in range(self.count):
+            self._spawn(index)
+        self._monitor.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(1)
+            with self._lock:
+                if self._stopping:
+                    return
+                for index, process in enumerate(self._processes):
+                    if not process.is_alive():
+                        logger.error(f"Процесс-обработчик {index} завершился с кодом {process.exitcode}, перезапуск")
+                        self._restarts += 1
+                        self._spawn(index)
+
+    def route(self, data):
+        """
+        Отправить обновление процессу его пользователя
+
+        Если очередь процесса заполнена, ждет освобождения места.
+        """
+        index = jump_hash(update_key(data), self.count)
+        self._queues[index].put(data)
+        self._routed[index] += 1
+
+    def stop(self, timeout=60.0):
+        """
+        Дождаться обработки уже отправленных обновлений и остановить процессы
+
+        Args:
+            timeout: сколько ждать каждый процесс, секунд
+        """
+        with self._lock:
+            self._stopping = True
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        for index, process in enumerate(self._processes):
+            process.join(timeout)
+            if process.is_alive():
+                logger.error(f"Процесс-обработчик {index} не остановился за {timeout} с, завершаем")
+                process.terminate()
+                process.join()
+
+    def stats(self):
+        """
+        Статистика
+
+        Returns:
+            dict: workers, alive, restarts, queue_depth (сумма), queue_depth_N и routed_N по процессам
+        """
+        stats = {
+            'workers': self.count,
+            'alive': sum(1 for process in self._processes if process is not None and process.is_alive()),
+            'restarts': self._restarts,
+            'queue_depth': 0,
+        }
+        for index, worker_queue in enumerate(self._queues):
+            try:
+                depth = worker_queue.qsize()
+            except NotImplementedError:
+                # qsize() недоступен на macOS
+                depth = 0
+            stats['queue_depth'] += depth
+            stats[f'queue_depth_{index}'] = depth
+            stats[f'routed_{index}'] = self._routed[index]
+        return stats
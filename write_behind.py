@@ -0,0 +1,101 @@
+"""
+Отложенная пакетная запись регистраций пользователей (write-behind)
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RegistrationBuffer:
+    """
+    Буфер регистраций, который сбрасывается в базу пачками
+
+    Записи копятся в памяти (по одной на пользователя, новая заменяет старую)
+    и сохраняются одним запросом, когда набирается batch_size записей
+    или проходит flush_interval секунд с прошлого сброса.
+    """
+
+    def __init__(self, flush_func, batch_size=500, flush_interval=1.0):
+        """
+        Args:
+            flush_func: функция, принимающая список строк и сохраняющая их (например, add_users_bulk)
+            batch_size: сколько записей накопить до немедленного сброса
+            flush_interval: максимальная задержка записи в секундах
+        """
+        self._flush_func = flush_func
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._stopped = False
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='registration-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, key, row):
+        """
+        Поставить запись в очередь на сохранение
+
+        Args:
+            key: ключ записи (Telegram user ID)
+            row: значения для сохранения
+        """
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Буфер регистраций уже остановлен")
+            self._pending[key] = row
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def flush(self):
+        """Сохранить все накопленные записи прямо сейчас"""
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                self._flush_func(list(batch.values()))
+            except Exception as e:
+                logger.error("Не удалось сохранить %s регистраций, повторим позже: %s", len(batch), e,
+                             extra={'event': 'registrations_flush_failed'})
+                with self._cond:
+                    # Более свежие записи, пришедшие во время сброса, не затираем
+                    batch.update(self._pending)
+                    self._pending = batch
+                raise
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        failed = False
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    remaining = next_flush - time.monotonic()
+                    # После неудачного сброса ждем полный интервал, даже если буфер полон
+                    if remaining <= 0 or (not failed and len(self._pending) >= self.batch_size):
+                        break
+                    self._cond.wait(remaining)
+                if self._stopped:
+                    return
+            try:
+                self.flush()
+                failed = False
+            except Exception:
+                failed = True
+            next_flush = time.monotonic() + self.flush_interval
+
+    def close(self):
+        """Остановить фоновый поток и сохранить остаток буфера"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()